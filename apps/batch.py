@@ -0,0 +1,160 @@
+'''
+Run a batch of questions through dbot without the UI, e.g. to evaluate it.
+
+Questions are read from a JSONL file ({"question": ..., "id": ...} per line),
+answered concurrently and written to an output JSONL file as they complete:
+the SQL, its type, the number of attempts and the generation time, and with
+--execute the pre-flight plan, the execution time and the row count.
+
+Usage (from the repository root):
+  python apps/batch.py adventure_works questions.jsonl results.jsonl [--concurrency 8] [--execute]
+  LLM_BACKEND=fake python apps/batch.py adventure_works questions.jsonl results.jsonl
+'''
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from lib import dbot, engines, guard, llm, schema, schema_compact
+from lib.schema_index import SchemaIndex
+
+CONTEXT_TOP_K = 8
+CONTEXT_MAX_TOKENS = 3000
+FETCH_SIZE = 10000
+
+
+def load_schema(db_name):
+    '''
+    Returns (schema SQL, SchemaIndex or None, lib.schema_compact model or None)
+    from the saved snapshot of a database.
+    '''
+    model = schema_compact.load(db_name) if schema_compact.exists(db_name) else None
+    if schema.snapshot_exists(db_name):
+        snapshot = schema.load_snapshot(db_name)
+        return schema.render(snapshot), SchemaIndex(snapshot), model
+    if schema.exists(db_name):
+        return schema.load_from_file(db_name), None, model
+    raise SystemExit(f'No schema for {db_name}, generate it in the app first')
+
+
+def read_questions(path):
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                item = json.loads(line)
+                yield i, item if isinstance(item, dict) else {'question': item}
+
+
+def run(engine, preflight, sql):
+    '''
+    Check and run a statement, counting its rows without holding them.
+
+    Returns a dict of the plan, execution time and row count.
+    '''
+    con = engine.raw_connection()
+    try:
+        plan = preflight.check(con, sql)
+        start = time.perf_counter()
+        with con.cursor() as cursor:
+            guard.begin(cursor, read_only=True, statement_timeout=preflight.statement_timeout)
+        cursor = con.cursor(name=f'batch_{uuid.uuid4().hex}')
+        cursor.execute(plan['sql'])
+        rows = 0
+        while True:
+            batch = cursor.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+            rows += len(batch)
+        cursor.close()
+        return {
+            'executed_sql': plan['sql'],
+            'plan_cost': plan['cost'],
+            'plan_rows': plan['rows'],
+            'limited': plan['limited'],
+            'execute_ms': round((time.perf_counter() - start) * 1000, 2),
+            'rows': rows,
+        }
+    finally:
+        con.rollback()
+        con.close()
+
+
+async def answer(line, item, context, args, client, slots, db_slots, engine, preflight):
+    question = item['question']
+    record = {'line': line, 'id': item.get('id', line), 'question': question}
+    loop = asyncio.get_running_loop()
+    async with slots:
+        start = time.perf_counter()
+        for attempt in range(1, args.retries + 2):
+            record['attempts'] = attempt
+            try:
+                reply = await loop.run_in_executor(None, dbot.generate, client, context(question), question)
+                record.update({'sql': reply.get('sql'), 'type': reply.get('type'), 'error': reply.get('error')})
+                break
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+                if attempt <= args.retries:
+                    await asyncio.sleep(args.backoff * 2 ** (attempt - 1))
+        record['generate_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+    if args.execute and record.get('sql'):
+        async with db_slots:
+            try:
+                record.update(await loop.run_in_executor(None, run, engine, preflight, record['sql']))
+            except guard.Rejected as e:
+                record['rejected'] = e.reason
+            except Exception as e:
+                record['execute_error'] = f'{type(e).__name__}: {e}'
+    return record
+
+
+async def main(args):
+    schemas, index, model = load_schema(args.db)
+
+    def context(question):
+        return dbot.context(schemas, index, question, top_k=CONTEXT_TOP_K, max_tokens=CONTEXT_MAX_TOKENS,
+                            model=model)
+
+    kwargs = {}
+    if args.backend == 'fake':
+        kwargs = {'first_token_latency': args.latency}
+    client = llm.Client(llm.create_backend(args.backend, **kwargs), max_concurrency=args.concurrency)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(args.concurrency + args.db_concurrency))
+    slots = asyncio.Semaphore(args.concurrency)
+    db_slots = asyncio.Semaphore(args.db_concurrency)
+    engine = engines.get(args.db) if args.execute else None
+    preflight = guard.Preflight(statement_timeout=args.statement_timeout)
+
+    start = time.perf_counter()
+    count = failed = 0
+    tasks = [answer(line, item, context, args, client, slots, db_slots, engine, preflight)
+             for line, item in read_questions(args.questions)]
+    with open(args.output, 'w') as f:
+        for task in asyncio.as_completed(tasks):
+            record = await task
+            f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            count += 1
+            failed += not record.get('sql')
+
+    elapsed = time.perf_counter() - start
+    print(f'{count} questions in {elapsed:.2f}s ({count / elapsed:.1f}/s), {failed} without SQL')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer a JSONL of questions with dbot')
+    parser.add_argument('db', help='database name')
+    parser.add_argument('questions', help='input JSONL')
+    parser.add_argument('output', help='output JSONL')
+    parser.add_argument('--concurrency', type=int, default=8, help='questions generated at once')
+    parser.add_argument('--retries', type=int, default=2, help='retries of failed or malformed replies')
+    parser.add_argument('--backoff', type=float, default=1.0, help='seconds before the first retry')
+    parser.add_argument('--backend', default=os.environ.get('LLM_BACKEND', 'openai'))
+    parser.add_argument('--latency', type=float, default=0.5, help='latency of the fake backend')
+    parser.add_argument('--execute', action='store_true', help='run the SQL and count its rows')
+    parser.add_argument('--db-concurrency', type=int, default=4, help='statements run at once')
+    parser.add_argument('--statement-timeout', type=int, default=30000, help='in ms')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,162 @@
+import json
+import numpy as np
+import re
+import sqlite3
+import threading
+import time
+
+CREATE = '''
+CREATE TABLE IF NOT EXISTS answers (
+  db_name TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  question TEXT NOT NULL,
+  answer TEXT NOT NULL,
+  embedding BLOB,
+  created_at REAL NOT NULL,
+  accessed_at REAL NOT NULL,
+  PRIMARY KEY (db_name, fingerprint, question)
+);
+'''
+
+
+def normalize(question):
+    '''
+    Normalize a question so trivial rephrasings (case, spacing, trailing
+    punctuation) share a cache entry.
+    '''
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?.!;').strip().lower()
+
+
+class AnswerCache:
+    '''
+    A disk-backed cache of dbot answers, keyed by (database, schema fingerprint,
+    normalized question).
+
+    If an `embed` function is given, a question missing from the cache can also
+    be answered by a cached question whose embedding has a cosine similarity of
+    at least `similarity`. Entries expire after `ttl` seconds, and the least
+    recently used ones are evicted beyond `max_entries`. Entries of a database
+    are dropped as soon as a different schema fingerprint is seen for it.
+    '''
+
+    def __init__(self, path='data/db/answers.sqlite', max_entries=1000, ttl=7 * 24 * 3600,
+                 embed=None, similarity=0.95):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute(CREATE)
+
+    def get(self, db_name, fingerprint, question):
+        '''
+        Look up the answer of a question.
+
+        Returns the cached answer, or None.
+        '''
+        key = normalize(question)
+        with self._lock:
+            self._invalidate(db_name, fingerprint)
+            row = self._con.execute(
+                'SELECT answer FROM answers WHERE db_name = ? AND fingerprint = ? AND question = ? AND created_at >= ?',
+                (db_name, fingerprint, key, time.time() - self.ttl)).fetchone()
+            if row is None and self.embed is not None:
+                key, row = self._nearest(db_name, fingerprint, key)
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            if key == normalize(question):
+                self.hits += 1
+            else:
+                self.near_hits += 1
+            with self._con:
+                self._con.execute(
+                    'UPDATE answers SET accessed_at = ? WHERE db_name = ? AND fingerprint = ? AND question = ?',
+                    (time.time(), db_name, fingerprint, key))
+            return json.loads(row[0])
+
+    def put(self, db_name, fingerprint, question, answer):
+        '''
+        Store the answer of a question.
+        '''
+        key = normalize(question)
+        embedding = None
+        if self.embed is not None:
+            embedding = np.asarray(self.embed(key), dtype=np.float32).tobytes()
+
+        now = time.time()
+        with self._lock, self._con:
+            self._invalidate(db_name, fingerprint)
+            self._con.execute(
+                'INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (db_name, fingerprint, key, json.dumps(answer), embedding, now, now))
+            self._con.execute('DELETE FROM answers WHERE created_at < ?', (now - self.ttl,))
+            self._con.execute(
+                'DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def get_or_create(self, db_name, fingerprint, question, complete):
+        '''
+        Look up the answer of a question, or ask `complete` for it. Only answers
+        with a "sql" key are cached.
+
+        Arguments:
+        complete: A function taking the question and returning the answer.
+
+        Returns a tuple of (answer, True if it came from the cache).
+        '''
+        answer = self.get(db_name, fingerprint, question)
+        if answer is not None:
+            return answer, True
+
+        answer = complete(question)
+        if 'sql' in answer:
+            self.put(db_name, fingerprint, question, answer)
+        return answer, False
+
+    def stats(self):
+        lookups = self.hits + self.near_hits + self.misses
+        with self._lock:
+            entries = self._con.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock, self._con:
+            self._con.execute('DELETE FROM answers')
+
+    def _invalidate(self, db_name, fingerprint):
+        if self._fingerprints.get(db_name) == fingerprint:
+            return
+        with self._con:
+            self._con.execute(
+                'DELETE FROM answers WHERE db_name = ? AND fingerprint != ?', (db_name, fingerprint))
+        self._fingerprints[db_name] = fingerprint
+
+    def _nearest(self, db_name, fingerprint, key):
+        rows = self._con.execute(
+            'SELECT question, answer, embedding FROM answers WHERE db_name = ? AND fingerprint = ? AND created_at >= ? AND embedding IS NOT NULL',
+            (db_name, fingerprint, time.time() - self.ttl)).fetchall()
+        if not rows:
+            return key, None
+
+        query = np.asarray(self.embed(key), dtype=np.float32)
+        vectors = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+        scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return key, None
+        return rows[best][0], (rows[best][1],)
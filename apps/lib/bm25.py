@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter
+
+STOPWORDS = {
+    'a', 'about', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'does',
+    'each', 'for', 'from', 'give', 'have', 'how', 'i', 'in', 'is', 'it', 'its', 'list', 'me',
+    'many', 'much', 'my', 'of', 'on', 'or', 'our', 'per', 'please', 'show', 'that', 'the',
+    'their', 'them', 'there', 'these', 'they', 'this', 'to', 'was', 'we', 'were', 'what',
+    'when', 'where', 'which', 'who', 'with', 'would', 'you',
+}
+
+
+def tokenize(text, stopwords=STOPWORDS):
+    '''
+    Split a text into lower case, naively stemmed terms.
+
+    Arguments:
+    text: The text to tokenize.
+    stopwords: Terms to drop.
+
+    Returns a list of terms.
+    '''
+    terms = []
+    for term in re.split(r'[^a-z0-9]+', text.lower()):
+        if not term or term in stopwords:
+            continue
+        terms.append(stem(term))
+    return terms
+
+
+def stem(term):
+    if len(term) > 4 and term.endswith('ies'):
+        return term[:-3] + 'y'
+    if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+        return term[:-1]
+    return term
+
+
+class Bm25:
+    '''
+    An in-memory Okapi BM25 index over tokenized documents.
+
+    Query terms of at least `min_partial` characters also match the terms they
+    are a part of (e.g. "order" matches "salesorderdetail"), scaled by
+    `partial_weight`. That matters for identifiers glued together without
+    separators.
+    '''
+
+    def __init__(self, docs, k1=1.5, b=0.75, partial_weight=0.5, min_partial=4):
+        self.k1 = k1
+        self.b = b
+        self.partial_weight = partial_weight
+        self.min_partial = min_partial
+        self.lengths = [len(doc) for doc in docs]
+        self.avg_length = sum(self.lengths) / len(docs) if docs else 0
+        self.postings = {}
+        for i, doc in enumerate(docs):
+            for term, freq in Counter(doc).items():
+                self.postings.setdefault(term, []).append((i, freq))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def to_dict(self):
+        return {
+            'k1': self.k1,
+            'b': self.b,
+            'partial_weight': self.partial_weight,
+            'min_partial': self.min_partial,
+            'lengths': self.lengths,
+            'postings': self.postings,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        '''
+        Restore an index saved with `to_dict`.
+        '''
+        index = cls([], data['k1'], data['b'], data['partial_weight'], data['min_partial'])
+        index.lengths = data['lengths']
+        index.avg_length = sum(index.lengths) / len(index.lengths) if index.lengths else 0
+        index.postings = {term: [tuple(p) for p in postings] for term, postings in data['postings'].items()}
+        return index
+
+    def idf(self, term):
+        df = len(self.postings.get(term, []))
+        return math.log(1 + (len(self) - df + 0.5) / (df + 0.5))
+
+    def expand(self, term):
+        '''
+        Returns a list of (indexed term, weight) a query term matches.
+        '''
+        matches = []
+        if term in self.postings:
+            matches.append((term, 1.0))
+        if self.partial_weight and len(term) >= self.min_partial:
+            matches.extend((t, self.partial_weight)
+                           for t in self.postings if t != term and term in t)
+        return matches
+
+    def search(self, terms, k=None):
+        '''
+        Score the documents against a query.
+
+        Arguments:
+        terms: The tokenized query.
+        k: Max number of results, all matching documents if None.
+
+        Returns a list of (document index, score), best first.
+        '''
+        scores = {}
+        for term in set(terms):
+            for indexed, weight in self.expand(term):
+                idf = self.idf(indexed) * weight
+                for i, freq in self.postings[indexed]:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                    scores[i] = scores.get(i, 0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        return ranked if k is None else ranked[:k]
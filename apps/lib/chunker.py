@@ -0,0 +1,261 @@
+import re
+import zlib
+import numpy as np
+
+# a Mersenne prime above the 32 bit shingle hashes, for the MinHash permutations
+PRIME = (1 << 61) - 1
+NUMBERED = re.compile(r'^(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)\s+\S')
+SENTENCE = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9"(])')
+WORD = re.compile(r'\w+')
+# paragraphs shorter than this are kept even when repeated
+DEDUP_WORDS = 20
+
+
+class MinHash:
+    '''
+    MinHash signatures of texts over their word shingles, and an LSH index of
+    them: two texts agree on a share of the signature close to the Jaccard
+    similarity of their shingle sets.
+
+    Arguments:
+    num_perm: Length of a signature.
+    shingle: Words per shingle.
+    bands: LSH bands; texts agreeing on all the values of a band are compared.
+    '''
+
+    def __init__(self, num_perm=64, shingle=5, bands=16, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+        self.shingle = shingle
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.signatures = []
+        self.buckets = {}
+
+    def signature(self, text):
+        words = WORD.findall(text.lower())
+        n = self.shingle
+        shingles = {' '.join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64)
+        # a and the hashes are below 2^32, so a * h + b doesn't overflow
+        return ((np.outer(hashes, self.a) + self.b) % PRIME).min(axis=0)
+
+    def duplicate(self, text, threshold):
+        '''
+        Returns True if text is a near-duplicate of a text added before,
+        otherwise adds it.
+        '''
+        signature = self.signature(text)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+        candidates = {i for key in keys for i in self.buckets.get(key, [])}
+        if any(np.mean(self.signatures[i] == signature) >= threshold for i in candidates):
+            return True
+        for key in keys:
+            self.buckets.setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+        return False
+
+
+class Chunker:
+    '''
+    Split the pages of a document into chunks along its structure: chunks
+    start at headings and are packed with whole paragraphs, then sentences,
+    then pieces cut at `separator`, up to `chunk_size` characters. A chunk
+    continuing a section starts with the last `chunk_overlap` characters of
+    the previous one.
+
+    A chunker keeps state across the pages it splits, to clean up what
+    report-style documents repeat:
+    - header and footer lines (page numbers masked) found at the edges of
+      `boilerplate_pages` pages are removed from the next pages
+    - paragraphs (of DEDUP_WORDS words or more) and chunks with an estimated
+      Jaccard similarity of `dedup` or more to an earlier one (MinHash over
+      word shingles) are dropped, e.g. disclaimers repeated on pages
+
+    Use a chunker per document. `stats` counts the chunks kept, and the
+    paragraphs and chunks dropped.
+
+    Arguments:
+    chunk_size: Max characters of a chunk.
+    chunk_overlap: Characters repeated from the previous chunk of a section.
+    separator: Where text is cut when a sentence doesn't fit in a chunk.
+    dedup: Similarity above which a paragraph or chunk is dropped, None to keep them all.
+    boilerplate_pages: Pages a header or footer line must be seen on.
+    edge_lines: Lines at the top and bottom of a page checked for headers and footers.
+    '''
+
+    def __init__(self, chunk_size=1500, chunk_overlap=150, separator=' ', dedup=0.8, boilerplate_pages=3,
+                 edge_lines=2):
+        if chunk_overlap >= chunk_size:
+            raise ValueError('chunk_overlap must be smaller than chunk_size')
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separator = separator or ' '
+        self.dedup = dedup
+        self.boilerplate_pages = boilerplate_pages
+        self.edge_lines = edge_lines
+        self.minhash = MinHash() if dedup else None
+        self.paragraphs = MinHash() if dedup else None
+        self.edges = {}
+        self.stats = {'chunks': 0, 'duplicates': 0, 'boilerplate_lines': 0}
+
+    def split(self, text):
+        '''
+        Returns the chunks of a page, without the duplicates of earlier ones.
+        '''
+        chunks = []
+        blocks = self._blocks(self._strip(text.replace('\x0c', '').splitlines()))
+        for chunk in self._pack(self._unique(blocks)):
+            if self.minhash is not None and self.minhash.duplicate(chunk, self.dedup):
+                self.stats['duplicates'] += 1
+                continue
+            chunks.append(chunk)
+        self.stats['chunks'] += len(chunks)
+        return chunks
+
+    def remember(self, chunk):
+        '''
+        Count a chunk split before, e.g. by an interrupted build, for the
+        duplicates of the next ones.
+        '''
+        if self.minhash is not None:
+            self.minhash.duplicate(chunk, 1.0)
+            for paragraph in chunk.split('\n\n'):
+                if len(paragraph.split()) >= DEDUP_WORDS:
+                    self.paragraphs.duplicate(paragraph, 1.0)
+
+    def _unique(self, blocks):
+        for heading, text in blocks:
+            if not heading and self.paragraphs is not None and len(text.split()) >= DEDUP_WORDS \
+                    and self.paragraphs.duplicate(text, self.dedup):
+                self.stats['duplicates'] += 1
+                continue
+            yield heading, text
+
+    def _strip(self, lines):
+        content = [i for i, line in enumerate(lines) if line.strip()]
+        if len(content) <= 2 * self.edge_lines:
+            # short texts are not pages with headers and footers
+            return lines
+        edges = {}
+        for i in content[:self.edge_lines] + content[-self.edge_lines:]:
+            edges.setdefault(re.sub(r'\d+', '#', lines[i].strip().lower()), set()).add(i)
+        removed = set()
+        for key, indices in edges.items():
+            self.edges[key] = self.edges.get(key, 0) + 1
+            if self.edges[key] > self.boilerplate_pages:
+                removed |= indices
+        self.stats['boilerplate_lines'] += len(removed)
+        return [line for i, line in enumerate(lines) if i not in removed]
+
+    def _blocks(self, lines):
+        '''
+        Yields (is heading, text) of the headings and paragraphs of a page.
+        '''
+        paragraph = []
+        for line in lines + ['']:
+            line = line.strip()
+            if line and not is_heading(line):
+                if paragraph and paragraph[-1].endswith('-') and line[:1].islower():
+                    # a word hyphenated across lines
+                    paragraph[-1] = paragraph[-1][:-1] + line
+                else:
+                    paragraph.append(line)
+                continue
+            if paragraph:
+                yield False, ' '.join(paragraph)
+                paragraph = []
+            if line:
+                yield True, line
+
+    def _pack(self, blocks):
+        chunks = []
+        current = ''
+        # whether current has more than headings
+        body = False
+        for heading, text in blocks:
+            if heading:
+                # a heading starts a chunk, unless the section before is short:
+                # then they share one
+                if body and len(current) >= self.chunk_size // 4 \
+                        or len(current) + 2 + len(text) > self.chunk_size:
+                    chunks.append(current)
+                    current, body = '', False
+                current = f'{current}\n\n{text}' if current else text
+                continue
+
+            # the first piece leaves room for the headings it follows
+            size = self.chunk_size - len(current) - 2 if current and not body else self.chunk_size
+            for piece in self._pieces(text, max(size, self.chunk_size // 2)):
+                if current and len(current) + 2 + len(piece) > self.chunk_size:
+                    chunks.append(current)
+                    # overlaps stay within a section
+                    current = self._tail(current, self.chunk_size - 2 - len(piece)) if body else ''
+                current = f'{current}\n\n{piece}' if current else piece
+                body = True
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _pieces(self, text, size):
+        '''
+        Yields the parts of a paragraph of at most `size` characters: the whole
+        of it, else its sentences, else cuts at the separator.
+        '''
+        if len(text) <= size:
+            yield text
+            return
+        part = ''
+        for sentence in SENTENCE.split(text):
+            for piece in self._cut(sentence, size):
+                if part and len(part) + 1 + len(piece) > size:
+                    yield part
+                    part = ''
+                part = f'{part} {piece}' if part else piece
+        if part:
+            yield part
+
+    def _cut(self, text, size):
+        while len(text) > size:
+            end = text.rfind(self.separator, 0, size)
+            if end <= 0:
+                piece, text = text[:size], text[size:]
+            else:
+                piece, text = text[:end], text[end + len(self.separator):]
+            if piece.strip():
+                yield piece.strip()
+        if text.strip():
+            yield text.strip()
+
+    def _tail(self, text, room):
+        '''
+        Returns the overlap a chunk following `text` starts with, cut at the
+        separator, in at most `room` characters.
+        '''
+        size = min(self.chunk_overlap, room)
+        if size <= 0:
+            return ''
+        tail = text[-size:]
+        start = tail.find(self.separator)
+        if len(text) > size and start >= 0:
+            tail = tail[start + len(self.separator):]
+        return tail.strip()
+
+
+def is_heading(line):
+    '''
+    Guess whether a line of a page is a heading: short, not ending like a
+    sentence, and numbered, in capitals or in title case.
+    '''
+    words = line.split()
+    if not 1 <= len(words) <= 12 or len(line) > 100 or line[-1] in '.,;':
+        return False
+    if NUMBERED.match(line) and any(c.isalpha() for c in line):
+        return True
+    letters = [c for c in line if c.isalpha()]
+    if len(letters) >= 3 and all(c.isupper() for c in letters):
+        return True
+    long_words = [w for w in words if len(w) > 3 and w[0].isalpha()]
+    return len(words) >= 2 and bool(long_words) and all(w[0].isupper() for w in long_words)
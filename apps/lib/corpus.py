@@ -0,0 +1,399 @@
+import fcntl
+import glob
+import json
+import math
+import numpy as np
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+from lib import embeddings, metrics
+from lib.utils import atomic_path
+
+CREATE = '''
+CREATE TABLE IF NOT EXISTS chunks (
+  id INTEGER PRIMARY KEY,
+  document TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  length INTEGER NOT NULL,
+  metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_document ON chunks (document);
+CREATE TABLE IF NOT EXISTS changes (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  op TEXT NOT NULL,
+  first_id INTEGER NOT NULL,
+  count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+'''
+# changes applied to the in-memory index after which a snapshot of it is saved
+SNAPSHOT_EVERY = 50
+# the chunks file is rewritten without the texts of removed chunks once they
+# are over this share of it, and over COMPACT_MIN_BYTES
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 1024 * 1024
+
+
+class Corpus(VectorStore):
+    '''
+    A vector index over many documents, stored in one directory:
+    - chunks[.<generation>]: the UTF-8 texts of all chunks, appended as
+      documents are added, and rewritten to the next generation without the
+      texts of removed documents once they take most of it
+    - chunks.sqlite: the document, text offset and metadata of every chunk,
+      and the log of the chunks added and removed
+    - shards/<first id>.npy: the vectors of the chunks of an added document
+    - index.<seq>.faiss: a snapshot of the FAISS index as of log entry <seq>,
+      with chunk ids as FAISS ids
+
+    Adding or removing a document writes its own shard and log entry, not the
+    whole index. Every process keeps the index in memory, loaded from the last
+    snapshot, and applies the log entries written since, by any process,
+    before each use; writes hold a file lock, so processes don't overwrite
+    each other.
+
+    The index starts as a flat (exact) index and becomes an IVF index once it
+    holds more than `ivf_threshold` chunks; `nprobe` sets how many IVF lists a
+    search visits. Searches can be limited to some documents: small
+    selections are searched exactly over their own vectors.
+    '''
+
+    def __init__(self, path='data/pdf/corpus', embeddings=None, ivf_threshold=100000, nprobe=16,
+                 exact_limit=50000):
+        self.path = path
+        self.embeddings = embeddings
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.exact_limit = exact_limit
+        self._lock = threading.RLock()
+        os.makedirs(f'{path}/shards', exist_ok=True)
+        self._con = sqlite3.connect(f'{path}/chunks.sqlite', check_same_thread=False)
+        self._con.executescript(CREATE)
+        self.index = None
+        # the last log entry applied to the index, and to its last snapshot
+        self._seq = self._snapshot_seq = 0
+        snapshot = self._last_snapshot()
+        if snapshot is not None:
+            import faiss
+
+            self.index = faiss.read_index(snapshot)
+            self._seq = self._snapshot_seq = _snapshot_seq(snapshot)
+            self._tune()
+        self._generation = self._current_generation()
+        self._fd = os.open(self.chunks_name(), os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self._sync()
+
+    def index_name(self, seq):
+        return f'{self.path}/index.{seq}.faiss'
+
+    def chunks_name(self, generation=None):
+        generation = self._generation if generation is None else generation
+        return f'{self.path}/chunks.{generation}' if generation else f'{self.path}/chunks'
+
+    def shard_name(self, first_id):
+        return f'{self.path}/shards/{first_id}.npy'
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return self.index.ntotal if self.index is not None else 0
+
+    def documents(self):
+        '''
+        Returns a dictionary of {document: number of chunks}.
+        '''
+        with self._lock:
+            rows = self._con.execute('SELECT document, COUNT(*) FROM chunks GROUP BY document ORDER BY document')
+            return dict(rows.fetchall())
+
+    def add_document(self, name, texts, metadatas=None):
+        '''
+        Add the chunks of a document, replacing the document if it's already in
+        the corpus.
+
+        Arguments:
+        name: The name of the document.
+        texts: The chunk texts.
+        metadatas: The metadata of every chunk.
+
+        Returns the ids of the chunks.
+        '''
+        vectors = np.array(self._embeddings().embed_documents(texts), dtype=np.float32) if texts else None
+        with self._lock, self._write():
+            self._remove(name)
+            if not texts:
+                return []
+
+            first = self._con.execute(
+                "SELECT MAX(COALESCE((SELECT MAX(first_id + count) FROM changes WHERE op = 'add'), 0), "
+                "COALESCE((SELECT MAX(id) + 1 FROM chunks), 0))").fetchone()[0]
+            ids = list(range(first, first + len(texts)))
+            offset = os.fstat(self._fd).st_size
+            rows = []
+            for i, text in enumerate(texts):
+                data = text.encode('utf-8')
+                os.write(self._fd, data)
+                metadata = {**(metadatas[i] if metadatas else {}), 'source': name}
+                rows.append((ids[i], name, offset, len(data), json.dumps(metadata)))
+                offset += len(data)
+            with atomic_path(self.shard_name(first)) as tmp:
+                with open(tmp, 'wb') as f:
+                    np.save(f, vectors)
+
+            with self._con:
+                self._con.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?, ?)', rows)
+                seq = self._con.execute('INSERT INTO changes (op, first_id, count) VALUES (?, ?, ?)',
+                                        ('add', first, len(ids))).lastrowid
+            self._add(vectors, np.array(ids, dtype=np.int64))
+            self._seq = seq
+            self._snapshot()
+            return ids
+
+    def remove_document(self, name):
+        '''
+        Remove a document from the corpus.
+        '''
+        with self._lock, self._write():
+            if self._remove(name):
+                self._snapshot()
+
+    def rename_document(self, name, new_name):
+        '''
+        Rename a document of the corpus, replacing the document of the new
+        name if there is one.
+        '''
+        with self._lock, self._write():
+            if name == new_name or name not in self.documents():
+                return
+            self._remove(new_name)
+            with self._con:
+                self._con.execute(
+                    "UPDATE chunks SET document = ?, metadata = json_set(metadata, '$.source', ?) WHERE document = ?",
+                    (new_name, new_name, name))
+
+    def similarity_search(self, query, k=4, documents=None, **kwargs):
+        '''
+        Returns the k chunks most similar to a query, optionally only from
+        the given documents.
+        '''
+        embedding = self._embeddings().embed_query(query)
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, documents)]
+
+    def similarity_search_by_vector(self, embedding, k=4, documents=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, documents)]
+
+    @metrics.timed('corpus.search')
+    def similarity_search_with_score_by_vector(self, embedding, k=4, documents=None):
+        query = np.array([embedding], dtype=np.float32)
+        with self._lock:
+            self._sync()
+            if not len(self):
+                return []
+            if documents is None:
+                scores, ids = self.index.search(query, k)
+                hits = [(int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i != -1]
+            else:
+                hits = self._filtered_search(query, k, documents)
+            return [(self._document(i), s) for i, s in hits]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError('Use Corpus.add_document to add the chunks of a document')
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError('Use Corpus.add_document to add the chunks of a document')
+
+    def _filtered_search(self, query, k, documents):
+        marks = ', '.join('?' * len(documents))
+        ids = [r[0] for r in self._con.execute(
+            f'SELECT id FROM chunks WHERE document IN ({marks})', list(documents))]
+        if not ids:
+            return []
+
+        if len(ids) <= self.exact_limit:
+            vectors = np.stack([self.index.reconstruct(i) for i in ids])
+            distances = ((vectors - query) ** 2).sum(axis=1)
+            best = np.argsort(distances)[:k]
+            return [(ids[j], float(distances[j])) for j in best]
+
+        allowed = set(ids)
+        fetch = k * 4
+        while True:
+            scores, found = self.index.search(query, min(fetch, len(self)))
+            hits = [(int(i), float(s)) for i, s in zip(found[0], scores[0]) if i in allowed]
+            if len(hits) >= k or fetch >= len(self):
+                return hits[:k]
+            fetch *= 4
+
+    def _document(self, i):
+        # the offset and the generation of the file it's in are read at once,
+        # as another process may compact the file
+        offset, length, metadata, generation = self._con.execute(
+            "SELECT offset, length, metadata, (SELECT COALESCE(MAX(value), 0) FROM meta WHERE key = 'chunks') "
+            'FROM chunks WHERE id = ?', (i,)).fetchone()
+        if generation != self._generation:
+            self._reopen(generation)
+        text = os.pread(self._fd, length, offset).decode('utf-8')
+        return Document(page_content=text, metadata=json.loads(metadata))
+
+    @contextmanager
+    def _write(self):
+        '''
+        Hold the write lock of the corpus, with the index up to date.
+        '''
+        with open(f'{self.path}/corpus.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _sync(self):
+        '''
+        Apply the log entries written since the last one applied.
+        '''
+        generation = self._current_generation()
+        if generation != self._generation:
+            self._reopen(generation)
+        changes = self._con.execute(
+            'SELECT seq, op, first_id, count FROM changes WHERE seq > ? ORDER BY seq', (self._seq,)).fetchall()
+        for seq, op, first, count in changes:
+            ids = np.arange(first, first + count, dtype=np.int64)
+            if op == 'add':
+                try:
+                    self._add(np.load(self.shard_name(first)), ids)
+                except FileNotFoundError:
+                    # removed by a later entry
+                    pass
+            elif self.index is not None:
+                self.index.remove_ids(ids)
+            self._seq = seq
+
+    def _remove(self, name):
+        # the ids of a document are contiguous: they're allocated when it's added
+        first, last = self._con.execute(
+            'SELECT MIN(id), MAX(id) FROM chunks WHERE document = ?', (name,)).fetchone()
+        if first is None:
+            return False
+        with self._con:
+            self._con.execute('DELETE FROM chunks WHERE document = ?', (name,))
+            seq = self._con.execute('INSERT INTO changes (op, first_id, count) VALUES (?, ?, ?)',
+                                    ('remove', first, last - first + 1)).lastrowid
+        if self.index is not None:
+            self.index.remove_ids(np.arange(first, last + 1, dtype=np.int64))
+        self._seq = seq
+        if os.path.exists(self.shard_name(first)):
+            os.remove(self.shard_name(first))
+        self._compact()
+        return True
+
+    def _compact(self):
+        '''
+        Rewrite the chunks file without the texts of removed chunks, if they
+        take most of it. The write lock must be held.
+        '''
+        size = os.fstat(self._fd).st_size
+        live = self._con.execute('SELECT COALESCE(SUM(length), 0) FROM chunks').fetchone()[0]
+        if size < COMPACT_MIN_BYTES or size - live <= size * COMPACT_RATIO:
+            return
+
+        generation = self._generation + 1
+        offsets = []
+        with open(self.chunks_name(generation), 'wb') as f:
+            for i, offset, length in self._con.execute('SELECT id, offset, length FROM chunks ORDER BY offset'):
+                offsets.append((f.tell(), i))
+                f.write(os.pread(self._fd, length, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        with self._con:
+            self._con.executemany('UPDATE chunks SET offset = ? WHERE id = ?', offsets)
+            self._con.execute("INSERT OR REPLACE INTO meta VALUES ('chunks', ?)", (generation,))
+        # processes reading the old file keep it open until they see the new generation
+        old = self.chunks_name()
+        self._reopen(generation)
+        os.remove(old)
+        metrics.count('corpus.compactions')
+
+    def _current_generation(self):
+        row = self._con.execute("SELECT value FROM meta WHERE key = 'chunks'").fetchone()
+        return row[0] if row else 0
+
+    def _reopen(self, generation):
+        fd = os.open(self.chunks_name(generation), os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        os.close(self._fd)
+        self._fd = fd
+        self._generation = generation
+
+    def _add(self, vectors, ids):
+        import faiss
+
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        self.index.add_with_ids(vectors, ids)
+        if not _is_ivf(self.index) and self.index.ntotal > self.ivf_threshold:
+            self._to_ivf()
+
+    def _to_ivf(self):
+        import faiss
+
+        n = self.index.ntotal
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        vectors = self.index.index.reconstruct_n(0, n)
+        quantizer = faiss.IndexFlatL2(self.index.d)
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        ivf = faiss.IndexIVFFlat(quantizer, self.index.d, nlist)
+        ivf.train(vectors)
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        ivf.add_with_ids(vectors, ids)
+        self.index = ivf
+        self._tune()
+
+    def _tune(self):
+        if _is_ivf(self.index):
+            self.index.nprobe = self.nprobe
+
+    def _snapshot(self):
+        '''
+        Save the index once SNAPSHOT_EVERY changes were applied since the last
+        snapshot, so processes starting later replay fewer of them. The write
+        lock must be held.
+        '''
+        import faiss
+
+        if self.index is None or self._seq - self._snapshot_seq < SNAPSHOT_EVERY:
+            return
+        with atomic_path(self.index_name(self._seq)) as tmp:
+            faiss.write_index(self.index, tmp)
+        for snapshot in glob.glob(f'{self.path}/index*.faiss'):
+            if snapshot != self.index_name(self._seq):
+                os.remove(snapshot)
+        self._snapshot_seq = self._seq
+
+    def _last_snapshot(self):
+        # index.faiss is the index of earlier versions, saved on every change
+        snapshots = glob.glob(f'{self.path}/index*.faiss')
+        return max(snapshots, key=_snapshot_seq) if snapshots else None
+
+    def _embeddings(self):
+        if self.embeddings is None:
+            self.embeddings = embeddings.default()
+        return self.embeddings
+
+
+def _is_ivf(index):
+    import faiss
+
+    return isinstance(index, faiss.IndexIVF)
+
+
+def _snapshot_seq(path):
+    m = re.search(r'index\.(\d+)\.faiss$', path)
+    return int(m.group(1)) if m else 0
@@ -0,0 +1,55 @@
+from lib import schema_compact, utils
+
+PROMT = '''
+You're playing a role of dbot. dbot is a very skillful, and creative database administrator. It will only give accurate, highly optimized, well-written SQLs based on users' descriptions of the problem. It could also use its own judgment to generate meaningful, valid mock data if user requires so. Here's the context (the schema) of the database users will ask about:
+
+```
+{context}
+```
+
+dbot will strictly follow these rules:
+- If users ask it a question that could be answered with current context of the database, it return a valid, accurate SQL that could answer the question. The SQL will be wrapped in a JSON object with key "sql". The JSON shall also contain a key "type" that indicates the type of the SQL (SELECT, INSERT, UPDATE, DELETE, etc).
+- If users ask questions can't be answered with current context of the database, it will return a message that says it can't answer the question. The message will be wrapped in a JSON object with key "error".
+- The response MUST be a JSON object with key "sql" or "error". Otherwise, it will be considered as an error.
+
+Here's user's question: ```{question}```. Answer it as dbot.
+'''
+
+
+def context(schemas, schema_index, question, top_k=8, max_tokens=3000, model=None):
+    '''
+    Returns the schema context of a question: the parts of the schema relevant
+    to it if a schema index is given, otherwise the whole schema.
+
+    Arguments:
+    schemas: The schema SQL.
+    schema_index: A SchemaIndex of the schema snapshot, or None.
+    question: The question.
+    top_k: Max number of objects picked by the index.
+    max_tokens: Token budget of the context.
+    model: A lib.schema_compact model. If given, the context is in its compact
+      encoding instead of SQL.
+    '''
+    if model is not None:
+        return schema_compact.context(model, schema_index, question, top_k=top_k, max_tokens=max_tokens)
+    if schema_index is None:
+        return schemas
+    return schema_index.context(question, top_k=top_k, max_tokens=max_tokens)
+
+
+def generate(client, context, question):
+    '''
+    Ask dbot a question.
+
+    Arguments:
+    client: A lib.llm.Client.
+    context: The schema context.
+    question: The question.
+
+    Returns the reply as a dict with "sql" and "type", or "error". Raises
+    ValueError if the reply isn't a JSON object.
+    '''
+    reply = utils.parse_json_reply(client.complete(PROMT.format(context=context, question=question), temperature=0))
+    if 'sql' not in reply and 'error' not in reply:
+        raise ValueError(f'Reply has neither "sql" nor "error": {reply}')
+    return reply
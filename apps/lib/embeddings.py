@@ -0,0 +1,165 @@
+import hashlib
+import numpy as np
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain.embeddings.base import Embeddings
+
+RETRYABLE = ['RateLimitError', 'ServiceUnavailableError', 'APIError', 'Timeout', 'APIConnectionError']
+
+
+class HashEmbeddings(Embeddings):
+    '''
+    Deterministic local embeddings: a normalized bag of hashed words and word
+    bigrams. Texts sharing words are close, which is enough for tests and
+    benchmarks without network.
+    '''
+
+    def __init__(self, size=256):
+        self.size = size
+        self.model = f'hash-{size}'
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        words = re.findall(r'\w+', text.lower())
+        for term in words + [a + ' ' + b for a, b in zip(words, words[1:])]:
+            h = int.from_bytes(hashlib.md5(term.encode('utf-8')).digest()[:8], 'little')
+            vector[h % self.size] += 1.0 if h & (1 << 63) else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+class EmbeddingCache:
+    '''
+    A disk cache of vectors, keyed by model and SHA-256 of the text.
+    '''
+
+    def __init__(self, path='data/pdf/embeddings.sqlite'):
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute(
+            'CREATE TABLE IF NOT EXISTS vectors (model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, hash))')
+
+    def get_many(self, model, hashes):
+        '''
+        Returns a dictionary of {hash: vector} for the hashes found.
+        '''
+        found = {}
+        hashes = list(hashes)
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self._con.execute(
+                    f'SELECT hash, vector FROM vectors WHERE model = ? AND hash IN ({", ".join("?" * len(batch))})',
+                    [model, *batch])
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model, vectors):
+        '''
+        Store a dictionary of {hash: vector}.
+        '''
+        with self._lock, self._con:
+            self._con.executemany(
+                'INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)',
+                [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in vectors.items()])
+
+
+class EmbeddingPipeline(Embeddings):
+    '''
+    Embed documents through another embedder in batches, several batches at
+    once, retrying with exponential backoff when rate limited. Vectors are
+    cached by content hash, so only new texts are sent to the embedder.
+
+    The stats of the last embed_documents call are kept in `stats`: chunks,
+    cache hits, seconds, chunks per second and hit rate.
+    '''
+
+    def __init__(self, embedder, cache=None, model=None, batch_size=64, concurrency=4,
+                 max_retries=6, backoff=1.0):
+        self.embedder = embedder
+        self.cache = cache
+        self.model = model or getattr(embedder, 'model', type(embedder).__name__)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = {}
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        hashes = [hashlib.sha256(t.encode('utf-8')).hexdigest() for t in texts]
+        vectors = self.cache.get_many(self.model, set(hashes)) if self.cache else {}
+        hits = sum(1 for h in hashes if h in vectors)
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in vectors:
+                missing.setdefault(h, text)
+        keys = list(missing)
+        batches = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = pool.map(lambda batch: self._embed([missing[h] for h in batch]), batches)
+            for batch, result in zip(batches, results):
+                embedded = dict(zip(batch, result))
+                if self.cache:
+                    self.cache.put_many(self.model, embedded)
+                vectors.update(embedded)
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            'chunks': len(texts),
+            'cache_hits': hits,
+            'embedded': len(keys),
+            'seconds': round(elapsed, 3),
+            'chunks_per_second': round(len(texts) / elapsed, 1) if elapsed > 0 else 0.0,
+            'hit_rate': round(hits / len(texts), 3) if texts else 0.0,
+        }
+        return [vectors[h] for h in hashes]
+
+    def embed_query(self, text):
+        return self.embedder.embed_query(text)
+
+    def _embed(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.embedder.embed_documents(texts)
+            except Exception as e:
+                if attempt == self.max_retries or type(e).__name__ not in RETRYABLE:
+                    raise
+                delay = _retry_after(e) or self.backoff * 2 ** attempt
+                time.sleep(delay * (1 + random.random() / 2))
+
+
+def default():
+    '''
+    Returns the embedding pipeline picked by the EMBEDDING_BACKEND environment
+    variable: "openai" (default) or "hash".
+    '''
+    backend = os.environ.get('EMBEDDING_BACKEND', 'openai')
+    if backend == 'openai':
+        from langchain.embeddings import OpenAIEmbeddings
+        embedder = OpenAIEmbeddings()
+        model = embedder.document_model_name
+    elif backend == 'hash':
+        embedder = HashEmbeddings()
+        model = embedder.model
+    else:
+        raise ValueError(f'Unknown embedding backend: {backend}')
+    return EmbeddingPipeline(embedder, EmbeddingCache(), model=model)
+
+
+def _retry_after(e):
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
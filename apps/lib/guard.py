@@ -0,0 +1,201 @@
+import json
+import re
+import sqlparse
+import threading
+import time
+from collections import deque
+from sqlparse import sql as S, tokens as T
+from lib import metrics
+
+EXPLAINABLE = ['SELECT', 'INSERT', 'UPDATE', 'DELETE']
+# trailing locking clauses of a SELECT, e.g. FOR UPDATE OF orders SKIP LOCKED
+LOCKING = re.compile(r'(\s+FOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b(\s+OF\s+[\w\s,."]+?)?'
+                     r'(\s+(NOWAIT|SKIP\s+LOCKED))?)+$', re.I)
+
+
+class Rejected(Exception):
+    '''
+    A statement refused by the pre-flight check. `plan` holds what was known
+    about it when it was refused.
+    '''
+
+    def __init__(self, reason, plan=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.plan = plan
+
+
+class Preflight:
+    '''
+    Check generated SQL before it runs. The statement is parsed with sqlparse,
+    and explained with EXPLAIN (FORMAT JSON) in a read-only transaction under
+    `statement_timeout`. A SELECT estimated to return more than `max_rows`
+    rows gets a LIMIT of `limit`; statements still estimated to cost more than
+    `max_cost` are rejected, as are writes unless `allow_writes` is set.
+
+    The plan also lists the tables the statement reads (views are expanded to
+    their tables), e.g. to invalidate cached results. The plans of the last
+    `history` checks are kept for `stats`.
+
+    Arguments:
+    max_cost: Max estimated total cost of the plan, in Postgres cost units.
+    max_rows: Max estimated rows of a SELECT before a LIMIT is added.
+    limit: The LIMIT added to large SELECTs.
+    statement_timeout: Timeout of the EXPLAIN and of the statement, in ms.
+    allow_writes: Allow statements other than SELECT.
+    '''
+
+    def __init__(self, max_cost=1000000, max_rows=100000, limit=1000, statement_timeout=30000,
+                 allow_writes=False, history=1000):
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.limit = limit
+        self.statement_timeout = statement_timeout
+        self.allow_writes = allow_writes
+        self.plans = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    @metrics.timed('sql.preflight')
+    def check(self, con, sql):
+        '''
+        Check a statement.
+
+        Arguments:
+        con: A DB-API connection (e.g. engine.raw_connection()). Its transaction
+          is rolled back.
+        sql: The statement.
+
+        Returns the plan: a dict of sql (the statement to run, possibly with a
+        LIMIT), type, cost, rows, tables ("schema.table" names), limited and
+        ms. Raises Rejected if the statement must not run.
+        '''
+        start = time.perf_counter()
+        plan = {'sql': sql, 'type': None, 'cost': None, 'rows': None, 'tables': [], 'limited': False,
+                'rejected': None, 'ms': None}
+        try:
+            statement = parse(sql)
+            plan['type'] = statement_type(statement)
+            plan['sql'] = sql = str(statement).strip().rstrip(';').strip()
+            if plan['type'] != 'SELECT' and not self.allow_writes:
+                raise Rejected(f'Only SELECT statements are allowed, got {plan["type"]}')
+
+            if plan['type'] in EXPLAINABLE:
+                plan['cost'], plan['rows'], plan['tables'] = self.explain(con, sql)
+                if plan['type'] == 'SELECT' and plan['rows'] > self.max_rows:
+                    plan['sql'] = sql = add_limit(statement, self.limit)
+                    plan['limited'] = True
+                    plan['cost'], plan['rows'], plan['tables'] = self.explain(con, sql)
+                if plan['cost'] > self.max_cost:
+                    raise Rejected(
+                        f'Estimated cost {plan["cost"]:.0f} exceeds the limit of {self.max_cost:.0f}')
+            return plan
+        except Rejected as e:
+            plan['rejected'] = e.reason
+            e.plan = plan
+            raise
+        finally:
+            plan['ms'] = round((time.perf_counter() - start) * 1000, 2)
+            with self._lock:
+                self.plans.append(plan)
+
+    def explain(self, con, sql):
+        '''
+        Returns the estimated (total cost, rows) of a statement, and the tables
+        it reads.
+        '''
+        cursor = con.cursor()
+        try:
+            begin(cursor, read_only=True, statement_timeout=self.statement_timeout)
+            # VERBOSE adds the schema of the scanned tables
+            cursor.execute(f'EXPLAIN (FORMAT JSON, VERBOSE) {sql}')
+            data = cursor.fetchone()[0]
+        except Exception as e:
+            raise Rejected(f'Invalid SQL: {e}')
+        finally:
+            cursor.close()
+            con.rollback()
+
+        if isinstance(data, str):
+            data = json.loads(data)
+        root = data[0]['Plan']
+        return root['Total Cost'], root['Plan Rows'], sorted(relations(root))
+
+    def stats(self):
+        '''
+        Returns a summary of the recent checks.
+        '''
+        with self._lock:
+            plans = list(self.plans)
+        costs = sorted(p['cost'] for p in plans if p['cost'] is not None)
+        return {
+            'checked': len(plans),
+            'rejected': sum(1 for p in plans if p['rejected']),
+            'limited': sum(1 for p in plans if p['limited']),
+            'cost_median': costs[len(costs) // 2] if costs else None,
+            'cost_max': costs[-1] if costs else None,
+            'last': plans[-1] if plans else None,
+        }
+
+
+def parse(sql):
+    '''
+    Returns the single statement of a SQL text, or raises Rejected.
+    '''
+    statements = [s for s in sqlparse.parse(sql) if str(s).strip().strip(';').strip()]
+    if len(statements) != 1:
+        raise Rejected(f'Expected one statement, got {len(statements)}')
+    return statements[0]
+
+
+def statement_type(statement):
+    '''
+    Returns the type of a parsed statement, as sqlparse's get_type(), except
+    that a statement starting with a parenthesized SELECT, e.g.
+    `(SELECT ...) UNION (SELECT ...)`, is a SELECT.
+    '''
+    kind = statement.get_type()
+    token = statement.token_first(skip_cm=True)
+    while kind == 'UNKNOWN' and isinstance(token, S.Parenthesis):
+        token = token.token_next(0, skip_cm=True)[1]
+        if token is not None and token.ttype is T.DML and token.normalized == 'SELECT':
+            return 'SELECT'
+    return kind
+
+
+def relations(node):
+    '''
+    Returns the set of "schema.table" names scanned by a plan node and its children.
+    '''
+    names = set()
+    if 'Relation Name' in node:
+        names.add(f"{node.get('Schema', 'public')}.{node['Relation Name']}")
+    for child in node.get('Plans', []):
+        names |= relations(child)
+    return names
+
+
+def add_limit(statement, limit):
+    '''
+    Returns the SQL of a SELECT returning at most `limit` rows: a LIMIT is
+    appended (before the locking clauses, e.g. FOR UPDATE), or the statement
+    is wrapped if it has a LIMIT already.
+    '''
+    sql = str(statement).strip().rstrip(';').strip()
+    has_limit = any(t.ttype is T.Keyword and t.normalized in ('LIMIT', 'FETCH') for t in statement.tokens)
+    if has_limit:
+        return f'SELECT * FROM (\n{sql}\n) AS limited LIMIT {int(limit)}'
+    locking = LOCKING.search(sql)
+    if locking:
+        return f'{sql[:locking.start()]}\nLIMIT {int(limit)}{locking.group()}'
+    return f'{sql}\nLIMIT {int(limit)}'
+
+
+def begin(cursor, read_only=False, statement_timeout=None):
+    '''
+    Start the transaction of a DB-API cursor with the given settings. They
+    last until the transaction ends.
+    '''
+    if read_only:
+        cursor.execute('SET TRANSACTION READ ONLY')
+    if statement_timeout:
+        cursor.execute(f'SET LOCAL statement_timeout = {int(statement_timeout)}')
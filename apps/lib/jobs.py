@@ -0,0 +1,165 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from lib.utils import atomic_write
+
+JOBS_PATH = 'data/jobs'
+ACTIVE = ['queued', 'running']
+
+_default = None
+_lock = threading.Lock()
+
+
+class Job:
+    '''
+    The handle a job function gets to report progress.
+    '''
+
+    def __init__(self, jobs, target, id):
+        self.jobs = jobs
+        self.target = target
+        self.id = id
+
+    def progress(self, done, total=None):
+        self.jobs._update(self.target, done=done, total=total)
+
+
+class Jobs:
+    '''
+    A local job queue. A thread pool runs the jobs, and the status of the last
+    job of every target is kept in <path>/<target>.json, so any process can
+    poll it. A job holds a file lock on its target while it runs, so jobs of
+    the same target never run at once, even from different processes.
+
+    Submitting a target that already has a queued or running job returns that
+    job instead of starting another one, and a job is skipped if another job
+    of its target finished after it was queued.
+
+    Arguments:
+    path: The directory of the status and lock files.
+    workers: Number of jobs run at once.
+    '''
+
+    def __init__(self, path=JOBS_PATH, workers=2):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+
+    def submit(self, target, fn, *args, **kwargs):
+        '''
+        Queue a job, unless one for the same target is queued or running.
+
+        Arguments:
+        target: The name of what the job builds, e.g. "vdb:manual".
+        fn: The job function, called as fn(job, *args, **kwargs) where job is
+          a Job handle to report progress. Its result must be JSON
+          serializable; it's kept in the status.
+
+        Returns the status of the new or existing job.
+        '''
+        with self._lock:
+            status = self.status(target)
+            if status and status['state'] in ACTIVE and _alive(status['pid']):
+                return status
+
+            status = {
+                'id': uuid.uuid4().hex,
+                'target': target,
+                'state': 'queued',
+                'pid': os.getpid(),
+                'queued': time.time(),
+                'started': None,
+                'finished': None,
+                'done': 0,
+                'total': None,
+                'error': None,
+                'result': None,
+            }
+            self._save(status)
+        self._pool.submit(self._run, status, fn, args, kwargs)
+        return status
+
+    def status(self, target):
+        '''
+        Returns the status of the last job of a target, or None. The state is
+        one of "queued", "running", "done" or "failed".
+        '''
+        try:
+            with open(self._status_name(target)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def active(self, target):
+        '''
+        Returns True if a job of the target is queued or running.
+        '''
+        status = self.status(target)
+        return bool(status) and status['state'] in ACTIVE and _alive(status['pid'])
+
+    def _run(self, status, fn, args, kwargs):
+        target = status['target']
+        with open(self._lock_name(target), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                last = self.status(target)
+                if last and last['id'] != status['id'] and last['state'] == 'done' \
+                        and last['finished'] >= status['queued']:
+                    # built by another process meanwhile, keep its status
+                    return
+
+                self._update(target, id=status['id'], state='running', started=time.time())
+                result = fn(Job(self, target, status['id']), *args, **kwargs)
+                self._update(target, state='done', finished=time.time(), result=result)
+            except Exception:
+                self._update(target, state='failed', finished=time.time(), error=traceback.format_exc())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _update(self, target, **changes):
+        with self._lock:
+            status = self.status(target) or {}
+            status.update(changes)
+            self._save(status)
+
+    def _save(self, status):
+        with atomic_write(self._status_name(status['target'])) as f:
+            json.dump(status, f)
+
+    def _status_name(self, target):
+        return f'{self.path}/{_key(target)}.json'
+
+    def _lock_name(self, target):
+        return f'{self.path}/{_key(target)}.lock'
+
+
+def default():
+    '''
+    Returns the process-wide job queue.
+    '''
+    global _default
+    with _lock:
+        if _default is None:
+            _default = Jobs()
+        return _default
+
+
+def _key(target):
+    return re.sub(r'[^\w.-]', '_', target)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
@@ -0,0 +1,30 @@
+from typing import Any, Callable, List, Optional
+
+from langchain.llms.base import LLM
+
+
+class ClientLlm(LLM):
+    '''
+    Expose a lib.llm.Client as a LangChain LLM, sampling at `temperature`.
+    If `on_text` is set, it is called with the text generated so far each
+    time a token arrives.
+    '''
+
+    client: Any
+    temperature: float = 0
+    on_text: Optional[Callable[[str], Any]] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'lib.llm'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        text = ''
+        for token in self.client.stream(prompt, self.temperature):
+            text += token
+            if self.on_text is not None:
+                self.on_text(text)
+
+        for s in stop or []:
+            text = text.split(s)[0]
+        return text
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from lib import metrics
+from lib.utils import count_tokens
+
+MODEL = 'gpt-3.5-turbo'
+# SQL generation and document QA want the most likely answer, which is also
+# the one worth caching
+TEMPERATURE = 0
+
+
+class OpenAIBackend:
+    '''
+    Stream chat completions from OpenAI, at `temperature` unless a call
+    gives another one.
+    '''
+
+    def __init__(self, model=MODEL, temperature=TEMPERATURE):
+        import openai
+
+        if not os.environ.get('OPENAI_KEY'):
+            raise Exception('No OPENAI_KEY found in environment')
+        openai.api_key = os.environ['OPENAI_KEY']
+        self.openai = openai
+        self.model = model
+        self.temperature = temperature
+
+    def stream(self, prompt, temperature=None):
+        response = self.openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {"role": "user", "content": prompt},
+            ],
+            temperature=self.temperature if temperature is None else temperature,
+            stream=True,
+        )
+        for chunk in response:
+            token = chunk['choices'][0]['delta'].get('content')
+            if token:
+                yield token
+
+
+class FakeBackend:
+    '''
+    A deterministic local stand-in for a chat model. The same prompt always
+    gets the same answer, streamed word by word after the given latencies.
+
+    Arguments:
+    respond: A function returning the answer of a prompt, `fake_answer` by default.
+    first_token_latency: Seconds before the first token.
+    token_latency: Seconds between tokens.
+    '''
+
+    def __init__(self, respond=None, first_token_latency=0.0, token_latency=0.0):
+        self.respond = respond or fake_answer
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+
+    def stream(self, prompt, temperature=None):
+        time.sleep(self.first_token_latency)
+        for i, token in enumerate(re.findall(r'\s*\S+', self.respond(prompt))):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            yield token
+
+
+def fake_answer(prompt):
+    '''
+    Answer a prompt without a model: dbot prompts get a query on the first
+    table of the context, anything else a canned sentence.
+    '''
+    digest = hashlib.md5(prompt.encode('utf-8')).hexdigest()[:8]
+    if 'dbot' in prompt:
+        table = _first_table(prompt)
+        if table is None:
+            return json.dumps({'error': f'No table found to answer the question ({digest})'})
+        return json.dumps({'sql': f'SELECT * FROM {table} LIMIT 10;', 'type': 'SELECT'})
+    return f'This is a fake answer ({digest}) to a prompt of {len(prompt)} characters.'
+
+
+def _first_table(prompt):
+    # a schema context in SQL, or in the encoding of lib.schema_compact
+    m = re.search(r'CREATE TABLE (\S+) \(', prompt)
+    if m is not None:
+        return m.group(1)
+    m = re.search(r'^## (\S+)\n(?:(?:enum|type|view|mview|fn) .*\n)*([^\s(]+)\(', prompt, re.M)
+    return f'{m.group(1)}.{m.group(2)}' if m else None
+
+
+class Client:
+    '''
+    A chat completion client over a backend. At most `max_concurrency` calls
+    run at once, the others wait in a queue. The timings of the last
+    `history` calls are kept in `timings`, as dicts with the seconds spent
+    queued, to the first token and in total, plus the number of tokens and
+    tokens per second.
+    '''
+
+    def __init__(self, backend, max_concurrency=4, history=1000):
+        self.backend = backend
+        self.timings = deque(maxlen=history)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def stream(self, prompt, temperature=None):
+        '''
+        Stream the answer of a prompt.
+
+        Arguments:
+        temperature: The sampling temperature, the backend's default if None.
+
+        Returns an iterator of tokens.
+        '''
+        return self._stream(prompt, temperature, time.perf_counter())
+
+    def complete(self, prompt, temperature=None):
+        '''
+        Returns the whole answer of a prompt.
+        '''
+        return ''.join(self.stream(prompt, temperature))
+
+    def _stream(self, prompt, temperature, created):
+        with metrics.span('llm.completion'), self._slots:
+            start = time.perf_counter()
+            metrics.registry.observe('llm.queued', (start - created) * 1000)
+            first = None
+            tokens = 0
+            for token in self.backend.stream(prompt, temperature):
+                if first is None:
+                    first = time.perf_counter()
+                    metrics.registry.observe('llm.first_token', (first - start) * 1000)
+                tokens += 1
+                yield token
+
+            end = time.perf_counter()
+            generating = end - (first or end)
+            metrics.count('llm.prompt_tokens', count_tokens(prompt))
+            metrics.count('llm.completion_tokens', tokens)
+            self.timings.append({
+                'queued': start - created,
+                'first_token': (first or end) - start,
+                'total': end - created,
+                'tokens': tokens,
+                'tokens_per_second': tokens / generating if generating > 0 else 0.0,
+            })
+
+
+_default = None
+_lock = threading.Lock()
+
+
+def default():
+    '''
+    Returns the process-wide client. The backend is picked by the LLM_BACKEND
+    environment variable: "openai" (default) or "fake".
+    '''
+    global _default
+    with _lock:
+        if _default is None:
+            _default = Client(create_backend(os.environ.get('LLM_BACKEND', 'openai')))
+        return _default
+
+
+def create_backend(name, **kwargs):
+    if name == 'openai':
+        return OpenAIBackend(**kwargs)
+    if name == 'fake':
+        return FakeBackend(**kwargs)
+    raise ValueError(f'Unknown LLM backend: {name}')
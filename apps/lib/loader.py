@@ -1,6 +1,82 @@
-from langchain.document_loaders import UnstructuredPDFLoader
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from lib import metrics
 
+_open = {}
 
+
+@metrics.timed('loader.pdf')
 def pdf(filename):
-    loader = UnstructuredPDFLoader(filename)
-    return loader.load()
+    '''
+    Returns the pages of a PDF as a list of documents. Prefer `pages` for large
+    files: it doesn't hold the whole document in memory.
+    '''
+    return list(pages(filename))
+
+
+def page_count(filename):
+    from pdfminer.pdfpage import PDFPage
+
+    with open(filename, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+
+def pages(filename, start=0, workers=None, in_flight=None):
+    '''
+    Extract the text of a PDF page by page in a process pool, yielding a
+    document per page in page order.
+
+    Arguments:
+    filename: The PDF file.
+    start: The first page to extract (from 0), to resume an earlier run.
+    workers: Number of processes, defaults to the number of CPUs.
+    in_flight: Max pages extracted or waiting to be consumed, which bounds
+      memory. Defaults to twice the number of workers.
+    '''
+    from langchain.docstore.document import Document
+
+    total = page_count(filename)
+    workers = workers or os.cpu_count() or 1
+    in_flight = in_flight or workers * 2
+    with ProcessPoolExecutor(workers) as pool:
+        futures = deque()
+        n = start
+        while n < total or futures:
+            while n < total and len(futures) < in_flight:
+                futures.append((n, pool.submit(_extract, filename, n)))
+                n += 1
+            page, future = futures.popleft()
+            yield Document(page_content=future.result(), metadata={'source': filename, 'page': page})
+
+
+def _extract(filename, n):
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter
+
+    # each worker parses the document once and keeps it for the next pages
+    if filename not in _open:
+        for f, _, _ in _open.values():
+            f.close()
+        _open.clear()
+        _open[filename] = _load(filename)
+    _, resources, doc_pages = _open[filename]
+
+    out = StringIO()
+    device = TextConverter(resources, out, laparams=LAParams())
+    PDFPageInterpreter(resources, device).process_page(doc_pages[n])
+    device.close()
+    return out.getvalue()
+
+
+def _load(filename):
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfinterp import PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+
+    f = open(filename, 'rb')
+    doc = PDFDocument(PDFParser(f))
+    return f, PDFResourceManager(caching=True), list(PDFPage.create_pages(doc))
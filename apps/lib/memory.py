@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.memory.prompt import SUMMARY_PROMPT
+from lib.answer_cache import normalize
+from lib.utils import count_tokens
+
+# summaries of all sessions are updated by a few shared threads
+_executor = ThreadPoolExecutor(2, thread_name_prefix='memory')
+
+
+class ConversationMemory:
+    '''
+    The history of a conversation within a token budget: the last turns
+    verbatim, plus a summary of the older ones. Turns leaving the window are
+    folded into the summary by a background thread, so answering never waits
+    for it; until then they stay in the history if the budget allows.
+
+    Standalone questions condensed from the history are cached, so asking the
+    same question again at the same point of the conversation costs no LLM call.
+
+    Arguments:
+    client: A lib.llm.Client, used to summarize and to condense questions.
+    max_tokens: Token budget of the history.
+    window: Max number of turns kept verbatim.
+    cache_size: Max number of standalone questions cached.
+    '''
+
+    def __init__(self, client, max_tokens=1000, window=4, cache_size=256):
+        self.client = client
+        self.max_tokens = max_tokens
+        self.window = window
+        self.cache_size = cache_size
+        self.turns = []
+        self.summary = ''
+        self.stats = {'condensed': 0, 'cached': 0, 'summarized': 0}
+        self._pending = []
+        self._future = None
+        self._standalone = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, question, answer):
+        '''
+        Add a turn, moving the oldest turns out of the window when it's full or
+        over budget.
+        '''
+        with self._lock:
+            self.turns.append((question, answer))
+            while len(self.turns) > 1 and (len(self.turns) > self.window or
+                                           count_tokens(self._render(self.turns)) > self.max_tokens):
+                self._pending.append(self.turns.pop(0))
+            if self._pending and self._future is None:
+                self._future = _executor.submit(self._summarize)
+
+    def history(self):
+        '''
+        Returns the history as text: the summary, the turns not summarized yet
+        if they fit, and the window.
+        '''
+        with self._lock:
+            turns = list(self.turns)
+            for turn in reversed(self._pending):
+                if count_tokens(self._render([turn] + turns)) > self.max_tokens:
+                    break
+                turns.insert(0, turn)
+            return self._render(turns)
+
+    def standalone(self, question):
+        '''
+        Returns the question rephrased to be understood without the history.
+        '''
+        history = self.history()
+        if not history:
+            return question
+
+        key = (history, normalize(question))
+        with self._lock:
+            if key in self._standalone:
+                self._standalone.move_to_end(key)
+                self.stats['cached'] += 1
+                return self._standalone[key]
+
+        result = self.client.complete(
+            CONDENSE_QUESTION_PROMPT.format(chat_history=history, question=question)).strip()
+        with self._lock:
+            self._standalone[key] = result or question
+            while len(self._standalone) > self.cache_size:
+                self._standalone.popitem(last=False)
+            self.stats['condensed'] += 1
+        return result or question
+
+    def wait(self):
+        '''
+        Wait for the background summary to be up to date.
+        '''
+        while True:
+            with self._lock:
+                future = self._future
+            if future is None:
+                return
+            future.result()
+
+    def clear(self):
+        with self._lock:
+            self.turns = []
+            self.summary = ''
+            self._pending = []
+            self._standalone.clear()
+
+    def _summarize(self):
+        while True:
+            with self._lock:
+                turns = list(self._pending)
+                summary = self.summary
+                if not turns:
+                    self._future = None
+                    return
+
+            lines = '\n'.join(f'Human: {q}\nAI: {a}' for q, a in turns)
+            try:
+                summary = self.client.complete(SUMMARY_PROMPT.format(summary=summary, new_lines=lines)).strip()
+            except Exception:
+                # the turns stay pending, the next add() retries
+                with self._lock:
+                    self._future = None
+                raise
+            with self._lock:
+                # a clear() meanwhile drops the pending turns, and the result with them
+                if self._pending[:len(turns)] == turns:
+                    del self._pending[:len(turns)]
+                    self.summary = summary
+                    self.stats['summarized'] += len(turns)
+
+    def _render(self, turns):
+        text = f'Summary of the earlier conversation: {self.summary}\n' if self.summary else ''
+        return text + '\n'.join(f'Human: {q}\nAssistant: {a}' for q, a in turns)
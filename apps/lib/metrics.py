@@ -0,0 +1,196 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in ms
+BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+# if set, every finished trace is appended to this JSON lines file
+JSONL_PATH = os.environ.get('METRICS_JSONL')
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    '''
+    Durations of a stage: cumulative buckets for Prometheus, plus the last
+    `history` values for percentiles.
+    '''
+
+    def __init__(self, buckets=BUCKETS, history=1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=history)
+
+    def observe(self, ms):
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += ms
+        self.recent.append(ms)
+
+    def summary(self):
+        values = sorted(self.recent)
+        return {
+            'count': self.count,
+            'p50_ms': round(values[len(values) // 2], 2) if values else 0.0,
+            'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))], 2) if values else 0.0,
+            'max_ms': round(values[-1], 2) if values else 0.0,
+            'total_ms': round(self.sum, 2),
+        }
+
+
+class Trace:
+    '''
+    The spans of one request, in the order they finished.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.ms = None
+
+    def breakdown(self):
+        '''
+        Returns a list of rows: stage, depth, start offset and duration in ms.
+        '''
+        return sorted(self.spans, key=lambda s: s['start_ms'])
+
+    def to_dict(self):
+        return {'name': self.name, 'ms': self.ms, 'spans': self.breakdown(), 'counters': self.counters}
+
+
+class Registry:
+    '''
+    Histograms of stage durations and counters, shared by all threads.
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.traces = deque(maxlen=100)
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+
+    @contextmanager
+    def span(self, name):
+        '''
+        Time a block as stage `name`. Spans inside a trace are also added to it.
+        '''
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._depth.value = depth
+            ms = (end - start) * 1000
+            self.observe(name, ms)
+            trace = _trace.get()
+            if trace is not None:
+                trace.spans.append({'stage': name, 'depth': depth, 'start_ms': round((start - trace.start) * 1000, 2),
+                                    'ms': round(ms, 2)})
+
+    def timed(self, name):
+        '''
+        Decorate a function to time its calls as stage `name`.
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def trace(self, name):
+        '''
+        Collect the spans and counters of a request. Yields the Trace, which is
+        kept in `traces` when the block ends.
+        '''
+        trace = Trace(name)
+        token = _trace.set(trace)
+        try:
+            with self.span(name):
+                yield trace
+        finally:
+            _trace.reset(token)
+            trace.ms = round((time.perf_counter() - trace.start) * 1000, 2)
+            with self._lock:
+                self.traces.append(trace)
+            if JSONL_PATH:
+                with self._lock, open(JSONL_PATH, 'a') as f:
+                    f.write(json.dumps({'time': time.time(), **trace.to_dict()}) + '\n')
+
+    def observe(self, name, ms):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(ms)
+
+    def count(self, name, value=1):
+        '''
+        Add to counter `name`, and to the counters of the current trace.
+        '''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        trace = _trace.get()
+        if trace is not None:
+            trace.counters[name] = trace.counters.get(name, 0) + value
+
+    def last(self):
+        with self._lock:
+            return self.traces[-1] if self.traces else None
+
+    def summary(self):
+        '''
+        Returns a dict of {stage: histogram summary} and the counters.
+        '''
+        with self._lock:
+            return {
+                'stages': {name: h.summary() for name, h in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        lines = ['# TYPE llm_apps_stage_ms histogram']
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append(f'llm_apps_stage_ms_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'llm_apps_stage_ms_bucket{{stage="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'llm_apps_stage_ms_sum{{stage="{name}"}} {h.sum:.3f}')
+                lines.append(f'llm_apps_stage_ms_count{{stage="{name}"}} {h.count}')
+            lines.append('# TYPE llm_apps_total counter')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'llm_apps_total{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def jsonl(self):
+        '''
+        Returns the kept traces as JSON lines.
+        '''
+        with self._lock:
+            traces = list(self.traces)
+        return ''.join(json.dumps(t.to_dict()) + '\n' for t in traces)
+
+
+registry = Registry()
+span = registry.span
+timed = registry.timed
+trace = registry.trace
+count = registry.count
@@ -0,0 +1,142 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from lib.utils import atomic_path, atomic_write
+
+KEY = re.compile(r'^[0-9a-f]{16}$')
+
+
+class PdfStore:
+    '''
+    The uploaded PDFs, stored by content as <path>/<key>.pdf, where the key is
+    a prefix of the SHA-256 of the file. <path>/names.json maps the names
+    they were uploaded as to their keys.
+
+    Vector databases are named by key too: a file uploaded again under
+    another name reuses the database of the first upload, and another file
+    uploaded under an old name gets its own. A file no name refers to any
+    more is removed with its database, once no job is building the database.
+
+    Arguments:
+    path: The directory of the PDFs and their vector databases.
+    '''
+
+    def __init__(self, path='data/pdf'):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def names_path(self):
+        return f'{self.path}/names.json'
+
+    def filename(self, key):
+        return f'{self.path}/{key}.pdf'
+
+    def names(self):
+        '''
+        Returns a dict of {name: key}, ordered by name.
+        '''
+        try:
+            with open(self.names_path()) as f:
+                return dict(sorted(json.load(f).items()))
+        except FileNotFoundError:
+            return {}
+
+    def key(self, name):
+        return self.names().get(name)
+
+    def add(self, name, data):
+        '''
+        Store the content of a PDF under a name, replacing what the name
+        referred to.
+
+        Returns the key of the content.
+        '''
+        with self._locked():
+            names = self.names()
+            key = self._add(names, name, data)
+            self._save(names)
+            self._collect(set(names.values()))
+        return key
+
+    def remove(self, name):
+        with self._locked():
+            names = self.names()
+            if names.pop(name, None) is not None:
+                self._save(names)
+                self._collect(set(names.values()))
+
+    def migrate(self):
+        '''
+        Move PDFs stored by file name (<name>.pdf, with a vector database
+        named <name>) to their content keys, and remove the files no name
+        refers to.
+
+        Returns the names migrated.
+        '''
+        from lib.vdb import Vdb
+
+        migrated = []
+        with self._locked():
+            names = self.names()
+            for file in sorted(os.listdir(self.path)):
+                name, ext = os.path.splitext(file)
+                if ext != '.pdf' or KEY.match(name):
+                    continue
+                with open(f'{self.path}/{file}', 'rb') as f:
+                    key = self._add(names, name, f.read())
+                vdb = Vdb(self.path, name)
+                if vdb.exists() and not Vdb(self.path, key).exists():
+                    vdb.rename(key)
+                os.remove(f'{self.path}/{file}')
+                migrated.append(name)
+            self._save(names)
+            self._collect(set(names.values()))
+        return migrated
+
+    def _add(self, names, name, data):
+        key = hashlib.sha256(data).hexdigest()[:16]
+        if not os.path.exists(self.filename(key)):
+            with atomic_path(self.filename(key)) as tmp:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+        names[name] = key
+        return key
+
+    def _save(self, names):
+        if names != self.names():
+            with atomic_write(self.names_path()) as f:
+                json.dump(names, f, indent=2)
+
+    @contextmanager
+    def _locked(self):
+        # names.json and the files are shared with other processes: change
+        # them under a file lock
+        with self._lock, open(f'{self.path}/names.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _collect(self, keys):
+        '''
+        Remove the files and vector databases of the keys not in `keys`,
+        except those a job is building. The lock must be held.
+        '''
+        from lib import jobs
+        from lib.vdb import Vdb
+
+        for file in os.listdir(self.path):
+            key, ext = os.path.splitext(file)
+            if ext != '.pdf' or not KEY.match(key) or key in keys:
+                continue
+            if jobs.default().active(f'vdb:{key}'):
+                # collected by a later change once the job is over
+                continue
+            Vdb(self.path, key).remove()
+            os.remove(self.filename(key))
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sqlparse
+import threading
+import time
+from sqlparse import tokens as T
+from lib import metrics
+from lib.utils import atomic_path
+
+CREATE = '''
+CREATE TABLE IF NOT EXISTS results (
+  key TEXT PRIMARY KEY,
+  db_name TEXT NOT NULL,
+  sql TEXT NOT NULL,
+  markers TEXT NOT NULL,
+  columns TEXT NOT NULL,
+  rows INTEGER NOT NULL,
+  truncated INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  created_at REAL NOT NULL,
+  accessed_at REAL NOT NULL
+);
+'''
+
+MARKERS = '''
+SELECT schemaname || '.' || relname, n_tup_ins, n_tup_upd, n_tup_del, n_live_tup
+FROM pg_catalog.pg_stat_user_tables
+WHERE schemaname || '.' || relname = ANY(%s)
+'''
+
+VOLATILE = '''
+SELECT 1 FROM pg_catalog.pg_proc WHERE lower(proname) = ANY(%s) AND provolatile = 'v' LIMIT 1
+'''
+# the current time, from SQL value functions and stable functions: results
+# using it change without any table changing
+CLOCK = {'current_date', 'current_time', 'current_timestamp', 'localtime', 'localtimestamp', 'now',
+         'statement_timestamp', 'transaction_timestamp'}
+
+
+def functions(sql):
+    '''
+    Returns the lowercase names of the functions a statement calls, and of
+    the SQL value functions (e.g. current_date) it uses.
+    '''
+    tokens = [t for t in sqlparse.parse(sql)[0].flatten() if not t.is_whitespace]
+    names = set()
+    for token, following in zip(tokens, tokens[1:] + [None]):
+        if token.ttype in T.Keyword and token.value.lower() in CLOCK:
+            names.add(token.value.lower())
+        elif following is not None and following.match(T.Punctuation, '(') \
+                and (token.ttype in T.Name or token.ttype in T.Keyword or token.ttype in T.Literal.String.Symbol):
+            names.add(token.value.strip('"').lower())
+    return names
+
+
+def normalize(sql):
+    '''
+    Normalize a statement so trivial variations (comments, spacing, keyword
+    case, a trailing semicolon) share a cache entry. Literals and identifiers
+    are kept as they are.
+    '''
+    statement = sqlparse.parse(sqlparse.format(sql, strip_comments=True))[0]
+    parts = []
+    for token in statement.flatten():
+        if token.is_whitespace:
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        elif token.is_keyword:
+            parts.append(token.normalized)
+        else:
+            parts.append(token.value)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+class CachedResult:
+    '''
+    A result loaded from the cache, with the interface of a finished
+    lib.results.ResultStream.
+    '''
+
+    def __init__(self, sql, frame, truncated, page_size=100, created_at=None):
+        self.sql = sql
+        self.rows = frame
+        self.columns = list(frame.columns)
+        self.truncated = truncated
+        self.page_size = page_size
+        self.created_at = created_at
+        self.done = True
+
+    def pages(self):
+        return max(1, (len(self.rows) + self.page_size - 1) // self.page_size)
+
+    def page(self, n):
+        return self.rows.iloc[n * self.page_size:(n + 1) * self.page_size].reset_index(drop=True)
+
+    def close(self):
+        pass
+
+
+class ResultCache:
+    '''
+    A disk cache of SELECT results, keyed by (database, normalized statement).
+    Results are stored as Parquet files, indexed in a SQLite database.
+
+    An entry is valid for `ttl` seconds, as long as the tables the statement
+    reads are unchanged: their insert, update and delete counters in
+    pg_stat_user_tables are kept with the entry (the "markers") and compared
+    on lookup. Postgres updates these counters within a few seconds of a
+    commit, and doesn't track tables of other kinds (e.g. foreign tables);
+    the TTL bounds how stale such results can get. Statements reading no
+    table or calling volatile functions aren't cached (see `cacheable`).
+
+    The least recently used entries are evicted beyond `max_bytes` of files.
+
+    Arguments:
+    path: The directory of the cache.
+    max_bytes: Max total size of the Parquet files.
+    ttl: Max age of an entry in seconds.
+    page_size: Page size of the cached results.
+    '''
+
+    def __init__(self, path='data/db/results', max_bytes=500 * 1024 * 1024, ttl=3600, page_size=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.page_size = page_size
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._con = sqlite3.connect(f'{path}/index.sqlite', check_same_thread=False)
+        self._con.execute(CREATE)
+
+    def key(self, db_name, sql):
+        return hashlib.sha256(f'{db_name}\n{normalize(sql)}'.encode('utf-8')).hexdigest()
+
+    def file_name(self, key):
+        return f'{self.path}/{key}.parquet'
+
+    def cacheable(self, con, sql, tables):
+        '''
+        Returns whether the result of a SELECT can be cached: it reads tables,
+        whose changes invalidate it, and calls no volatile function (e.g.
+        random()) and nothing returning the current time.
+
+        Arguments:
+        con: A DB-API connection of the database. Its transaction is rolled back.
+        sql: The statement.
+        tables: "schema.table" names, e.g. the "tables" of a lib.guard plan.
+        '''
+        if not tables:
+            return False
+        names = functions(sql)
+        if names & CLOCK:
+            return False
+        if not names:
+            return True
+        cursor = con.cursor()
+        try:
+            cursor.execute(VOLATILE, (list(names),))
+            return cursor.fetchone() is None
+        finally:
+            cursor.close()
+            con.rollback()
+
+    def markers(self, con, tables):
+        '''
+        Returns the change counters of tables, as a dict of {table: [inserts,
+        updates, deletes, live rows]}. Tables Postgres doesn't track are left out.
+
+        Arguments:
+        con: A DB-API connection of the database. Its transaction is rolled back.
+        tables: "schema.table" names, e.g. the "tables" of a lib.guard plan.
+        '''
+        if not tables:
+            return {}
+        cursor = con.cursor()
+        try:
+            cursor.execute(MARKERS, (list(tables),))
+            return {row[0]: list(row[1:]) for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+            con.rollback()
+
+    @metrics.timed('sql.cache')
+    def get(self, db_name, sql, markers):
+        '''
+        Look up the result of a statement.
+
+        Arguments:
+        db_name: The database.
+        sql: The statement.
+        markers: The current markers of the tables it reads, from `markers`.
+
+        Returns a CachedResult, or None.
+        '''
+        import pyarrow.parquet as pq
+
+        key = self.key(db_name, sql)
+        with self._lock:
+            row = self._con.execute(
+                'SELECT markers, columns, truncated, created_at FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[3] < time.time() - self.ttl or json.loads(row[0]) != markers:
+                self.stale += 1
+                self._delete(key)
+                return None
+
+        try:
+            frame = pq.read_table(self.file_name(key)).to_pandas()
+        except (FileNotFoundError, OSError):
+            # evicted by another process meanwhile
+            with self._lock:
+                self.misses += 1
+                self._delete(key)
+            return None
+        # the file has positional column names: result columns may repeat
+        frame.columns = json.loads(row[1])
+
+        with self._lock, self._con:
+            self.hits += 1
+            self._con.execute('UPDATE results SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return CachedResult(sql, frame, bool(row[2]), self.page_size, row[3])
+
+    def put(self, db_name, sql, markers, columns, rows, truncated=False):
+        '''
+        Store the result of a statement.
+
+        Arguments:
+        db_name: The database.
+        sql: The statement.
+        markers: The markers of the tables it reads, taken before it ran.
+        columns: The column names.
+        rows: The rows, a list of tuples.
+        truncated: Whether rows were left out of the result.
+
+        Returns False if the result can't be cached: too large, or of values
+        Arrow can't store.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        try:
+            table = pa.Table.from_arrays(
+                [pa.array([row[i] for row in rows]) for i in range(len(columns))],
+                names=[f'c{i}' for i in range(len(columns))])
+        except (pa.ArrowException, ValueError, TypeError):
+            return False
+
+        key = self.key(db_name, sql)
+        with atomic_path(self.file_name(key)) as tmp:
+            pq.write_table(table, tmp)
+        size = os.path.getsize(self.file_name(key))
+        if size > self.max_bytes:
+            os.remove(self.file_name(key))
+            return False
+
+        now = time.time()
+        with self._lock, self._con:
+            self._con.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, db_name, normalize(sql), json.dumps(markers, sort_keys=True), json.dumps(columns),
+                 len(rows), int(truncated), size, now, now))
+            self._evict()
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        with self._lock:
+            entries, size = self._con.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock, self._con:
+            for (key,) in self._con.execute('SELECT key FROM results').fetchall():
+                self._delete(key)
+
+    def _evict(self):
+        total = 0
+        rows = self._con.execute('SELECT key, size FROM results ORDER BY accessed_at DESC').fetchall()
+        for key, size in rows:
+            total += size
+            if total > self.max_bytes:
+                self._delete(key)
+
+    def _delete(self, key):
+        with self._con:
+            self._con.execute('DELETE FROM results WHERE key = ?', (key,))
+        try:
+            os.remove(self.file_name(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,311 @@
+import csv
+import sys
+import threading
+import time
+import uuid
+import weakref
+from lib import metrics
+from lib.guard import begin
+
+# seconds between checks for idle streams
+REAP_INTERVAL = 5
+
+_streams = weakref.WeakSet()
+_streams_lock = threading.Lock()
+_reaper = None
+
+
+class ResultStream:
+    '''
+    Run a SELECT through a server-side cursor and fetch its rows lazily, a
+    chunk at a time, as pages are requested. Fetching stops once `max_rows`
+    rows or about `max_bytes` bytes are held; `truncated` tells whether rows
+    were left out.
+
+    A stream holds a pooled connection and an open transaction until all its
+    rows are fetched. One left unused for `idle_timeout` seconds, e.g. by an
+    idle browser tab, releases them; the statement is run again, skipping the
+    rows held, when the next rows are requested. Rows fetched after that come
+    from a new snapshot, and in another order if the statement has no ORDER BY.
+
+    Arguments:
+    engine: A SQLAlchemy engine of a Postgres database.
+    sql: The SELECT statement.
+    page_size: Rows per page.
+    fetch_size: Rows fetched from the server at a time.
+    max_rows: Max number of rows held.
+    max_bytes: Max estimated size of the rows held.
+    read_only: Run the statement in a read-only transaction.
+    statement_timeout: Timeout of the statement in ms, None for the server default.
+    idle_timeout: Seconds without a fetch after which the connection is released.
+    '''
+
+    def __init__(self, engine, sql, page_size=100, fetch_size=1000, max_rows=10000,
+                 max_bytes=50 * 1024 * 1024, read_only=False, statement_timeout=None, idle_timeout=60):
+        self.engine = engine
+        self.sql = sql
+        self.page_size = page_size
+        self.fetch_size = fetch_size
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.statement_timeout = statement_timeout
+        self.idle_timeout = idle_timeout
+        self.rows = []
+        self.size = 0
+        self.columns = []
+        self.truncated = False
+        self.done = False
+        self.used_at = time.monotonic()
+        self._con = None
+        self._cursor = None
+        self._lock = threading.RLock()
+        with metrics.span('sql.execute'), self._lock:
+            self._open()
+            self._fetch(page_size)
+        if not self.done:
+            _watch(self)
+
+    def pages(self):
+        '''
+        Returns the number of pages fetched so far, plus one if more rows may follow.
+        '''
+        pages = (len(self.rows) + self.page_size - 1) // self.page_size
+        return max(1, pages + (0 if self.done else 1))
+
+    def page(self, n):
+        '''
+        Returns page n (from 0) as a DataFrame, fetching more rows if needed.
+        '''
+        import pandas as pd
+
+        end = (n + 1) * self.page_size
+        with self._lock:
+            self.used_at = time.monotonic()
+            if end > len(self.rows) and not self.done:
+                with metrics.span('sql.fetch'):
+                    if self._cursor is None:
+                        self._open()
+                    self._fetch(end - len(self.rows))
+        return pd.DataFrame(self.rows[n * self.page_size:end], columns=self.columns)
+
+    def release(self):
+        '''
+        Close the cursor and return the connection to the pool, keeping the
+        rows fetched. The next fetch opens them again.
+        '''
+        with self._lock:
+            if self._cursor is not None:
+                try:
+                    self._cursor.close()
+                    self._con.rollback()
+                finally:
+                    self._con.close()
+                    self._cursor = None
+                    self._con = None
+
+    def close(self):
+        self.release()
+        self.done = True
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _open(self):
+        self._con = self.engine.raw_connection()
+        try:
+            with self._con.cursor() as cursor:
+                begin(cursor, self.read_only, self.statement_timeout)
+            self._cursor = self._con.cursor(name=f'result_{uuid.uuid4().hex}')
+            self._cursor.itersize = self.fetch_size
+            self._cursor.execute(self.sql)
+            if self.rows:
+                # reopened after an idle release: skip the rows held
+                self._cursor.scroll(len(self.rows))
+        except Exception:
+            self._con.close()
+            self._con = self._cursor = None
+            raise
+
+    def _fetch(self, count):
+        while count > 0 and not self.done:
+            rows = self._cursor.fetchmany(min(self.fetch_size, max(count, self.page_size)))
+            if not self.columns and self._cursor.description:
+                self.columns = [d[0] for d in self._cursor.description]
+            if not rows:
+                self.close()
+                break
+
+            for row in rows:
+                if len(self.rows) >= self.max_rows or self.size >= self.max_bytes:
+                    self.truncated = True
+                    self.close()
+                    break
+                self.rows.append(row)
+                self.size += row_size(row)
+            count -= len(rows)
+
+
+def _watch(stream):
+    '''
+    Have the reaper thread release the connection of a stream once it's idle.
+    '''
+    global _reaper
+    with _streams_lock:
+        _streams.add(stream)
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap, name='result-reaper', daemon=True)
+            _reaper.start()
+
+
+def _reap():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        with _streams_lock:
+            streams = list(_streams)
+        now = time.monotonic()
+        for stream in streams:
+            if stream.done:
+                with _streams_lock:
+                    _streams.discard(stream)
+            elif stream._cursor is not None and now - stream.used_at > stream.idle_timeout:
+                # a fetch in progress holds the lock: try again next time
+                if stream._lock.acquire(blocking=False):
+                    try:
+                        if now - stream.used_at > stream.idle_timeout:
+                            stream.release()
+                            metrics.count('sql.idle_released')
+                    except Exception:
+                        pass
+                    finally:
+                        stream._lock.release()
+
+
+@metrics.timed('sql.export')
+def export(engine, sql, path, format='csv', fetch_size=10000, read_only=False, statement_timeout=None):
+    '''
+    Stream the result of a SELECT to a file without holding it in memory.
+
+    Arguments:
+    engine: A SQLAlchemy engine of a Postgres database.
+    sql: The SELECT statement.
+    path: The file to write.
+    format: "csv" or "parquet" (requires pyarrow).
+    fetch_size: Rows fetched from the server at a time.
+    read_only: Run the statement in a read-only transaction.
+    statement_timeout: Timeout of the statement in ms, None for the server default.
+
+    Returns the number of rows written.
+    '''
+    con = engine.raw_connection()
+    try:
+        with con.cursor() as cursor:
+            begin(cursor, read_only, statement_timeout)
+        cursor = con.cursor(name=f'export_{uuid.uuid4().hex}')
+        cursor.itersize = fetch_size
+        cursor.execute(sql)
+        if format == 'csv':
+            return _export_csv(cursor, path, fetch_size)
+        if format == 'parquet':
+            return _export_parquet(cursor, path, fetch_size)
+        raise ValueError(f'Unknown export format: {format}')
+    finally:
+        con.rollback()
+        con.close()
+
+
+@metrics.timed('sql.execute')
+def execute(engine, sql, statement_timeout=None):
+    '''
+    Run a statement that returns no rows and commit it.
+
+    Arguments:
+    engine: A SQLAlchemy engine of a Postgres database.
+    sql: The statement.
+    statement_timeout: Timeout of the statement in ms, None for the server default.
+    '''
+    con = engine.raw_connection()
+    try:
+        with con.cursor() as cursor:
+            begin(cursor, statement_timeout=statement_timeout)
+            cursor.execute(sql)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+
+def row_size(row):
+    '''
+    Estimate the memory held by a row, in bytes.
+    '''
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+
+
+def _export_csv(cursor, path, fetch_size):
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        rows = cursor.fetchmany(fetch_size)
+        writer.writerow([d[0] for d in cursor.description])
+        while rows:
+            writer.writerows(rows)
+            count += len(rows)
+            rows = cursor.fetchmany(fetch_size)
+    return count
+
+
+def _export_parquet(cursor, path, fetch_size):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    count = 0
+    rows = cursor.fetchmany(fetch_size)
+    columns = [d[0] for d in cursor.description]
+    if rows:
+        schema = pa.Table.from_pandas(pd.DataFrame(rows, columns=columns), preserve_index=False).schema
+        # the pandas metadata would describe the types of the first rows
+        schema = schema.remove_metadata()
+    else:
+        schema = pa.schema([pa.field(c, pa.string()) for c in columns])
+    # columns without a value in the first rows (or without rows) take the
+    # type of their Postgres column, so values in later rows fit
+    for i, d in enumerate(cursor.description):
+        if pa.types.is_null(schema.field(i).type) or not rows:
+            schema = schema.set(i, pa.field(d[0], _arrow_type(d.type_code)))
+
+    with pq.ParquetWriter(path, schema) as writer:
+        if not rows:
+            writer.write_table(schema.empty_table())
+        while rows:
+            table = pa.Table.from_pandas(pd.DataFrame(rows, columns=columns), preserve_index=False)
+            writer.write_table(table.replace_schema_metadata().cast(schema))
+            count += len(rows)
+            rows = cursor.fetchmany(fetch_size)
+    return count
+
+
+def _arrow_type(type_code):
+    '''
+    Returns the Arrow type of a Postgres type OID, string for the others.
+    '''
+    import pyarrow as pa
+
+    types = {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1082: pa.date32(),
+        1114: pa.timestamp('us'),
+        1184: pa.timestamp('us', tz='UTC'),
+    }
+    return types.get(type_code, pa.string())
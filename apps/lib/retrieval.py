@@ -0,0 +1,119 @@
+import numpy as np
+from langchain.vectorstores.base import VectorStore
+from lib import metrics
+from lib.bm25 import tokenize
+from lib.utils import count_tokens
+
+
+class HybridRetriever(VectorStore):
+    '''
+    Hybrid retrieval over a MmapStore: dense (FAISS) and lexical (BM25)
+    candidates are merged by reciprocal-rank fusion, then picked by maximal
+    marginal relevance, skipping near-duplicate chunks, until a token budget
+    is filled.
+
+    Arguments:
+    store: A MmapStore with a BM25 index.
+    candidates: Number of candidates taken from each ranking.
+    rrf_k: The constant of reciprocal-rank fusion, higher values flatten ranks.
+    weights: Weights of the dense and the lexical ranking in the fusion.
+    mmr_lambda: Weight of relevance against diversity in MMR, 1 disables diversity.
+    duplicate: Cosine similarity above which a chunk is a duplicate of a picked one.
+    max_tokens: Token budget of the retrieved chunks. If None, return k chunks.
+    '''
+
+    def __init__(self, store, candidates=20, rrf_k=60, weights=(1.0, 1.0), mmr_lambda=0.7,
+                 duplicate=0.95, max_tokens=1500):
+        self.store = store
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.weights = weights
+        self.mmr_lambda = mmr_lambda
+        self.duplicate = duplicate
+        self.max_tokens = max_tokens
+
+    def dense(self, query, n=None, embedding=None):
+        '''
+        Returns the chunk indices nearest to the query, best first.
+        '''
+        if embedding is None:
+            embedding = self.store.embedding_function(query)
+        n = min(n or self.candidates, len(self.store))
+        indices, _ = self.store.nearest(embedding, n)
+        return [int(i) for i in indices]
+
+    def lexical(self, query, n=None):
+        '''
+        Returns the chunk indices with the best BM25 scores, best first.
+        '''
+        if self.store.bm25 is None:
+            return []
+        return [i for i, _ in self.store.bm25.search(tokenize(query), n or self.candidates)]
+
+    def fuse(self, dense, lexical):
+        '''
+        Merge the dense and the lexical ranking by weighted reciprocal-rank fusion.
+
+        Returns a list of (chunk index, score), best first.
+        '''
+        scores = {}
+        for ranking, weight in zip([dense, lexical], self.weights):
+            for rank, i in enumerate(ranking):
+                scores[i] = scores.get(i, 0) + weight / (self.rrf_k + rank + 1)
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+    @metrics.timed('retrieval.search')
+    def search(self, query, k=4):
+        '''
+        Returns the indices of the retrieved chunks, in order of selection.
+        '''
+        embedding = self.store.embedding_function(query)
+        fused = self.fuse(self.dense(query, embedding=embedding), self.lexical(query))
+        if not fused:
+            return []
+
+        ids = [i for i, _ in fused]
+        relevance = np.array([s for _, s in fused])
+        relevance = relevance / relevance.max()
+        vectors = np.stack([self.store.vector(i) for i in ids])
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        picked = []
+        seen = set()
+        budget = self.max_tokens
+        remaining = list(range(len(ids)))
+        while remaining:
+            if picked:
+                similarity = vectors[remaining] @ vectors[picked].T
+                redundancy = similarity.max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            scores = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * redundancy
+            best = int(np.argmax(scores))
+            j = remaining.pop(best)
+            text = self.store.text(ids[j])
+            key = ' '.join(text.split()).lower()
+            if key in seen or redundancy[best] >= self.duplicate:
+                continue
+
+            if budget is None:
+                if len(picked) == k:
+                    break
+            else:
+                tokens = count_tokens(text)
+                if picked and tokens > budget:
+                    break
+                budget -= tokens
+            picked.append(j)
+            seen.add(key)
+        return [ids[j] for j in picked]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [self.store.document(i) for i in self.search(query, k)]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError('HybridRetriever is read-only, rebuild the Vdb instead')
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError('Use Vdb.build and wrap the loaded store')
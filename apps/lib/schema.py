@@ -1,21 +1,29 @@
+import hashlib
+import json
 import os
+from lib import metrics
+from lib.utils import atomic_write
 
 SCHEMAS = 'SELECT nspname AS schema_name FROM pg_catalog.pg_namespace ORDER BY nspname;'
 ENUMS = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE TYPE ' || n.nspname || '.' || t.typname || ' AS ENUM (' || string_agg(quote_literal(e.enumlabel), ', ') || ');' AS sql
 FROM
   pg_catalog.pg_type t
   JOIN pg_catalog.pg_namespace n ON t.typnamespace = n.oid
   JOIN pg_catalog.pg_enum e ON t.oid = e.enumtypid
 WHERE
-  n.nspname = '{nsp}'
+  n.nspname IN ({nsp})
   AND t.typtype = 'e'
 GROUP BY
+  n.nspname, t.typname
+ORDER BY
   n.nspname, t.typname;
 '''
 TYPES = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE TYPE ' || n.nspname || '.' || t.typname || ' AS (' || string_agg(a.attname || ' ' || pg_catalog.format_type(a.atttypid, a.atttypmod), ', ') || ');' AS sql
 FROM
   pg_catalog.pg_type t
@@ -23,10 +31,12 @@ FROM
   JOIN pg_catalog.pg_class c ON t.typrelid = c.oid
   JOIN pg_catalog.pg_attribute a ON t.typrelid = a.attrelid
 WHERE
-  n.nspname = '{nsp}'
+  n.nspname IN ({nsp})
   AND t.typtype = 'c'
   AND c.relkind = 'c'
 GROUP BY
+  n.nspname, t.typname
+ORDER BY
   n.nspname, t.typname;
 '''
 TABLES = '''
@@ -45,7 +55,7 @@ WITH table_columns AS (
   WHERE
     a.attnum > 0
     AND NOT a.attisdropped
-    AND n.nspname = '{nsp}'
+    AND n.nspname IN ({nsp})
     AND c.relkind = 'r'
 ),
 table_constraints AS (
@@ -63,7 +73,7 @@ table_constraints AS (
       AND tc.constraint_name = kcu.constraint_name
   WHERE
     tc.constraint_type IN ('PRIMARY KEY', 'FOREIGN KEY', 'UNIQUE')
-    AND tc.table_schema = '{nsp}'
+    AND tc.table_schema IN ({nsp})
 ),
 formatted_columns AS (
   SELECT
@@ -108,32 +118,42 @@ create_table_statements AS (
     fc.table_name
 )
 SELECT
+  schema_name,
   'CREATE TABLE ' || schema_name || '.' || table_name || ' (' || formatted_columns || ');' AS sql
 FROM
-  create_table_statements;
+  create_table_statements
+ORDER BY
+  schema_name, table_name;
 '''
 VIEWS = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE VIEW ' || n.nspname || '.' || c.relname || ' AS ' || pg_get_viewdef(c.oid) AS sql
 FROM
   pg_catalog.pg_class c
   JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
 WHERE
   c.relkind = 'v' -- Select views
-  AND n.nspname = '{nsp}';
+  AND n.nspname IN ({nsp})
+ORDER BY
+  n.nspname, c.relname;
 '''
 MVIEWS = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE MATERIALIZED VIEW ' || n.nspname || '.' || c.relname || ' AS ' || pg_get_viewdef(c.oid) AS sql
 FROM
   pg_catalog.pg_class c
   JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
 WHERE
   c.relkind = 'm' -- Select materialized views
-  AND n.nspname = '{nsp}';
+  AND n.nspname IN ({nsp})
+ORDER BY
+  n.nspname, c.relname;
 '''
 FUNCTIONS = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE OR REPLACE FUNCTION ' || n.nspname || '.' || p.proname || '(' || pg_get_function_arguments(p.oid) || ') RETURNS '
   || pg_get_function_result(p.oid) || ' AS $function_body$ ' || pg_get_functiondef(p.oid) || '$function_body$ LANGUAGE ' || l.lanname || ';' AS sql
 FROM
@@ -141,14 +161,17 @@ FROM
   JOIN pg_catalog.pg_namespace n ON p.pronamespace = n.oid
   JOIN pg_catalog.pg_language l ON p.prolang = l.oid
 WHERE
-  n.nspname = '{nsp}'
-  AND p.prokind = 'f';
+  n.nspname IN ({nsp})
+  AND p.prokind = 'f'
+ORDER BY
+  n.nspname, p.proname, pg_get_function_arguments(p.oid);
 '''
 INDEXES = '''
-SELECT indexdef || ';' AS sql FROM pg_indexes WHERE schemaname = '{nsp}' ORDER BY tablename, indexname;
+SELECT schemaname AS schema_name, indexdef || ';' AS sql FROM pg_indexes WHERE schemaname IN ({nsp}) ORDER BY schemaname, tablename, indexname;
 '''
 TRIGGERS = '''
 SELECT
+  n.nspname AS schema_name,
   'CREATE TRIGGER ' || t.tgname
   || ' ' || CASE
     WHEN t.tgtype & 2 > 0 THEN 'BEFORE'
@@ -170,27 +193,271 @@ FROM
   JOIN pg_catalog.pg_proc p ON t.tgfoid = p.oid
   JOIN pg_catalog.pg_namespace np ON p.pronamespace = np.oid
 WHERE
-  n.nspname = '{nsp}'
-  AND NOT t.tgisinternal;
+  n.nspname IN ({nsp})
+  AND NOT t.tgisinternal
+ORDER BY
+  n.nspname, c.relname, t.tgname;
 '''
 
+FINGERPRINTS = '''
+WITH catalog_rows AS (
+  SELECT n.nspname AS schema_name, 'Enums' AS kind, 't' || t.oid || ':' || t.xmin AS item
+  FROM pg_catalog.pg_type t JOIN pg_catalog.pg_namespace n ON t.typnamespace = n.oid
+  WHERE t.typtype = 'e'
+  UNION ALL
+  SELECT n.nspname, 'Enums', 'e' || e.oid || ':' || e.xmin
+  FROM pg_catalog.pg_enum e JOIN pg_catalog.pg_type t ON e.enumtypid = t.oid JOIN pg_catalog.pg_namespace n ON t.typnamespace = n.oid
+  UNION ALL
+  SELECT n.nspname, 'Types', 'c' || c.oid || ':' || c.xmin
+  FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  WHERE c.relkind = 'c'
+  UNION ALL
+  SELECT n.nspname, CASE c.relkind WHEN 'c' THEN 'Types' ELSE 'Tables' END, 'a' || a.attrelid || '.' || a.attnum || ':' || a.xmin
+  FROM pg_catalog.pg_attribute a JOIN pg_catalog.pg_class c ON a.attrelid = c.oid JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  WHERE c.relkind IN ('c', 'r') AND a.attnum > 0
+  UNION ALL
+  SELECT n.nspname, 'Tables', 'c' || c.oid || ':' || c.xmin
+  FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  WHERE c.relkind = 'r'
+  UNION ALL
+  SELECT n.nspname, 'Tables', 'k' || k.oid || ':' || k.xmin
+  FROM pg_catalog.pg_constraint k JOIN pg_catalog.pg_class c ON k.conrelid = c.oid JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  WHERE c.relkind = 'r' AND k.contype IN ('p', 'f', 'u')
+  UNION ALL
+  SELECT n.nspname, CASE c.relkind WHEN 'v' THEN 'Views' ELSE 'Materialized Views' END, 'c' || c.oid || ':' || c.xmin || ':' || r.xmin
+  FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid JOIN pg_catalog.pg_rewrite r ON r.ev_class = c.oid
+  WHERE c.relkind IN ('v', 'm')
+  UNION ALL
+  -- the tables and columns a view references, so renaming or altering them changes the view's fingerprint
+  SELECT n.nspname, CASE c.relkind WHEN 'v' THEN 'Views' ELSE 'Materialized Views' END,
+    'd' || c.oid || '>' || rc.oid || ':' || rc.xmin || COALESCE('.' || a.attnum || ':' || a.xmin, '')
+  FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid JOIN pg_catalog.pg_rewrite r ON r.ev_class = c.oid
+    JOIN pg_catalog.pg_depend d ON d.classid = 'pg_catalog.pg_rewrite'::regclass AND d.objid = r.oid
+      AND d.refclassid = 'pg_catalog.pg_class'::regclass AND d.refobjid <> c.oid
+    JOIN pg_catalog.pg_class rc ON d.refobjid = rc.oid
+    LEFT JOIN pg_catalog.pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid AND d.refobjsubid > 0
+  WHERE c.relkind IN ('v', 'm')
+  UNION ALL
+  SELECT n.nspname, 'Functions', 'p' || p.oid || ':' || p.xmin
+  FROM pg_catalog.pg_proc p JOIN pg_catalog.pg_namespace n ON p.pronamespace = n.oid
+  WHERE p.prokind = 'f'
+  UNION ALL
+  SELECT n.nspname, 'Indexes', 'i' || i.indexrelid || ':' || i.xmin || ':' || ic.xmin || ':' || c.xmin
+  FROM pg_catalog.pg_index i JOIN pg_catalog.pg_class ic ON i.indexrelid = ic.oid JOIN pg_catalog.pg_class c ON i.indrelid = c.oid
+    JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  WHERE c.relkind IN ('r', 'm', 'p')
+  UNION ALL
+  SELECT n.nspname, 'Triggers', 'g' || t.oid || ':' || t.xmin || ':' || c.xmin || ':' || p.xmin
+  FROM pg_catalog.pg_trigger t JOIN pg_catalog.pg_class c ON t.tgrelid = c.oid JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+    JOIN pg_catalog.pg_proc p ON t.tgfoid = p.oid
+  WHERE NOT t.tgisinternal
+)
+SELECT
+  schema_name,
+  kind,
+  md5(string_agg(item, ',' ORDER BY item)) AS fingerprint
+FROM
+  catalog_rows
+WHERE
+  schema_name IN ({nsp})
+GROUP BY
+  schema_name, kind;
+'''
 
-def load_from_db(con):
+KINDS = [
+    ('Enums', ENUMS),
+    ('Types', TYPES),
+    ('Tables', TABLES),
+    ('Views', VIEWS),
+    ('Materialized Views', MVIEWS),
+    ('Functions', FUNCTIONS),
+    ('Indexes', INDEXES),
+    ('Triggers', TRIGGERS),
+]
+SNAPSHOT_VERSION = 1
+
+
+@metrics.timed('schema.load_from_db')
+def load_from_db(con, bulk=True):
     '''
     Load schemas from the database.
 
+    Arguments:
+    con: A database connection.
+    bulk: If True, load each object kind for all schemas in a single query, so
+          the number of round trips doesn't grow with the number of schemas.
+          Otherwise run every query once per schema. Both produce the same output.
+
+    Returns a SQL string containing all schemas.
+    '''
+    names = load_schema_names(con)
+    if not bulk:
+        return ''.join(_load_schema(con, name) for name in names)
+
+    items = _load_items(con, names)
+    return ''.join(_render_schema(name, items[name]) for name in names)
+
+
+def load_schema_names(con):
+    '''
+    Load the names of all non-system schemas in the database.
+
     Arguments:
     con: A database connection.
 
-    Returns a dictionary of schemas, keyed by schema name.
+    Returns a list of schema names, ordered by name.
     '''
-    schemas = ''
+    names = []
     for row in con.execute(SCHEMAS):
         if row['schema_name'].startswith('pg_') or row['schema_name'] in ['public', 'information_schema']:
             continue
-        schema = row['schema_name']
-        schemas += _load_schema(con, schema)
-    return schemas
+        names.append(row['schema_name'])
+    return names
+
+
+@metrics.timed('schema.refresh')
+def refresh(con, db_name, full=False):
+    '''
+    Refresh the schema snapshot of a database. The catalog fingerprint of every
+    schema and object kind is compared with the stored snapshot, and only the
+    changed ones are loaded again.
+
+    Arguments:
+    con: A database connection.
+    db_name: The name of the database.
+    full: If True, ignore the stored snapshot and load everything.
+
+    Returns a tuple of (SQL string containing all schemas, list of (schema, kind)
+    that were reloaded or dropped). Both the snapshot and the SQL file are updated.
+    '''
+    cached = {}
+    if not full and snapshot_exists(db_name):
+        cached = load_snapshot(db_name)['schemas']
+
+    names = load_schema_names(con)
+    fingerprints = load_fingerprints(con, names)
+    schemas = {name: {} for name in names}
+    stale = {}
+    for name in names:
+        for kind, _ in KINDS:
+            fingerprint = fingerprints[name].get(kind)
+            if fingerprint is None:
+                continue
+            entry = cached.get(name, {}).get(kind)
+            if entry is not None and entry['fingerprint'] == fingerprint:
+                schemas[name][kind] = entry
+            else:
+                stale.setdefault(kind, []).append(name)
+
+    changed = []
+    for kind, kind_names in stale.items():
+        items = _load_items(con, kind_names, [kind])
+        for name in kind_names:
+            schemas[name][kind] = {
+                'fingerprint': fingerprints[name][kind],
+                'items': items[name].get(kind, []),
+            }
+            changed.append((name, kind))
+
+    for name, kinds in cached.items():
+        changed.extend((name, kind) for kind in kinds if kind not in schemas.get(name, {}))
+
+    schemas = {name: {kind: schemas[name][kind] for kind, _ in KINDS if kind in schemas[name]}
+               for name in names}
+    snapshot = {'version': SNAPSHOT_VERSION, 'schemas': schemas}
+    sql = render(snapshot)
+    if schemas != cached or not exists(db_name):
+        save_snapshot(db_name, snapshot)
+        save_to_file(db_name, sql)
+    return sql, changed
+
+
+def load_fingerprints(con, names):
+    '''
+    Load the catalog fingerprint of every object kind in the given schemas. A
+    fingerprint changes whenever an object of that kind is created, altered or
+    dropped.
+
+    Arguments:
+    con: A database connection.
+    names: A list of schema names.
+
+    Returns a dictionary of {kind: fingerprint}, keyed by schema name. Kinds
+    without any object have no fingerprint.
+    '''
+    fingerprints = {name: {} for name in names}
+    if names:
+        for row in con.execute(FINGERPRINTS.format(nsp=_quote_names(names))):
+            fingerprints[row['schema_name']][row['kind']] = row['fingerprint']
+    return fingerprints
+
+
+def render(snapshot):
+    '''
+    Render a schema snapshot.
+
+    Arguments:
+    snapshot: A snapshot, as returned by load_snapshot.
+
+    Returns a SQL string containing all schemas, same as load_from_db.
+    '''
+    sql = ''
+    for name, kinds in snapshot['schemas'].items():
+        sql += _render_schema(name, {kind: entry['items'] for kind, entry in kinds.items()})
+    return sql
+
+
+def load_snapshot(db_name):
+    '''
+    Load a schema snapshot from a json file.
+
+    Arguments:
+    db_name: The name of the database.
+
+    Returns a dictionary with the objects of every schema, keyed by schema name
+    and then by object kind, each with its fingerprint.
+    '''
+
+    path = snapshot_path(db_name)
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_snapshot(db_name, snapshot):
+    '''
+    Save a schema snapshot to a json file.
+
+    Arguments:
+    db_name: The name of the database.
+    snapshot: The snapshot to save.
+    '''
+
+    path = snapshot_path(db_name)
+    with atomic_write(path) as f:
+        json.dump(snapshot, f, indent=2)
+
+
+def snapshot_exists(db_name):
+    '''
+    Check if a schema snapshot exists.
+
+    Arguments:
+    db_name: The name of the database.
+
+    Returns True if the snapshot file exists, otherwise False.
+    '''
+
+    path = snapshot_path(db_name)
+    return os.path.exists(path)
+
+
+def fingerprint(schemas):
+    '''
+    Fingerprint a SQL string containing all schemas.
+
+    Returns a hex digest that changes whenever the schemas change.
+    '''
+    return hashlib.md5(schemas.encode('utf-8')).hexdigest()
 
 
 def load_from_file(db_name):
@@ -219,7 +486,7 @@ def save_to_file(db_name, schemas):
     '''
 
     path = schema_path(db_name)
-    with open(path, 'w') as f:
+    with atomic_write(path) as f:
         f.write(schemas)
 
 
@@ -241,55 +508,42 @@ def schema_path(db_name):
     return f'data/db/{db_name}.sql'
 
 
+def snapshot_path(db_name):
+    return f'data/db/{db_name}.json'
+
+
 def _load_schema(con, name):
-    sql = f'-- Schema: {name}\n'
+    items = {}
+    for kind, query in KINDS:
+        rows = con.execute(query.format(nsp=_quote_names([name]))).fetchall()
+        if rows:
+            items[kind] = [row['sql'] for row in rows]
+    return _render_schema(name, items)
+
+
+def _load_items(con, names, kinds=None):
+    items = {name: {} for name in names}
+    if not names:
+        return items
+
+    nsp = _quote_names(names)
+    for kind, query in KINDS:
+        if kinds is not None and kind not in kinds:
+            continue
+        for row in con.execute(query.format(nsp=nsp)):
+            items[row['schema_name']].setdefault(kind, []).append(row['sql'])
+    return items
 
-    items = con.execute(ENUMS.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Enums\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(TYPES.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Types\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(TABLES.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Tables\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(VIEWS.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Views\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(MVIEWS.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Materialized Views\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(FUNCTIONS.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Functions\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(INDEXES.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Indexes\n'
-        for row in items:
-            sql += row['sql'] + '\n'
-
-    items = con.execute(TRIGGERS.format(nsp=name)).fetchall()
-    if items:
-        sql += '\n-- Triggers\n'
-        for row in items:
-            sql += row['sql'] + '\n'
 
+def _render_schema(name, items):
+    sql = f'-- Schema: {name}\n'
+    for kind, _ in KINDS:
+        if items.get(kind):
+            sql += f'\n-- {kind}\n'
+            for item in items[kind]:
+                sql += item + '\n'
     return sql + '\n'
+
+
+def _quote_names(names):
+    return ', '.join("'" + name.replace("'", "''") + "'" for name in names)
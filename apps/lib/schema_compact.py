@@ -0,0 +1,312 @@
+import json
+import os
+import re
+from lib import metrics, schema
+from lib.utils import atomic_write, count_tokens
+
+COLUMNS = '''
+SELECT
+  n.nspname AS schema_name,
+  c.relname AS table_name,
+  c.relkind AS kind,
+  a.attname AS column_name,
+  pg_catalog.format_type(a.atttypid, a.atttypmod) AS column_type,
+  a.attnotnull AS not_null
+FROM
+  pg_catalog.pg_attribute a
+  JOIN pg_catalog.pg_class c ON a.attrelid = c.oid
+  JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+WHERE
+  a.attnum > 0
+  AND NOT a.attisdropped
+  AND n.nspname IN ({nsp})
+  AND c.relkind IN ('r', 'p', 'v', 'm', 'c')
+ORDER BY
+  n.nspname, c.relname, a.attnum;
+'''
+CONSTRAINTS = '''
+SELECT
+  n.nspname AS schema_name,
+  c.relname AS table_name,
+  k.contype AS kind,
+  ARRAY(SELECT a.attname FROM unnest(k.conkey) WITH ORDINALITY AS u(attnum, i)
+        JOIN pg_catalog.pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = u.attnum ORDER BY u.i) AS columns,
+  fn.nspname AS target_schema,
+  fc.relname AS target_table,
+  ARRAY(SELECT a.attname FROM unnest(k.confkey) WITH ORDINALITY AS u(attnum, i)
+        JOIN pg_catalog.pg_attribute a ON a.attrelid = k.confrelid AND a.attnum = u.attnum ORDER BY u.i) AS target_columns
+FROM
+  pg_catalog.pg_constraint k
+  JOIN pg_catalog.pg_class c ON k.conrelid = c.oid
+  JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+  LEFT JOIN pg_catalog.pg_class fc ON k.confrelid = fc.oid
+  LEFT JOIN pg_catalog.pg_namespace fn ON fc.relnamespace = fn.oid
+WHERE
+  n.nspname IN ({nsp})
+  AND k.contype IN ('p', 'f')
+ORDER BY
+  n.nspname, c.relname, k.conname;
+'''
+ENUMS = '''
+SELECT
+  n.nspname AS schema_name,
+  t.typname AS type_name,
+  ARRAY(SELECT e.enumlabel FROM pg_catalog.pg_enum e WHERE e.enumtypid = t.oid ORDER BY e.enumsortorder) AS labels
+FROM
+  pg_catalog.pg_type t
+  JOIN pg_catalog.pg_namespace n ON t.typnamespace = n.oid
+WHERE
+  n.nspname IN ({nsp})
+  AND t.typtype = 'e'
+ORDER BY
+  n.nspname, t.typname;
+'''
+FUNCTIONS = '''
+SELECT
+  n.nspname AS schema_name,
+  p.proname AS function_name,
+  pg_get_function_arguments(p.oid) AS arguments,
+  pg_get_function_result(p.oid) AS result
+FROM
+  pg_catalog.pg_proc p
+  JOIN pg_catalog.pg_namespace n ON p.pronamespace = n.oid
+WHERE
+  n.nspname IN ({nsp})
+  AND p.prokind = 'f'
+  AND p.prorettype <> 'pg_catalog.trigger'::pg_catalog.regtype
+ORDER BY
+  n.nspname, p.proname, pg_get_function_arguments(p.oid);
+'''
+VIEW_SOURCES = '''
+SELECT DISTINCT
+  vn.nspname AS schema_name,
+  v.relname AS view_name,
+  tn.nspname || '.' || t.relname AS source
+FROM
+  pg_catalog.pg_rewrite r
+  JOIN pg_catalog.pg_class v ON r.ev_class = v.oid
+  JOIN pg_catalog.pg_namespace vn ON v.relnamespace = vn.oid
+  JOIN pg_catalog.pg_depend d ON d.objid = r.oid AND d.classid = 'pg_catalog.pg_rewrite'::pg_catalog.regclass
+    AND d.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass
+  JOIN pg_catalog.pg_class t ON d.refobjid = t.oid AND t.oid <> v.oid
+  JOIN pg_catalog.pg_namespace tn ON t.relnamespace = tn.oid
+WHERE
+  vn.nspname IN ({nsp})
+  AND v.relkind IN ('v', 'm')
+ORDER BY
+  1, 2, 3;
+'''
+RELATIONS = {'r': 'tables', 'p': 'tables', 'v': 'views', 'm': 'views', 'c': 'types'}
+# shorter spellings of common types; lengths and precisions are dropped too
+TYPE_ALIASES = [
+    (r'^character varying(\(\d+\))?', 'varchar'),
+    (r'^character(\(\d+\))?', 'char'),
+    (r'^timestamp(\(\d\))? without time zone', 'timestamp'),
+    (r'^timestamp(\(\d\))? with time zone', 'timestamptz'),
+    (r'^time(\(\d\))? without time zone', 'time'),
+    (r'^integer', 'int'),
+    (r'^numeric(\(\d+,\s*\d+\))?', 'numeric'),
+    (r'^double precision', 'float8'),
+    (r'^boolean', 'bool'),
+    (r'^public\.', ''),
+    (r'"', ''),
+]
+LEGEND = ('# name(column type, ...): * primary key, ? nullable, >table(column) foreign key '
+          '(to the column of the same name if omitted), pk(...) and fk(...) for multi-column keys, '
+          'like table for all the columns of a table')
+MODEL_VERSION = 1
+
+
+@metrics.timed('schema.compact')
+def load_from_db(con):
+    '''
+    Load a structured model of the schemas of a database: tables and views
+    with their columns, keys and foreign key targets, enums, composite types,
+    and function signatures without their bodies.
+
+    Arguments:
+    con: A database connection.
+
+    Returns a dict of {'version', 'schemas': {schema name: {'tables', 'views',
+    'types', 'enums', 'functions'}}}, each a dict keyed by object name.
+    '''
+    names = schema.load_schema_names(con)
+    schemas = {name: {'tables': {}, 'views': {}, 'types': {}, 'enums': {}, 'functions': {}} for name in names}
+    if not names:
+        return {'version': MODEL_VERSION, 'schemas': schemas}
+
+    nsp = schema._quote_names(names)
+    for row in con.execute(COLUMNS.format(nsp=nsp)):
+        objects = schemas[row['schema_name']][RELATIONS[row['kind']]]
+        item = objects.setdefault(row['table_name'], {'columns': [], 'primary_key': [], 'foreign_keys': []})
+        if row['kind'] == 'm':
+            item['materialized'] = True
+        item['columns'].append([row['column_name'], alias(row['column_type']), row['not_null']])
+
+    for row in con.execute(CONSTRAINTS.format(nsp=nsp)):
+        table = schemas[row['schema_name']]['tables'].get(row['table_name'])
+        if table is None:
+            continue
+        if row['kind'] == 'p':
+            table['primary_key'] = list(row['columns'])
+        else:
+            table['foreign_keys'].append([list(row['columns']), f"{row['target_schema']}.{row['target_table']}",
+                                          list(row['target_columns'])])
+
+    for row in con.execute(VIEW_SOURCES.format(nsp=nsp)):
+        view = schemas[row['schema_name']]['views'].get(row['view_name'])
+        if view is not None:
+            view.setdefault('sources', []).append(row['source'])
+
+    for row in con.execute(ENUMS.format(nsp=nsp)):
+        schemas[row['schema_name']]['enums'][row['type_name']] = list(row['labels'])
+
+    for row in con.execute(FUNCTIONS.format(nsp=nsp)):
+        functions = schemas[row['schema_name']]['functions']
+        functions.setdefault(row['function_name'], []).append([row['arguments'], alias(row['result'])])
+    return {'version': MODEL_VERSION, 'schemas': schemas}
+
+
+def alias(type_name):
+    '''
+    Returns the short spelling of a type.
+    '''
+    for pattern, short in TYPE_ALIASES:
+        type_name = re.sub(pattern, short, type_name)
+    return type_name
+
+
+def encode(model, names=None):
+    '''
+    Encode a model as compact text for a prompt: one line per object, names
+    qualified by a schema header instead of on every reference, no DDL
+    keywords, short type names, and keys as markers on the columns.
+
+    Arguments:
+    model: A model, as returned by load_from_db.
+    names: If given, only encode the objects of these "schema.name" names.
+
+    Returns the text.
+    '''
+    lines = [LEGEND]
+    for schema_name, objects in model['schemas'].items():
+        body = []
+        for name, labels in objects['enums'].items():
+            if names is None or f'{schema_name}.{name}' in names:
+                body.append(f"enum {name}: {'|'.join(labels)}")
+        for name, item in objects['types'].items():
+            if names is None or f'{schema_name}.{name}' in names:
+                body.append(f"type {name}({', '.join(f'{_quote(c)} {t}' for c, t, _ in item['columns'])})")
+        for name, item in objects['tables'].items():
+            if names is None or f'{schema_name}.{name}' in names:
+                body.append(_encode_table(schema_name, name, item))
+        for name, item in objects['views'].items():
+            if names is None or f'{schema_name}.{name}' in names:
+                body.append(_encode_view(model, schema_name, name, item))
+        for name, signatures in objects['functions'].items():
+            if names is None or f'{schema_name}.{name}' in names:
+                body.extend(f'fn {name}({arguments}) -> {result}' for arguments, result in signatures)
+        if body:
+            lines.append(f'## {schema_name}')
+            lines.extend(body)
+    return '\n'.join(lines) + '\n'
+
+
+def context(model, schema_index, question, top_k=8, max_tokens=3000):
+    '''
+    Returns the compact schema context of a question: the whole model if it
+    fits in the token budget, otherwise the objects the schema index picks.
+
+    Arguments:
+    model: A model, as returned by load_from_db.
+    schema_index: A SchemaIndex of the schema snapshot, or None.
+    question: The question.
+    top_k: Max number of objects picked by the index.
+    max_tokens: Token budget of the context.
+    '''
+    text = encode(model)
+    size = count_tokens(text)
+    if schema_index is None or size <= max_tokens:
+        return text
+
+    # the index measures objects as DDL, scale the budget to the compact size
+    budget = int(max_tokens * schema_index.full_size / size)
+    names = {schema_index.chunks[i].name for i in schema_index.select(question, top_k, budget)}
+    for name in list(names):
+        schema_name, view = name.split('.', 1)
+        sources = model['schemas'].get(schema_name, {}).get('views', {}).get(view, {}).get('sources', [])
+        if len(sources) == 1:
+            names.add(sources[0])
+    return encode(model, names)
+
+
+def load(db_name):
+    '''
+    Load the saved model of a database.
+    '''
+    with open(model_path(db_name)) as f:
+        return json.load(f)
+
+
+def save(db_name, model):
+    '''
+    Save the model of a database, next to its schema snapshot.
+    '''
+    with atomic_write(model_path(db_name)) as f:
+        json.dump(model, f)
+
+
+def exists(db_name):
+    return os.path.exists(model_path(db_name))
+
+
+def model_path(db_name):
+    return f'data/db/{db_name}.compact.json'
+
+
+def _quote(name):
+    return name if re.fullmatch(r'[a-z_][a-z0-9_$]*', name) else '"' + name.replace('"', '""') + '"'
+
+
+def _encode_view(model, schema_name, name, item):
+    columns = [f'{_quote(c)} {t}' for c, t, _ in item['columns']]
+    # a view over a single table with all its columns reads as that table
+    sources = item.get('sources', [])
+    if len(sources) == 1:
+        source_schema, source_name = sources[0].split('.', 1)
+        table = model['schemas'].get(source_schema, {}).get('tables', {}).get(source_name)
+        if table is not None:
+            inherited = [f'{_quote(c)} {t}' for c, t, _ in table['columns']]
+            if set(inherited) <= set(columns):
+                source = source_name if source_schema == schema_name else sources[0]
+                columns = [f'like {source}'] + [c for c in columns if c not in inherited]
+    kind = 'mview' if item.get('materialized') else 'view'
+    return f"{kind} {name}({', '.join(columns)})"
+
+
+def _encode_table(schema_name, name, item):
+    primary = item['primary_key']
+    single = {}
+    composite = []
+    for columns, target, target_columns in item['foreign_keys']:
+        target = target[len(schema_name) + 1:] if target.startswith(f'{schema_name}.') else target
+        if len(columns) == 1:
+            same = target_columns == columns
+            single[columns[0]] = f'>{target}' if same else f'>{target}({target_columns[0]})'
+        else:
+            composite.append(f"({','.join(columns)})>{target}({','.join(target_columns)})")
+
+    columns = []
+    for column, type_name, not_null in item['columns']:
+        text = f'{_quote(column)}{"*" if len(primary) == 1 and column in primary else ""} {type_name}'
+        if not not_null:
+            text += '?'
+        if column in single:
+            text += single[column]
+        columns.append(text)
+    text = f"{name}({', '.join(columns)})"
+    if len(primary) > 1:
+        text += f" pk({','.join(primary)})"
+    if composite:
+        text += ' fk' + ' fk'.join(composite)
+    return text
@@ -0,0 +1,122 @@
+import re
+from collections import namedtuple
+from lib import schema, utils
+from lib.bm25 import Bm25, STOPWORDS, tokenize
+
+KINDS = ['Enums', 'Types', 'Tables', 'Views', 'Materialized Views', 'Functions']
+SQL_STOPWORDS = STOPWORDS | {
+    'create', 'replace', 'type', 'table', 'view', 'materialized', 'function', 'return', 'returns',
+    'language', 'sql', 'plpgsql', 'body', 'function_body', 'not', 'null', 'primary', 'foreign',
+    'unique', 'key', 'select', 'join', 'inner', 'left', 'outer', 'using', 'case', 'then', 'else',
+    'end', 'enum', 'integer', 'int', 'smallint', 'bigint', 'numeric', 'text', 'character',
+    'varying', 'boolean', 'timestamp', 'without', 'time', 'zone', 'date', 'uuid',
+}
+NAME = re.compile(
+    r'^CREATE (?:OR REPLACE )?(?:MATERIALIZED )?(?:TYPE|TABLE|VIEW|FUNCTION) ([^\s(]+)')
+PRIMARY_KEY = re.compile(r'PRIMARY KEY \((\w+)\)')
+FOREIGN_KEY = re.compile(r'FOREIGN KEY \((\w+)\)')
+
+Chunk = namedtuple('Chunk', ['schema', 'kind', 'name', 'sql', 'tokens'])
+
+
+class SchemaIndex:
+    '''
+    A lexical index over the objects of a schema snapshot, used to pick the
+    part of the schema relevant to a question.
+
+    Tables are linked into a join graph: a foreign key column points to the
+    tables whose single column primary key has the same name. Foreign key
+    targets are not part of the snapshot, so the graph relies on the naming
+    convention shared by most schemas (e.g. AdventureWorks).
+    '''
+
+    def __init__(self, snapshot, kinds=KINDS, name_boost=3):
+        self.snapshot = snapshot
+        self.chunks = []
+        for schema_name, entries in snapshot['schemas'].items():
+            for kind in kinds:
+                for sql in entries.get(kind, {}).get('items', []):
+                    m = NAME.match(sql)
+                    name = m.group(1) if m else f'{schema_name}.{len(self.chunks)}'
+                    tokens = tokenize(name) * name_boost + tokenize(sql, SQL_STOPWORDS)
+                    self.chunks.append(Chunk(schema_name, kind, name, sql, tokens))
+
+        self.bm25 = Bm25([c.tokens for c in self.chunks])
+        self.sizes = [utils.count_tokens(c.sql) for c in self.chunks]
+        self.full_size = utils.count_tokens(schema.render(snapshot))
+        self.neighbors = self._join_graph()
+
+    def select(self, question, top_k=8, max_tokens=3000):
+        '''
+        Select the objects relevant to a question: the top k matches, then the
+        tables they join with, then the types they use, as long as they fit
+        in the token budget.
+
+        Arguments:
+        question: The user's question.
+        top_k: Number of objects matched directly.
+        max_tokens: Token budget of the selected objects.
+
+        Returns a list of chunk indexes.
+        '''
+        ranked = self.bm25.search(tokenize(question))
+        scores = dict(ranked)
+        seeds = [i for i, _ in ranked[:top_k]]
+
+        candidates = list(seeds)
+        for i in seeds:
+            joined = sorted(self.neighbors.get(i, []), key=lambda j: -scores.get(j, 0))
+            candidates.extend(j for j in joined if j not in candidates)
+
+        selected = []
+        used = 0
+        for i in candidates:
+            if used + self.sizes[i] <= max_tokens:
+                selected.append(i)
+                used += self.sizes[i]
+
+        text = '\n'.join(self.chunks[i].sql for i in selected)
+        for i, chunk in enumerate(self.chunks):
+            if chunk.kind in ['Enums', 'Types'] and i not in selected and chunk.name in text \
+                    and used + self.sizes[i] <= max_tokens:
+                selected.append(i)
+                used += self.sizes[i]
+        return selected
+
+    def context(self, question, top_k=8, max_tokens=3000):
+        '''
+        Build the schema context for a question. The whole schema is used if it
+        fits in the token budget.
+
+        Returns a SQL string in the same layout as schema.render.
+        '''
+        if self.full_size <= max_tokens:
+            return schema.render(self.snapshot)
+
+        selected = set(self.select(question, top_k, max_tokens))
+        schemas = {}
+        for i, chunk in enumerate(self.chunks):
+            if i in selected:
+                kinds = schemas.setdefault(chunk.schema, {})
+                kinds.setdefault(chunk.kind, {'items': []})['items'].append(chunk.sql)
+        return schema.render({'schemas': schemas})
+
+    def _join_graph(self):
+        keys = {}
+        tables = []
+        for i, chunk in enumerate(self.chunks):
+            if chunk.kind != 'Tables':
+                continue
+            primary = PRIMARY_KEY.findall(chunk.sql)
+            if len(primary) == 1:
+                keys.setdefault(primary[0], []).append(i)
+            tables.append((i, set(FOREIGN_KEY.findall(chunk.sql))))
+
+        neighbors = {}
+        for i, foreign in tables:
+            for column in foreign:
+                for j in keys.get(column, []):
+                    if i != j:
+                        neighbors.setdefault(i, set()).add(j)
+                        neighbors.setdefault(j, set()).add(i)
+        return neighbors
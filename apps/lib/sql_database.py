@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from langchain import SQLDatabase
+from sqlalchemy.exc import SQLAlchemyError
+from lib import engines, jobs, metrics, schema
+from lib.schema_index import NAME
+from lib.utils import atomic_write
+
+SAMPLE_ROWS = 3
+# sample rows are refreshed in the background once they are older than this
+SAMPLES_MAX_AGE = 24 * 3600
+SAMPLE_VALUE_CHARS = 100
+
+
+class CachedSQLDatabase(SQLDatabase):
+    '''
+    A LangChain SQLDatabase whose table info comes from the schema snapshot of
+    lib.schema and sample rows saved in data/db/<db>.samples.json, instead of
+    reflecting the tables and selecting their first rows every time a chain
+    builds its prompt. Only `run` queries the database.
+
+    Sample rows older than `samples_max_age` seconds, or missing tables added
+    to the snapshot since, are loaded again by a background job of lib.jobs;
+    the old ones are used meanwhile. They're loaded in place the first time.
+
+    Arguments:
+    db_name: The name of the database. Its schema snapshot must exist.
+    engine: The engine running the queries, lib.engines.get(db_name) by default.
+    sample_rows_in_table_info: Number of sample rows per table, 0 for none.
+    samples_max_age: Max age of the sample rows in seconds.
+    '''
+
+    def __init__(self, db_name, engine=None, sample_rows_in_table_info=SAMPLE_ROWS,
+                 samples_max_age=SAMPLES_MAX_AGE):
+        # SQLDatabase.__init__ reflects every table, skip it
+        self._engine = engine or engines.get(db_name)
+        self._schema = None
+        self._sample_rows_in_table_info = sample_rows_in_table_info
+        self.db_name = db_name
+        self.samples_max_age = samples_max_age
+        self.tables = tables(schema.load_snapshot(db_name))
+        self._samples = None
+        self._info = {}
+        self._info_samples = None
+        self._lock = threading.Lock()
+
+    def get_usable_table_names(self):
+        return list(self.tables)
+
+    @metrics.timed('schema.table_info')
+    def get_table_info(self, table_names=None):
+        if table_names is None:
+            table_names = list(self.tables)
+        missing = set(table_names).difference(self.tables)
+        if missing:
+            raise ValueError(f'table_names {missing} not found in database')
+
+        samples = self.samples()
+        with self._lock:
+            if self._info_samples is not samples:
+                self._info = {}
+                self._info_samples = samples
+            for name in table_names:
+                if name not in self._info:
+                    self._info[name] = self._table_info(name, samples['tables'].get(name))
+            return '\n\n'.join(self._info[name] for name in table_names)
+
+    def samples(self):
+        '''
+        Returns the saved sample rows, loading them first if there are none,
+        and queueing a refresh if they are stale.
+        '''
+        if not self._sample_rows_in_table_info:
+            return {'created_at': None, 'rows': 0, 'tables': {}}
+
+        path = samples_path(self.db_name)
+        with self._lock:
+            samples = self._samples
+        if samples is not None and _mtime(path) > samples['loaded_at']:
+            # refreshed by a job since
+            samples = None
+        if samples is None and os.path.exists(path):
+            samples = load_samples(self.db_name)
+
+        if samples is None or samples['rows'] < self._sample_rows_in_table_info:
+            samples = refresh_samples(self.db_name, self._sample_rows_in_table_info, self._engine)
+        elif time.time() - samples['created_at'] > self.samples_max_age \
+                or not set(self.tables) <= set(samples['tables']):
+            jobs.default().submit(f'samples:{self.db_name}', _refresh_job, self.db_name,
+                                  self._sample_rows_in_table_info)
+
+        with self._lock:
+            self._samples = samples
+        return samples
+
+    def _table_info(self, name, sample):
+        create_table = self.tables[name]
+        if not self._sample_rows_in_table_info or sample is None:
+            return create_table
+        rows = '\n'.join('\t'.join(row) for row in sample['rows'][:self._sample_rows_in_table_info])
+        return (f'{create_table}\n'
+                f'/*\n'
+                f'{self._sample_rows_in_table_info} rows from {name} table:\n'
+                f'{chr(9).join(sample["columns"])}\n'
+                f'{rows}\n'
+                f'*/')
+
+
+def tables(snapshot):
+    '''
+    Returns the CREATE TABLE statements of a schema snapshot, as a dict of
+    {"schema.table": sql}.
+    '''
+    result = {}
+    for entries in snapshot['schemas'].values():
+        for sql in entries.get('Tables', {}).get('items', []):
+            m = NAME.match(sql)
+            if m:
+                result[m.group(1)] = sql
+    return result
+
+
+@metrics.timed('schema.samples')
+def refresh_samples(db_name, rows=SAMPLE_ROWS, engine=None, job=None):
+    '''
+    Load the first rows of every table in the schema snapshot of a database,
+    and save them.
+
+    Arguments:
+    db_name: The name of the database.
+    rows: Number of rows per table.
+    engine: The engine to use, lib.engines.get(db_name) by default.
+    job: A lib.jobs.Job handle to report progress to, or None.
+
+    Returns the samples: {"tables": {table: {"columns", "rows"}}} with the
+    values of the rows as strings, None for tables that can't be read.
+    '''
+    names = list(tables(schema.load_snapshot(db_name)))
+    samples = {'created_at': time.time(), 'rows': rows, 'tables': {}}
+    with (engine or engines.get(db_name)).connect() as con:
+        for i, name in enumerate(names):
+            sample = None
+            try:
+                with con.begin():
+                    result = con.execute(f'SELECT * FROM {_quote(name)} LIMIT {int(rows)}')
+                    sample = {
+                        'columns': list(result.keys()),
+                        'rows': [[str(value)[:SAMPLE_VALUE_CHARS] for value in row] for row in result],
+                    }
+            except SQLAlchemyError:
+                # e.g. no privilege on the table
+                pass
+            samples['tables'][name] = sample
+            if job is not None:
+                job.progress(i + 1, len(names))
+    save_samples(db_name, samples)
+    samples['loaded_at'] = time.time()
+    return samples
+
+
+def load_samples(db_name):
+    loaded_at = time.time()
+    with open(samples_path(db_name)) as f:
+        samples = json.load(f)
+    samples['loaded_at'] = loaded_at
+    return samples
+
+
+def save_samples(db_name, samples):
+    with atomic_write(samples_path(db_name)) as f:
+        json.dump(samples, f)
+
+
+def samples_path(db_name):
+    return f'data/db/{db_name}.samples.json'
+
+
+def _refresh_job(job, db_name, rows):
+    return len(refresh_samples(db_name, rows, job=job)['tables'])
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _quote(name):
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in name.split('.', 1))
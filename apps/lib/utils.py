@@ -1,6 +1,88 @@
+import ast
+import json
+import os
+import re
 import sqlparse
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 
 def format_sql(sql):
     statements = sqlparse.split(sql)
     return '\n'.join([sqlparse.format(s, reindent=True, keyword_case='upper') for s in statements])
+
+
+def parse_json_reply(text):
+    '''
+    Parse the JSON object of a model reply, repairing common mistakes: text or
+    code fences around the object, trailing commas and Python literals.
+
+    Returns a dict. Raises ValueError if no object can be read.
+    '''
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError(f'No JSON object in reply: {text!r}')
+
+    body = text[start:end + 1]
+    candidates = [body, re.sub(r',\s*([}\]])', r'\1', body)]
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate, strict=False)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    try:
+        value = ast.literal_eval(candidates[-1])
+        if isinstance(value, dict):
+            return value
+    except (ValueError, SyntaxError):
+        pass
+    raise ValueError(f'Malformed JSON object in reply: {text!r}')
+
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    '''
+    Count the tokens of a text for a model. Falls back to an estimate of
+    4 characters per token if tiktoken is not installed.
+    '''
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    return len(_encoding(model).encode(text))
+
+
+@contextmanager
+def atomic_path(path):
+    '''
+    Yields a temporary path next to `path`, and renames it to `path` if the
+    block succeeds. Readers see either the old file or the complete new one.
+    '''
+    tmp = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Open a file for writing through `atomic_path`.
+    '''
+    with atomic_path(path) as tmp:
+        with open(tmp, mode) as f:
+            yield f
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    return tiktoken.encoding_for_model(model)
@@ -1,45 +1,525 @@
-import faiss
+import json
+import math
+import mmap
+import numpy as np
 import os
 import pickle
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import FAISS
+import shutil
+import threading
+import time
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+from lib import embeddings, loader, metrics
+from lib.bm25 import Bm25, tokenize
+from lib.chunker import Chunker
+from lib.utils import atomic_path, atomic_write
+
+FORMAT_VERSION = 1
+# compression of the FAISS index: float16 or int8 scalar quantization, or
+# product quantization in inverted lists, against 4 bytes per dimension
+SCALAR = {'fp16': 'QT_fp16', 'sq8': 'QT_8bit'}
+COMPRESSIONS = [None, *SCALAR, 'ivfpq']
+# product quantizers need enough vectors to train, smaller databases use sq8
+IVFPQ_MIN_VECTORS = 10000
 
 
 class Vdb:
-    def __init__(self, base_path, name, separator=' ', chunk_size=1500, chunk_overlap=0):
+    '''
+    A vector database of a text, stored as four files:
+    - <name>.faiss: the FAISS index, memory-mapped on load
+    - <name>.chunks: the UTF-8 texts of all chunks, read on demand
+    - <name>.bm25.json: a BM25 index of the chunks, for lexical search
+    - <name>.json: chunk offsets, metadata and settings
+
+    With `compression`, the index holds compressed vectors ("fp16", "sq8" or
+    "ivfpq"), and the float32 vectors are kept in <name>.vectors, memory-mapped
+    on load: searches take `rerank` candidates from the index, and re-rank
+    them by their exact distance.
+
+    Databases built in the legacy format (<name>.idx plus a pickled LangChain
+    store in <name>.pkl) are migrated on load.
+
+    While building, embedded chunks are appended to <name>.partial/, so an
+    interrupted build of a PDF resumes after the last embedded page.
+
+    Texts are split by lib.chunker.Chunker: along headings and paragraphs, cut
+    at `separator` when needed, with repeated headers and footers removed and
+    chunks with a MinHash similarity of `dedup` or more to an earlier one
+    dropped before they are embedded. The texts of the embedded pages are
+    logged in <name>.partial/ too, and a resumed build splits them again, so
+    it strips and drops what a build without the interruption would.
+    '''
+
+    def __init__(self, base_path, name, separator=' ', chunk_size=1500, chunk_overlap=150,
+                 embeddings=None, embed_batch=256, compression=None, rerank=50, nprobe=16, dedup=0.8):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression: {compression}')
         self.base_path = base_path
         self.name = name
         self.separator = separator
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.embeddings = embeddings
+        self.embed_batch = embed_batch
+        self.compression = compression
+        self.rerank = rerank
+        self.nprobe = nprobe
+        self.dedup = dedup
+        self.stats = {}
+
+    def faiss_name(self):
+        return f'{self.base_path}/{self.name}.faiss'
+
+    def chunks_name(self):
+        return f'{self.base_path}/{self.name}.chunks'
+
+    def meta_name(self):
+        return f'{self.base_path}/{self.name}.json'
 
     def index_name(self):
         return f'{self.base_path}/{self.name}.idx'
 
+    def pickle_name(self):
+        return f'{self.base_path}/{self.name}.pkl'
+
+    def bm25_name(self):
+        return f'{self.base_path}/{self.name}.bm25.json'
+
+    def vectors_name(self):
+        return f'{self.base_path}/{self.name}.vectors'
+
+    def partial_name(self):
+        return f'{self.base_path}/{self.name}.partial'
+
+    def files(self):
+        '''
+        Returns the paths of the files of the database, built, legacy or partial.
+        '''
+        return [self.faiss_name(), self.chunks_name(), self.meta_name(), self.bm25_name(), self.vectors_name(),
+                self.index_name(), self.pickle_name(), self.partial_name()]
+
     def exists(self):
+        return self.built() or self.legacy()
+
+    def built(self):
+        return all(os.path.exists(p) for p in [self.faiss_name(), self.chunks_name(), self.meta_name()])
+
+    def legacy(self):
         return os.path.exists(self.index_name()) and os.path.exists(self.pickle_name())
 
-    def pickle_name(self):
-        return f'{self.base_path}/{self.name}.pkl'
+    def chunker(self):
+        return Chunker(self.chunk_size, self.chunk_overlap, self.separator, self.dedup)
 
-    def build(self, data):
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
-        docs = []
+    def split(self, data):
+        '''
+        Split a text, or the page contents of documents, into chunks.
+        '''
+        chunker = self.chunker()
         if isinstance(data, str):
-            docs = splitter.split_text(data)
-        else:
-            docs = [t.page_content for t in splitter.split_documents(data)]
+            return chunker.split(data)
+        return [t for doc in data for t in chunker.split(doc.page_content)]
+
+    def rename(self, name):
+        '''
+        Move the files of the database to another name.
+        '''
+        target = Vdb(self.base_path, name)
+        for path, new_path in zip(self.files(), target.files()):
+            if os.path.exists(path):
+                os.replace(path, new_path)
+        self.name = name
+
+    def remove(self):
+        for path in self.files():
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def build(self, data, progress=None):
+        '''
+        Build the database from a text or an iterable of documents. Documents
+        are split and embedded as they come, so a generator is never held in
+        memory at once.
+
+        Arguments:
+        data: A text, or an iterable of documents.
+        progress: Called with the number of documents done.
+        '''
+        if isinstance(data, str):
+            data = [Document(page_content=data)]
+        self._build(data, 0, progress)
+
+    def ingest(self, filename, workers=None, progress=None):
+        '''
+        Build the database of a PDF, extracting its pages in a process pool and
+        streaming them into the splitter and the embedder. If an earlier build
+        was interrupted, resume after its last embedded page.
+
+        Arguments:
+        filename: The PDF file.
+        workers: Number of processes extracting pages.
+        progress: Called with (pages done, total pages).
+        '''
+        with metrics.span('vdb.ingest'):
+            total = loader.page_count(filename)
+            start = self._resume()
+            pages = loader.pages(filename, start=start, workers=workers)
+            self._build(pages, start, progress and (lambda done: progress(done, total)))
+        metrics.count('pdf.pages', total - start)
+
+    def _build(self, docs, start, progress):
+        began = time.perf_counter()
+        path = self.partial_name()
+        if not start:
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+        embedder = self._embeddings()
+        chunker = self.chunker()
+        if start:
+            self._remember(chunker)
+        totals = {'chunks': 0, 'cache_hits': 0, 'embedded': 0}
+        done = start
+        with open(f'{path}/vectors', 'ab') as vectors, open(f'{path}/chunks', 'ab') as chunks, \
+                open(f'{path}/pages.jsonl', 'a') as log:
+            def flush(batch):
+                texts = [t for _, split in batch for t in split]
+                if texts:
+                    embedded = np.array(embedder.embed_documents(texts), dtype=np.float32)
+                    for key in totals:
+                        totals[key] += getattr(embedder, 'stats', {}).get(key, 0)
+                    vectors.write(embedded.tobytes())
+                    for text in texts:
+                        chunks.write(text.encode('utf-8'))
+                    vectors.flush()
+                    chunks.flush()
+                # a page is only logged once its chunks and vectors are written
+                for doc, split in batch:
+                    log.write(json.dumps({
+                        'text': doc.page_content,
+                        'lengths': [len(t.encode('utf-8')) for t in split],
+                        'metadata': doc.metadata,
+                        'dimension': embedded.shape[1] if texts else None,
+                    }) + '\n')
+                log.flush()
+
+            batch = []
+            size = 0
+            for doc in docs:
+                split = chunker.split(doc.page_content)
+                batch.append((doc, split))
+                size += len(split)
+                if size >= self.embed_batch:
+                    flush(batch)
+                    done += len(batch)
+                    batch, size = [], 0
+                    if progress:
+                        progress(done)
+            flush(batch)
+            done += len(batch)
+            if progress:
+                progress(done)
+
+        self._finish()
+        elapsed = time.perf_counter() - began
+        self.stats = {
+            **totals,
+            'duplicates': chunker.stats['duplicates'],
+            'boilerplate_lines': chunker.stats['boilerplate_lines'],
+            'pages': done - start,
+            'seconds': round(elapsed, 3),
+            'chunks_per_second': round(totals['chunks'] / elapsed, 1) if elapsed > 0 else 0.0,
+            'hit_rate': round(totals['cache_hits'] / totals['chunks'], 3) if totals['chunks'] else 0.0,
+        }
+
+    def _records(self):
+        '''
+        Returns the pages logged by an interrupted build, and the byte size of
+        the complete lines of the log.
+        '''
+        records = []
+        size = 0
+        try:
+            with open(f'{self.partial_name()}/pages.jsonl', 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    records.append(json.loads(line))
+                    size += len(line)
+        except FileNotFoundError:
+            pass
+        return records, size
+
+    def _remember(self, chunker):
+        '''
+        Split the pages of an interrupted build again, for the headers, footers
+        and duplicates the chunker strips and drops from the next pages.
+        '''
+        records, _ = self._records()
+        with open(f'{self.partial_name()}/chunks', 'rb') as f:
+            for r in records:
+                texts = [f.read(n).decode('utf-8') for n in r['lengths']]
+                if 'text' in r:
+                    chunker.split(r['text'])
+                else:
+                    # logged without its text by an earlier version
+                    for text in texts:
+                        chunker.remember(text)
+        # the stats are of the pages of this build
+        chunker.stats = {key: 0 for key in chunker.stats}
 
-        store = FAISS.from_texts(docs, OpenAIEmbeddings())
-        faiss.write_index(store.index, self.index_name())
-        store.index = None
-        with open(self.pickle_name(), 'wb') as f:
-            pickle.dump(store, f)
+    def _resume(self):
+        '''
+        Truncate the files of an interrupted build to its last logged page, and
+        returns the number of pages to skip.
+        '''
+        records, size = self._records()
+        if not records:
+            return 0
+        path = self.partial_name()
+        dimension = next((r['dimension'] for r in records if r['dimension']), 0)
+        lengths = [n for r in records for n in r['lengths']]
+        os.truncate(f'{path}/pages.jsonl', size)
+        os.truncate(f'{path}/chunks', sum(lengths))
+        os.truncate(f'{path}/vectors', len(lengths) * dimension * 4)
+        return len(records)
 
+    def _finish(self):
+        path = self.partial_name()
+        records, _ = self._records()
+        metadatas = [r['metadata'] for r in records for _ in r['lengths']]
+        dimension = next((r['dimension'] for r in records if r['dimension']), None)
+        if not dimension:
+            shutil.rmtree(path)
+            raise ValueError(f'No text found for {self.name}')
+
+        vectors = np.fromfile(f'{path}/vectors', dtype=np.float32).reshape(-1, dimension)
+        index, compression = self._index(vectors)
+        del vectors
+        offsets = [0]
+        for r in records:
+            for n in r['lengths']:
+                offsets.append(offsets[-1] + n)
+        os.replace(f'{path}/chunks', self.chunks_name())
+        if compression:
+            os.replace(f'{path}/vectors', self.vectors_name())
+        elif os.path.exists(self.vectors_name()):
+            os.remove(self.vectors_name())
+        self._write_index(index, offsets, metadatas, compression)
+        shutil.rmtree(path)
+
+    def _index(self, vectors):
+        '''
+        Returns a FAISS index of vectors, and the compression it uses.
+        '''
+        import faiss
+
+        n, dimension = vectors.shape
+        compression = self.compression
+        if compression == 'ivfpq' and n < IVFPQ_MIN_VECTORS:
+            compression = 'sq8'
+
+        if compression is None:
+            index = faiss.IndexFlatL2(dimension)
+        elif compression in SCALAR:
+            index = faiss.IndexScalarQuantizer(dimension, getattr(faiss.ScalarQuantizer, SCALAR[compression]))
+        else:
+            # 8 bit codes of 16 dimensions each, e.g. 96 bytes for 1536 dimensions
+            m = next(m for m in range(max(1, dimension // 16), 0, -1) if dimension % m == 0)
+            nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, nlist, m, 8)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        return index, compression
+
+    @metrics.timed('vdb.load')
     def load(self):
+        if not self.built() and self.legacy():
+            self.migrate()
+
+        with open(self.meta_name()) as f:
+            meta = json.load(f)
+        if not os.path.exists(self.bm25_name()):
+            self._write_bm25(meta['offsets'])
+        import faiss
+
+        index = faiss.read_index(self.faiss_name(), mmap_flags())
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+        vectors = None
+        if meta.get('compression') and meta['count']:
+            vectors = np.memmap(self.vectors_name(), dtype=np.float32, mode='r',
+                                shape=(meta['count'], meta['dimension']))
+        # the BM25 index is only read on the first lexical search
+        return MmapStore(index, self.chunks_name(), meta['offsets'], meta['metadatas'],
+                         self._embeddings().embed_query, bm25_path=self.bm25_name(), vectors=vectors,
+                         rerank=self.rerank)
+
+    def migrate(self):
+        '''
+        Convert a legacy database (FAISS index plus pickled LangChain store) to
+        the current format, then remove the legacy files. Only migrate files
+        you created: unpickling runs arbitrary code.
+        '''
+        import faiss
+
         with open(self.pickle_name(), 'rb') as f:
             store = pickle.load(f)
-        store.index = faiss.read_index(self.index_name())
-        return store
+        index = faiss.read_index(self.index_name())
+        docs = [store.docstore.search(store.index_to_docstore_id[i]) for i in range(index.ntotal)]
+        self._write(index, [d.page_content for d in docs], [d.metadata for d in docs])
+        os.remove(self.pickle_name())
+        os.remove(self.index_name())
+
+    def _embeddings(self):
+        if self.embeddings is None:
+            self.embeddings = embeddings.default()
+        return self.embeddings
+
+    def _write(self, index, texts, metadatas=None):
+        offsets = [0]
+        with atomic_write(self.chunks_name(), 'wb') as f:
+            for text in texts:
+                data = text.encode('utf-8')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        self._write_index(index, offsets, metadatas or [{} for _ in texts])
+
+    def _write_index(self, index, offsets, metadatas, compression=None):
+        import faiss
+
+        with atomic_path(self.faiss_name()) as tmp:
+            faiss.write_index(index, tmp)
+        self._write_bm25(offsets)
+        meta = {
+            'version': FORMAT_VERSION,
+            'count': len(offsets) - 1,
+            'dimension': index.d,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'separator': self.separator,
+            'dedup': self.dedup,
+            'compression': compression,
+            'offsets': offsets,
+            'metadatas': metadatas,
+        }
+        # written last: a database is only complete once its meta file exists
+        with atomic_write(self.meta_name()) as f:
+            json.dump(meta, f)
+
+    def _write_bm25(self, offsets):
+        docs = []
+        with open(self.chunks_name(), 'rb') as f:
+            for start, end in zip(offsets, offsets[1:]):
+                docs.append(tokenize(f.read(end - start).decode('utf-8')))
+        # partial matches scan the whole vocabulary, too slow for free text
+        with atomic_write(self.bm25_name()) as f:
+            json.dump(Bm25(docs, partial_weight=0).to_dict(), f)
+
+
+class MmapStore(VectorStore):
+    '''
+    A read-only LangChain vector store over a memory-mapped FAISS index and
+    a chunk file. Chunk texts are only read for search results, and all
+    processes loading the same files share their pages through the OS cache.
+
+    If the index is compressed, `vectors` holds the float32 vectors (e.g. a
+    memory-mapped array): searches take `rerank` candidates from the index and
+    return the nearest by exact distance.
+    '''
+
+    def __init__(self, index, chunks_path, offsets, metadatas, embedding_function, bm25=None,
+                 bm25_path=None, vectors=None, rerank=50):
+        self.index = index
+        self.offsets = offsets
+        self.metadatas = metadatas
+        self.embedding_function = embedding_function
+        self.vectors = vectors
+        self.rerank = rerank
+        self.bm25_path = bm25_path
+        self._bm25 = bm25
+        self._lock = threading.Lock()
+        self._chunks = None
+        if offsets[-1] > 0:
+            with open(chunks_path, 'rb') as f:
+                self._chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def bm25(self):
+        '''
+        The BM25 index of the chunks, read from `bm25_path` on first use.
+        '''
+        if self._bm25 is None and self.bm25_path:
+            with self._lock:
+                if self._bm25 is None:
+                    with open(self.bm25_path) as f:
+                        self._bm25 = Bm25.from_dict(json.load(f))
+        return self._bm25
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, i):
+        return self._chunks[self.offsets[i]:self.offsets[i + 1]].decode('utf-8') if self._chunks else ''
+
+    def document(self, i):
+        return Document(page_content=self.text(i), metadata=self.metadatas[i])
+
+    def nearest(self, embedding, k=4):
+        '''
+        Returns the indices of the k chunks nearest to an embedding and their
+        squared L2 distances, nearest first.
+        '''
+        query = np.array([embedding], dtype=np.float32)
+        if self.vectors is None:
+            scores, indices = self.index.search(query, k)
+            found = indices[0] != -1
+            return indices[0][found], scores[0][found]
+
+        _, indices = self.index.search(query, max(k, self.rerank))
+        indices = indices[0][indices[0] != -1]
+        # reading the candidates in file order is kinder to the page cache
+        indices = np.sort(indices)
+        scores = ((self.vectors[indices] - query) ** 2).sum(axis=1)
+        order = np.argsort(scores, kind='stable')[:k]
+        return indices[order], scores[order]
+
+    def vector(self, i):
+        '''
+        Returns the float32 vector of chunk i.
+        '''
+        if self.vectors is not None:
+            return np.array(self.vectors[i])
+        return self.index.reconstruct(int(i))
+
+    @metrics.timed('vdb.search')
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        indices, scores = self.nearest(embedding, k)
+        return [(self.document(int(i)), score) for i, score in zip(indices, scores)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.similarity_search_with_score_by_vector(self.embedding_function(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_function(query), k)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError('MmapStore is read-only, rebuild the Vdb instead')
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError('Use Vdb.build to create a MmapStore')
+
+
+def mmap_flags():
+    import faiss
+
+    # IO_FLAG_MMAP_IFC maps the codes of flat indexes, and needs faiss >= 1.9
+    # (see requirements.txt); older versions only map the inverted lists of
+    # IVF indexes and read flat indexes into memory
+    return getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
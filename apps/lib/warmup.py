@@ -0,0 +1,115 @@
+import importlib
+import os
+import threading
+import time
+from lib import engines, metrics, schema
+
+# heavy modules imported on first use by each app, preloaded by a warm-up
+MODULES = {
+    'db': ['pandas', 'psycopg2'],
+    'pdf': ['faiss', 'langchain.chains', 'pdfminer.pdfinterp'],
+}
+
+_cache = {}
+_lock = threading.Lock()
+_started = None
+
+
+def schema_index(db_name):
+    '''
+    Returns the SchemaIndex of the saved snapshot of a database, shared by all
+    sessions of the process. It's rebuilt when the snapshot file changes.
+    '''
+    from lib.schema_index import SchemaIndex
+
+    return _cached(('schema', db_name), schema.snapshot_path(db_name),
+                   lambda: SchemaIndex(schema.load_snapshot(db_name)))
+
+
+def schema_model(db_name):
+    '''
+    Returns the lib.schema_compact model of a database, shared by all sessions
+    of the process, or None if it has none.
+    '''
+    from lib import schema_compact
+
+    if not schema_compact.exists(db_name):
+        return None
+    return _cached(('schema_model', db_name), schema_compact.model_path(db_name),
+                   lambda: schema_compact.load(db_name))
+
+
+def store(base_path, name):
+    '''
+    Returns the loaded vector store of a Vdb, shared by all sessions of the
+    process. It's reloaded when the Vdb is rebuilt.
+    '''
+    from lib.vdb import Vdb
+
+    vdb = Vdb(base_path, name)
+    if not vdb.built() and vdb.legacy():
+        vdb.migrate()
+    return _cached(('vdb', base_path, name), vdb.meta_name(), vdb.load)
+
+
+def run(dbs=(), pdfs=(), pdf_path='data/pdf', modules=()):
+    '''
+    Preload shared resources: import heavy modules, open a connection of each
+    database, and load its schema index and the vector stores of PDFs.
+
+    Arguments:
+    dbs: Database names.
+    pdfs: Names of PDFs with a vector database under `pdf_path`.
+    modules: Names of modules to import.
+
+    Returns a dict of {resource: ms or error}.
+    '''
+    timings = {}
+
+    def step(name, fn):
+        start = time.perf_counter()
+        try:
+            with metrics.span('warmup'):
+                fn()
+            timings[name] = round((time.perf_counter() - start) * 1000, 2)
+        except Exception as e:
+            timings[name] = f'{type(e).__name__}: {e}'
+
+    for module in modules:
+        step(f'import:{module}', lambda: importlib.import_module(module))
+    for db_name in dbs:
+        step(f'engine:{db_name}', lambda: engines.get(db_name).connect().close())
+        if schema.snapshot_exists(db_name):
+            step(f'schema:{db_name}', lambda: schema_index(db_name))
+    if pdfs:
+        from lib.vdb import Vdb
+    for name in pdfs:
+        if Vdb(pdf_path, name).exists():
+            step(f'vdb:{name}', lambda: store(pdf_path, name))
+    return timings
+
+
+def start(**kwargs):
+    '''
+    Run the warm-up once per process in a background thread, so the first page
+    isn't blocked by it. Takes the arguments of `run`; later calls are ignored.
+    '''
+    global _started
+    with _lock:
+        if _started is None:
+            _started = {}
+            threading.Thread(target=lambda: _started.update(run(**kwargs)), name='warmup',
+                             daemon=True).start()
+    return _started
+
+
+def _cached(key, path, load):
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        entry = _cache.get(key)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    value = load()
+    with _lock:
+        _cache[key] = (mtime, value)
+    return value
@@ -1,13 +1,29 @@
 import os
 import streamlit as st
-from langchain.chat_models import ChatOpenAI
+import time
 from langchain.chains import ChatVectorDBChain
+from lib.corpus import Corpus
+from lib.langchain_llm import ClientLlm
+from lib.memory import ConversationMemory
+from lib.pdf_store import PdfStore
+from lib.retrieval import HybridRetriever
 from lib.vdb import Vdb
-from lib import loader
+from lib import jobs, llm, metrics, warmup
 from pathlib import Path
 
 
 PDF_PATH = 'data/pdf'
+JOB_POLL_INTERVAL = 1
+# token budget of the chunks sent to the LLM for a question
+RETRIEVAL_MAX_TOKENS = 1500
+# token budget of the conversation history used to condense follow-up questions
+HISTORY_MAX_TOKENS = 1000
+# compression of new vector databases: None (float32), "fp16", "sq8" or "ivfpq"
+VDB_COMPRESSION = os.environ.get('VDB_COMPRESSION') or None
+# show the stage timings of the last request and the metrics in the sidebar
+DEBUG_PANEL = os.environ.get('DEBUG_PANEL') == '1'
+# preload the vector databases and heavy modules when the process starts
+WARMUP = os.environ.get('WARMUP') == '1'
 
 
 def app():
@@ -23,56 +39,110 @@ def app():
     if "history" not in st.session_state:
         st.session_state["history"] = []
 
+    if 'memory' not in st.session_state:
+        st.session_state['memory'] = ConversationMemory(llm.default(), max_tokens=HISTORY_MAX_TOKENS)
+
+    if 'vdb_job' not in st.session_state:
+        st.session_state['vdb_job'] = None
+
     with st.sidebar.expander(label='PDF Setting'):
         uploaded = st.file_uploader('Upload your PDF file', type=['pdf'])
         if uploaded is not None:
-            data = uploaded.getvalue()
-            with open(f'{PDF_PATH}/{uploaded.name}', 'wb') as f:
-                f.write(data)
-
-        pdf_names = [Path(f).stem for f in os.listdir(
-            PDF_PATH) if f.endswith('.pdf')]
-        name = st.selectbox('Select PDF file', pdf_names)
-
-        vdb = Vdb(PDF_PATH, name)
-        if st.button('Generate Vector DB'):
-            if not vdb.exists():
-                data = loader.pdf(f'{PDF_PATH}/{name}.pdf')
-                vdb.build(data)
-                st.write(f'Vector database for {name}.pdf generated')
-
-            st.session_state['name'] = name
-            st.session_state['vdb'] = vdb.load()
-            st.session_state["history"] = []
-
-        if name != st.session_state['name']:
+            upload_name = Path(uploaded.name).stem
+            previous = pdf_store().key(upload_name)
+            if pdf_store().add(upload_name, uploaded.getvalue()) != previous and previous is not None:
+                # the name now refers to another file: its document stays in the
+                # corpus under another name of the same file, if there is one
+                others = [n for n, k in pdf_store().names().items() if k == previous]
+                if others:
+                    corpus().rename_document(upload_name, others[0])
+                else:
+                    corpus().remove_document(upload_name)
+                if st.session_state['name'] == upload_name:
+                    st.session_state['name'] = None
+                    st.session_state['vdb'] = None
+
+        names = pdf_store().names()
+        name = st.selectbox('Select PDF file', list(names))
+        key = names.get(name)
+
+        vdb = Vdb(PDF_PATH, key)
+        target = f'vdb:{key}'
+        if st.button('Generate Vector DB') and key:
             if vdb.exists():
+                load(name)
+            else:
+                jobs.default().submit(target, build, key)
+                st.session_state['vdb_job'] = target
+
+        if st.session_state['vdb_job'] == target:
+            status = jobs.default().status(target)
+            if status['state'] in jobs.ACTIVE:
+                st.write(f'Generating vector database for {name}.pdf...')
+                st.progress(status['done'] / (status['total'] or 1))
+            else:
+                st.session_state['vdb_job'] = None
+                if status['state'] == 'failed':
+                    st.error(status['error'])
+                else:
+                    st.write(f'Vector database for {name}.pdf generated')
+                    stats = status['result']
+                    if stats:
+                        st.write(f"{stats['pages']} pages, {stats['chunks']} chunks in {stats['seconds']}s, "
+                                 f"{stats['hit_rate']:.0%} from cache")
+                    load(name)
+        elif name != st.session_state['name']:
+            if key and vdb.exists():
                 st.session_state['name'] = name
-                st.session_state['vdb'] = vdb.load()
+                st.session_state['vdb'] = warmup.store(PDF_PATH, key)
                 st.session_state["history"] = []
+                st.session_state['memory'].clear()
+
+    with st.sidebar.expander(label='Corpus'):
+        search_all = st.checkbox('Ask across all documents')
+        documents = st.multiselect('Limit to documents', list(corpus().documents()))
+        if st.button('Remove from corpus'):
+            corpus().remove_document(name)
+
+    chat_llm = ClientLlm(client=llm.default(), temperature=0)
+    if search_all:
+        if not len(corpus()):
+            st.write('The corpus is empty. Please "Generate Vector DB" for some PDFs first')
+            return
+
+        chain = ChatVectorDBChain.from_llm(
+            llm=chat_llm, vectorstore=corpus(), search_kwargs={'documents': documents or None})
+        st.write(f'Corpus of {len(corpus().documents())} documents loaded')
+    else:
+        if not st.session_state['vdb']:
+            st.session_state['name'] = name
+            st.write(
+                f'Vector database for {name}.pdf not loaded. Please "Generate Vector DB" first')
+            return
 
-    if not st.session_state['vdb']:
-        st.session_state['name'] = name
-        st.write(
-            f'Vector database for {name}.pdf not loaded. Please "Generate Vector DB" first')
-        return
-
-    chain = ChatVectorDBChain.from_llm(llm=ChatOpenAI(
-        temperature=0, model_name='gpt-3.5-turbo'), vectorstore=st.session_state['vdb'])
-    st.write(f'Vector database for {name}.pdf loaded')
+        retriever = HybridRetriever(st.session_state['vdb'], max_tokens=RETRIEVAL_MAX_TOKENS)
+        chain = ChatVectorDBChain.from_llm(llm=chat_llm, vectorstore=retriever)
+        st.write(f'Vector database for {name}.pdf loaded')
 
     input = st.text_area('Please ask questions for the PDF',  key='input')
     if st.button('Ask'):
-        with st.spinner('Thinking super hard...'):
-            result = chain(
-                {'question': input, 'chat_history': st.session_state["history"]})
+        c = st.container()
+        c.write(f'### Q: {input}')
+        placeholder = c.empty()
+        chat_llm.on_text = placeholder.write
+        with st.spinner('Thinking super hard...'), metrics.trace('pdf.request'):
+            # the question is condensed with the bounded memory, not the whole history
+            with metrics.span('pdf.condense'):
+                question = st.session_state['memory'].standalone(input)
+            with metrics.span('pdf.chain'):
+                result = chain({'question': question, 'chat_history': []})
             output = result["answer"]
+            placeholder.write(output)
 
-            c = st.container()
-            c.write(f'### Q: {input}')
-            c.write(output)
-
+            st.session_state['memory'].add(input, output)
             st.session_state["history"].append((input, output))
+            if len(st.session_state["history"]) > 5:
+                st.session_state["history"].pop(0)
 
     with st.sidebar.expander(label='History'):
         if st.session_state["history"]:
@@ -83,6 +153,69 @@ def app():
                 c.write(q)
                 c.write(a)
 
+    if DEBUG_PANEL:
+        show_metrics()
+
+
+def show_metrics():
+    with st.sidebar.expander(label='Metrics'):
+        trace = metrics.registry.last()
+        if trace is not None:
+            st.write(f'Last request: {trace.ms} ms')
+            st.dataframe(trace.breakdown())
+        st.json(metrics.registry.summary())
+        st.download_button('Prometheus', metrics.registry.prometheus(), file_name='metrics.txt')
+        st.download_button('Traces', metrics.registry.jsonl(), file_name='traces.jsonl')
+
+
+def build(job, key):
+    vdb = Vdb(PDF_PATH, key, compression=VDB_COMPRESSION)
+    vdb.ingest(pdf_store().filename(key), progress=job.progress)
+    return vdb.stats
+
+
+def load(name):
+    key = pdf_store().key(name)
+    st.session_state['name'] = name
+    st.session_state['vdb'] = warmup.store(PDF_PATH, key)
+    st.session_state["history"] = []
+    st.session_state['memory'].clear()
+    # the same file uploaded under several names is added once
+    documents = corpus().documents()
+    if name not in documents and not any(pdf_store().key(d) == key for d in documents):
+        jobs.default().submit(f'corpus:{key}', add_to_corpus, corpus(), name, st.session_state['vdb'])
+
+
+def add_to_corpus(job, corpus, name, store):
+    corpus.add_document(name, [store.text(i) for i in range(len(store))], store.metadatas)
+    return {'chunks': len(store)}
+
+
+def poll_jobs():
+    '''
+    Rerun the script while a job started by this session runs, to show its
+    progress without blocking the session.
+    '''
+    if st.session_state.get('vdb_job'):
+        time.sleep(JOB_POLL_INTERVAL)
+        st.experimental_rerun()
+
+
+@st.cache_resource
+def corpus():
+    return Corpus(f'{PDF_PATH}/corpus')
+
+
+@st.cache_resource
+def pdf_store():
+    store = PdfStore(PDF_PATH)
+    store.migrate()
+    return store
+
 
 if __name__ == "__main__":
+    if WARMUP:
+        warmup.start(pdfs=sorted(set(pdf_store().names().values())), pdf_path=PDF_PATH,
+                     modules=warmup.MODULES['pdf'])
     app()
+    poll_jobs()
@@ -0,0 +1,423 @@
+'''
+A headless HTTP API of dbot and the PDF helper, to call them from other
+services and run several worker processes behind a load balancer.
+
+Endpoints, JSON in and out:
+  POST /sql      {"db", "question", "execute": false, "max_rows": 100}
+  POST /pdf/ask  {"name", "question", "history": [[question, answer], ...]}
+  GET  /health   counters of the server and the connection pools
+  GET  /metrics  stage metrics in the Prometheus text format
+
+Engines, schema indexes and vector databases are shared by all requests of a
+process. Identical requests in flight at the same time share one upstream
+call. LLM calls and statements run at most `--llm-concurrency` and
+`--db-concurrency` at once; beyond `--max-pending` distinct requests in
+flight, new ones get a 503 with Retry-After instead of queueing.
+
+Usage (from the repository root):
+  python apps/server.py [--port 8000] [--workers 4] [--llm-concurrency 8] [--max-pending 64]
+  LLM_BACKEND=fake EMBEDDING_BACKEND=hash python apps/server.py --latency 0.2
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from lib import dbot, engines, guard, llm, metrics, schema, warmup
+from lib.pdf_store import PdfStore
+from lib.results import ResultStream
+
+PDF_PATH = 'data/pdf'
+CONTEXT_TOP_K = 8
+CONTEXT_MAX_TOKENS = 3000
+RETRIEVAL_MAX_TOKENS = 1500
+MAX_ROWS = 1000
+MAX_BODY = 64 * 1024
+SQL_STATEMENT_TIMEOUT = 30000
+NAME = re.compile(r'^[\w.-]+$')
+
+
+class HttpError(Exception):
+    '''
+    An error answered with its status and message.
+    '''
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class Coalescer:
+    '''
+    Run a coroutine once for identical calls made while it runs: calls with
+    the key of a call in flight wait for its result (or exception) instead.
+    '''
+
+    def __init__(self):
+        self.inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self.inflight
+
+    def __len__(self):
+        return len(self.inflight)
+
+    async def run(self, key, fn):
+        '''
+        Returns the result of `fn()`, a coroutine function, shared by the calls
+        with the same key. Cancelling a caller doesn't cancel the shared call.
+        '''
+        future = self.inflight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            metrics.count('server.coalesced')
+        return await asyncio.shield(future)
+
+
+class Server:
+    '''
+    The request handlers. Must be created in the event loop that serves it.
+
+    Arguments:
+    client: The lib.llm.Client of dbot and the PDF answers.
+    llm_concurrency: Max LLM calls at once.
+    db_concurrency: Max statements run at once.
+    max_pending: Max distinct requests in flight, the others get a 503.
+    timeout: Seconds before a request gets a 504. Its upstream call goes on
+      for the requests sharing it.
+    pdf_path: The directory of the vector databases.
+    '''
+
+    def __init__(self, client, llm_concurrency=8, db_concurrency=4, max_pending=64, timeout=60,
+                 pdf_path=PDF_PATH):
+        self.client = client
+        self.llm_slots = asyncio.Semaphore(llm_concurrency)
+        self.db_slots = asyncio.Semaphore(db_concurrency)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pdf_path = pdf_path
+        self.pdf_store = PdfStore(pdf_path)
+        self.coalescer = Coalescer()
+        self.preflight = guard.Preflight(limit=MAX_ROWS, statement_timeout=SQL_STATEMENT_TIMEOUT)
+        self.statuses = {}
+        self.rejected = 0
+        self.started = time.time()
+        self._chains = {}
+        self.routes = {
+            ('POST', '/sql'): self.sql,
+            ('POST', '/pdf/ask'): self.pdf_ask,
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.prometheus,
+        }
+
+    async def handle(self, reader, writer):
+        '''
+        Serve the requests of a connection, kept alive unless the client
+        closes it.
+        '''
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, content, extra = await self.dispatch(method, path, body)
+                except HttpError as e:
+                    # the request couldn't be read, the connection is out of sync
+                    status, content, extra = e.status, {'error': e.message}, e.headers
+                    keep_alive = False
+                writer.write(response(status, content, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        '''
+        Returns (status, JSON-serializable content or text, extra headers).
+        '''
+        route = self.routes.get((method, path.split('?')[0]))
+        try:
+            if route is None:
+                allowed = [m for m, p in self.routes if p == path.split('?')[0]]
+                if allowed:
+                    raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED, f'Use {", ".join(allowed)}',
+                                    {'Allow': ', '.join(allowed)})
+                raise HttpError(HTTPStatus.NOT_FOUND, f'No route {path}')
+            try:
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'The body is not valid JSON')
+            if not isinstance(payload, dict):
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'The body must be a JSON object')
+            status, content, extra = HTTPStatus.OK, await route(payload), {}
+        except HttpError as e:
+            status, content, extra = e.status, {'error': e.message}, e.headers
+        except Exception as e:
+            status, content, extra = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{type(e).__name__}: {e}'}, {}
+        self.statuses[int(status)] = self.statuses.get(int(status), 0) + 1
+        metrics.count(f'server.status.{int(status)}')
+        return status, content, extra
+
+    async def upstream(self, key, fn):
+        '''
+        Run `fn`, a coroutine function, for a request: shared with identical
+        requests in flight, refused with a 503 if too many are, and bounded by
+        the request timeout.
+        '''
+        if key not in self.coalescer and len(self.coalescer) >= self.max_pending:
+            self.rejected += 1
+            metrics.count('server.rejected')
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, 'Too many requests in flight, retry later',
+                            {'Retry-After': '1'})
+        try:
+            return await asyncio.wait_for(self.coalescer.run(key, fn), self.timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, f'No answer within {self.timeout}s')
+
+    async def sql(self, payload):
+        db_name = field(payload, 'db', name=True)
+        question = field(payload, 'question')
+        execute = bool(payload.get('execute', False))
+        max_rows = payload.get('max_rows', 100)
+        if not isinstance(max_rows, int) or isinstance(max_rows, bool) or max_rows < 1:
+            raise HttpError(HTTPStatus.BAD_REQUEST, '"max_rows" must be a positive integer')
+        max_rows = min(max_rows, MAX_ROWS)
+        if not schema.snapshot_exists(db_name):
+            raise HttpError(HTTPStatus.NOT_FOUND, f'No schema for {db_name}, generate it in the app first')
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            async with self.llm_slots:
+                reply = await loop.run_in_executor(None, self._generate, db_name, question)
+            if execute and reply.get('sql'):
+                async with self.db_slots:
+                    reply.update(await loop.run_in_executor(None, self._execute, db_name, reply['sql'], max_rows))
+            return reply
+
+        return await self.upstream(('sql', db_name, question, execute, max_rows), run)
+
+    async def pdf_ask(self, payload):
+        from lib.vdb import Vdb
+
+        name = field(payload, 'name', name=True)
+        question = field(payload, 'question')
+        history = [tuple(turn) for turn in payload.get('history') or []]
+        # an uploaded name, or the name of a vector database
+        key = self.pdf_store.key(name) or name
+        if not Vdb(self.pdf_path, key).exists():
+            raise HttpError(HTTPStatus.NOT_FOUND, f'No vector database for {name}.pdf')
+
+        async def run():
+            async with self.llm_slots:
+                return await asyncio.get_running_loop().run_in_executor(None, self._answer, key, question,
+                                                                        history)
+
+        return await self.upstream(('pdf', key, question, json.dumps(history)), run)
+
+    async def health(self, payload):
+        return {
+            'status': 'ok',
+            'pid': os.getpid(),
+            'uptime_s': round(time.time() - self.started),
+            'in_flight': len(self.coalescer),
+            'upstream_calls': self.coalescer.calls,
+            'coalesced': self.coalescer.coalesced,
+            'rejected': self.rejected,
+            'statuses': self.statuses,
+            'pools': engines.stats(),
+        }
+
+    async def prometheus(self, payload):
+        return metrics.registry.prometheus()
+
+    def _generate(self, db_name, question):
+        with metrics.trace('server.sql'):
+            index = warmup.schema_index(db_name)
+            # with an index, the schema SQL isn't needed
+            context = dbot.context(None, index, question, top_k=CONTEXT_TOP_K, max_tokens=CONTEXT_MAX_TOKENS,
+                                   model=warmup.schema_model(db_name))
+            try:
+                return dbot.generate(self.client, context, question)
+            except ValueError as e:
+                raise HttpError(HTTPStatus.BAD_GATEWAY, f'Malformed reply: {e}')
+
+    def _execute(self, db_name, sql, max_rows):
+        engine = engines.get(db_name)
+        with metrics.trace('server.execute'):
+            con = engine.raw_connection()
+            try:
+                plan = self.preflight.check(con, sql)
+            except guard.Rejected as e:
+                return {'rejected': e.reason}
+            finally:
+                con.close()
+            result = ResultStream(engine, plan['sql'], page_size=max_rows, max_rows=max_rows, read_only=True,
+                                  statement_timeout=SQL_STATEMENT_TIMEOUT)
+            try:
+                return {
+                    'executed_sql': plan['sql'],
+                    'columns': result.columns,
+                    'rows': [list(row) for row in result.rows],
+                    'truncated': result.truncated or not result.done,
+                }
+            finally:
+                result.close()
+
+    def _answer(self, key, question, history):
+        with metrics.trace('server.pdf'):
+            result = self._chain(key)({'question': question, 'chat_history': history})
+            return {'answer': result['answer']}
+
+    def _chain(self, key):
+        from langchain.chains import ChatVectorDBChain
+        from lib.langchain_llm import ClientLlm
+        from lib.retrieval import HybridRetriever
+
+        store = warmup.store(self.pdf_path, key)
+        cached = self._chains.get(key)
+        if cached is None or cached[0] is not store:
+            chain = ChatVectorDBChain.from_llm(llm=ClientLlm(client=self.client, temperature=0),
+                                               vectorstore=HybridRetriever(store, max_tokens=RETRIEVAL_MAX_TOKENS))
+            cached = self._chains[key] = (store, chain)
+        return cached[1]
+
+
+def field(payload, key, name=False):
+    value = payload.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise HttpError(HTTPStatus.BAD_REQUEST, f'"{key}" is required')
+    if name and not NAME.match(value):
+        raise HttpError(HTTPStatus.BAD_REQUEST, f'Invalid "{key}": {value}')
+    return value
+
+
+async def read_request(reader):
+    '''
+    Read an HTTP/1.1 request.
+
+    Returns (method, path, headers with lower case names, body), or None if
+    the connection was closed before a request.
+    '''
+    line = await read_line(reader)
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'Malformed request line')
+
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    length = headers.get('content-length') or '0'
+    if not (length.isascii() and length.isdigit()):
+        raise HttpError(HTTPStatus.BAD_REQUEST, f'Invalid Content-Length: {length}')
+    length = int(length)
+    if length > MAX_BODY:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'The body is over {MAX_BODY} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path, headers, body
+
+
+async def read_line(reader):
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):
+        # over the limit of the stream reader (64 KiB)
+        raise HttpError(HTTPStatus.BAD_REQUEST, 'A request or header line is too long')
+
+
+def response(status, content, headers=None, keep_alive=True):
+    status = HTTPStatus(status)
+    if isinstance(content, str):
+        body = content.encode('utf-8')
+        content_type = 'text/plain; charset=utf-8'
+    else:
+        body = json.dumps(content, default=str).encode('utf-8')
+        content_type = 'application/json'
+    lines = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type}',
+             f'Content-Length: {len(body)}', f'Connection: {"keep-alive" if keep_alive else "close"}']
+    lines.extend(f'{k}: {v}' for k, v in (headers or {}).items())
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+async def serve(args):
+    kwargs = {}
+    if args.backend == 'fake':
+        kwargs = {'first_token_latency': args.latency}
+    client = llm.Client(llm.create_backend(args.backend, **kwargs), max_concurrency=args.llm_concurrency)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(args.llm_concurrency + args.db_concurrency, thread_name_prefix='server'))
+    server = Server(client, llm_concurrency=args.llm_concurrency, db_concurrency=args.db_concurrency,
+                    max_pending=args.max_pending, timeout=args.timeout, pdf_path=args.pdf_path)
+    if args.dbs or args.pdfs:
+        pdfs = [server.pdf_store.key(name) or name for name in args.pdfs.split(',')] if args.pdfs else []
+        warmup.start(dbs=args.dbs.split(',') if args.dbs else [], pdfs=pdfs, pdf_path=args.pdf_path,
+                     modules=warmup.MODULES['db'] + warmup.MODULES['pdf'])
+
+    listener = await asyncio.start_server(server.handle, args.host, args.port, reuse_port=args.workers > 1,
+                                          backlog=args.backlog)
+    print(f'Listening on http://{args.host}:{args.port} (pid {os.getpid()})', flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def run(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve dbot and the PDF helper over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--backend', default=os.environ.get('LLM_BACKEND', 'openai'))
+    parser.add_argument('--latency', type=float, default=0.5, help='latency of the fake backend')
+    parser.add_argument('--llm-concurrency', type=int, default=8, help='LLM calls at once, per process')
+    parser.add_argument('--db-concurrency', type=int, default=4, help='statements run at once, per process')
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help='distinct requests in flight per process before answering 503')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before answering 504')
+    parser.add_argument('--backlog', type=int, default=1024, help='pending connections of the socket')
+    parser.add_argument('--pdf-path', default=PDF_PATH)
+    parser.add_argument('--dbs', help='comma separated databases to preload')
+    parser.add_argument('--pdfs', help='comma separated PDFs to preload')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        workers = [multiprocessing.Process(target=run, args=(args,)) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        signal.signal(signal.SIGTERM, lambda *_: [worker.terminate() for worker in workers])
+        for worker in workers:
+            worker.join()
+    else:
+        run(args)
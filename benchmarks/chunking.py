@@ -0,0 +1,126 @@
+'''
+Compare the chunking of Vdb (lib.chunker.Chunker: structure-aware, with
+boilerplate stripping and MinHash dedup) with the fixed-size splitter it
+replaced, on a synthetic report: numbered sections, a running header and a
+page-numbered footer, and a disclaimer and a standard notice repeated on
+pages.
+
+Reports chunks, the characters embedded and the index size, the section
+headings found inside chunks rather than at their start, and the time to
+ingest the report and to upload it again under another name.
+
+Usage: python benchmarks/chunking.py [--pages 100] [--dim 1536]
+'''
+import argparse
+import os
+import re
+import tempfile
+import textwrap
+import time
+from common import report, write_pdf
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from lib import embeddings, loader
+from lib.chunker import Chunker
+from lib.pdf_store import PdfStore
+from lib.vdb import Vdb
+
+HEADER = 'ACME Holdings Annual Report 2023'
+DISCLAIMER = ('This document contains forward looking statements that involve risks and uncertainties. '
+              'Actual results may differ materially from those expressed or implied in these statements. '
+              'ACME Holdings undertakes no obligation to update any forward looking statement.')
+NOTICE = ('All amounts are in thousands of dollars unless stated otherwise. Figures may not add up due to '
+          'rounding. Segment results are reported before eliminations.')
+SECTIONS = ['Overview', 'Revenue By Region', 'Operating Expenses', 'Risk Factors', 'Outlook',
+            'Capital Allocation', 'Sustainability', 'Governance']
+SECTION = re.compile(r'^\d+\. [A-Z]', re.M)
+
+
+def report_text(page, rng, words):
+    '''
+    Lines of a page of the report: a header, a section heading every few
+    pages, paragraphs broken into lines, some repeated notices, and a footer.
+    '''
+    def paragraph(n):
+        sentences = [' '.join(rng.choice(words) for _ in range(rng.randint(8, 16))).capitalize() + '.'
+                     for _ in range(n)]
+        text = ' '.join(sentences)
+        return textwrap.wrap(text, 90)
+
+    lines = [HEADER, '']
+    if page % 3 == 0:
+        lines += [f'{page // 3 + 1}. {SECTIONS[page // 3 % len(SECTIONS)]}', '']
+    for _ in range(rng.randint(3, 5)):
+        lines += paragraph(rng.randint(3, 6)) + ['']
+    if page % 2 == 0:
+        lines += textwrap.wrap(DISCLAIMER, 90) + ['']
+    if page % 4 == 1:
+        lines += textwrap.wrap(NOTICE, 90) + ['']
+    return lines + [f'Confidential - Page {page + 1} of {page + 1000}']
+
+
+def fixed_split(pages, chunk_size):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+    return [t for page in pages for t in splitter.split_text(page)]
+
+
+def chunker_split(pages, chunker):
+    return [t for page in pages for t in chunker.split(page)], chunker.stats
+
+
+def measures(name, chunks, dim, stats=None):
+    # section headings inside a chunk rather than at its start
+    inside = sum(len(SECTION.findall(c, 1)) for c in chunks)
+    return {
+        'splitter': name,
+        'chunks': len(chunks),
+        'chars_embedded': sum(len(c) for c in chunks),
+        'index_mb': round(len(chunks) * dim * 4 / 1e6, 2),
+        'headings_inside': inside,
+        'duplicates': (stats or {}).get('duplicates', '-'),
+        'boilerplate_lines': (stats or {}).get('boilerplate_lines', '-'),
+        'disclaimer_copies': sum(c.count('forward looking statements that involve') for c in chunks),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--chunk-size', type=int, default=1500)
+    parser.add_argument('--dim', type=int, default=1536, help='embedding dimension for the index size')
+    args = parser.parse_args()
+
+    os.environ['EMBEDDING_BACKEND'] = 'hash'
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            os.makedirs('data/pdf')
+            write_pdf('report.pdf', args.pages, page_text=report_text)
+            pages = [doc.page_content for doc in loader.pages('report.pdf')]
+
+            rows = [measures('fixed size', fixed_split(pages, args.chunk_size), args.dim)]
+            for label, dedup in [('chunker, no dedup', None), ('chunker', 0.8)]:
+                chunks, stats = chunker_split(pages, Chunker(args.chunk_size, dedup=dedup))
+                rows.append(measures(label, chunks, args.dim, stats))
+            report(f'Chunking of a {args.pages} page report ({args.chunk_size} characters per chunk)', rows)
+
+            with open('report.pdf', 'rb') as f:
+                data = f.read()
+            store = PdfStore('data/pdf')
+            timings = []
+            for name in ['report', 'report (copy)']:
+                start = time.perf_counter()
+                key = store.add(name, data)
+                vdb = Vdb('data/pdf', key, embeddings=embeddings.default())
+                if not vdb.exists():
+                    vdb.ingest(store.filename(key))
+                timings.append({'upload': name, 'key': key, 'seconds': round(time.perf_counter() - start, 3),
+                                'pdf_files': sum(1 for f in os.listdir('data/pdf') if f.endswith('.pdf'))})
+            report('Uploads of the same report (hash embeddings)', timings)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
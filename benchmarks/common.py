@@ -0,0 +1,116 @@
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'apps'))
+
+from lib.engines import DSN  # noqa: E402
+
+
+def measure(fn, repeat=5):
+    '''
+    Run a function several times and collect its wall clock timings.
+
+    Arguments:
+    fn: A function without arguments.
+    repeat: Number of runs.
+
+    Returns a tuple of (last result, list of timings in seconds).
+    '''
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def summary(timings):
+    '''
+    Summarize timings in milliseconds.
+    '''
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        'min': round(ms[0], 2),
+        'median': round(statistics.median(ms), 2),
+        'p95': round(percentile(ms, 95), 2),
+        'max': round(ms[-1], 2),
+    }
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def rss():
+    '''
+    Returns the current resident set size of the process in bytes (Linux only).
+    '''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def report(title, rows):
+    '''
+    Print a list of dict rows as an aligned table.
+    '''
+    print(f'## {title}')
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths = [max(len(str(c)), *(len(str(r[c])) for r in rows)) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+    print()
+
+
+def write_pdf(path, pages, lines=50, seed=0, page_text=None):
+    '''
+    Write a plain text PDF of `pages` pages of random words, without any PDF
+    library.
+
+    Arguments:
+    page_text: A function of (page number, random generator, word list)
+      returning the lines of a page, instead of `lines` lines of random words.
+    '''
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+             for _ in range(3000)]
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in range(pages):
+        if page_text is None:
+            text = [f'Page {page + 1}'] + [' '.join(rng.choice(words) for _ in range(12)) for _ in range(lines)]
+        else:
+            text = page_text(page, rng, words)
+        shown = b' '.join(b'(' + t.encode('latin-1').replace(b'\\', b'\\\\').replace(b'(', b'\\(')
+                          .replace(b')', b'\\)') + b") '" for t in text)
+        stream = b'BT /F1 10 Tf 14 TL 50 790 Td ' + shown + b' ET'
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % len(objects))
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), pages)
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = []
+        for i, body in enumerate(objects):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n%s\nendobj\n' % (i + 1, body))
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b'%010d 00000 n \n' % offset)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
@@ -0,0 +1,63 @@
+'''
+Measure the embedding pipeline: serial vs concurrent batches, and a cold vs
+warm cache, against the local hash embedder with simulated API latency.
+
+Usage: python benchmarks/embedding_pipeline.py [--chunks 2000] [--latency 0.2]
+'''
+import argparse
+import os
+import tempfile
+import time
+from common import report
+
+from lib.embeddings import EmbeddingCache, EmbeddingPipeline, HashEmbeddings
+
+
+class SlowEmbeddings(HashEmbeddings):
+    '''
+    Hash embeddings that take `latency` seconds per request, like a remote API.
+    '''
+
+    def __init__(self, latency, size=256):
+        super().__init__(size)
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    texts = [f'chunk {i}: ' + ' '.join(f'word{(i * 7 + j) % 997}' for j in range(30))
+             for i in range(args.chunks)]
+    embedder = SlowEmbeddings(args.latency)
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        cache = EmbeddingCache(os.path.join(path, 'embeddings.sqlite'))
+        runs = [
+            ('serial, no cache', EmbeddingPipeline(embedder, batch_size=args.batch_size, concurrency=1), texts),
+            (f'{args.concurrency} concurrent, no cache',
+             EmbeddingPipeline(embedder, batch_size=args.batch_size, concurrency=args.concurrency), texts),
+            ('concurrent, cold cache',
+             EmbeddingPipeline(embedder, cache, batch_size=args.batch_size, concurrency=args.concurrency), texts),
+            ('concurrent, warm cache',
+             EmbeddingPipeline(embedder, cache, batch_size=args.batch_size, concurrency=args.concurrency), texts),
+            ('concurrent, 10% new chunks',
+             EmbeddingPipeline(embedder, cache, batch_size=args.batch_size, concurrency=args.concurrency),
+             texts[args.chunks // 10:] + [t + ' new' for t in texts[:args.chunks // 10]]),
+        ]
+        for title, pipeline, docs in runs:
+            pipeline.embed_documents(docs)
+            rows.append({'run': title, **pipeline.stats})
+    report(f'{args.chunks} chunks, {args.latency * 1000:.0f} ms per request', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Check the import time of the modules each app loads on a cold start, with
+`python -X importtime` in a fresh process per app, against a budget. Modules
+that must stay lazy (e.g. faiss or pandas for the db app) are reported when an
+import pulls them in anyway.
+
+Exits with 1 if an app is over budget or imports a module it must not.
+
+Usage (from the repository root):
+  python benchmarks/import_time.py [--repeat 3] [--scale 1.0]
+'''
+import argparse
+import os
+import subprocess
+import sys
+from common import report
+
+APPS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'apps'))
+# the lib modules imported by each app at the top level (streamlit is left
+# out: it isn't ours to speed up), their budget in ms, and the heavy modules
+# they must only import on first use
+CHECKS = {
+    'db': {
+        'imports': ['lib.answer_cache', 'lib.dbot', 'lib.engines', 'lib.guard', 'lib.jobs', 'lib.llm',
+                    'lib.metrics', 'lib.result_cache', 'lib.results', 'lib.schema', 'lib.schema_compact', 'lib.utils',
+                    'lib.warmup'],
+        'budget_ms': 500,
+        'lazy': ['faiss', 'langchain', 'pandas', 'pyarrow', 'openai', 'pdfminer'],
+    },
+    'batch': {
+        'imports': ['lib.dbot', 'lib.engines', 'lib.guard', 'lib.llm', 'lib.schema', 'lib.schema_compact',
+                    'lib.schema_index'],
+        'budget_ms': 500,
+        'lazy': ['faiss', 'langchain', 'pandas', 'pyarrow', 'openai'],
+    },
+    'pdf': {
+        'imports': ['lib.corpus', 'lib.jobs', 'lib.langchain_llm', 'lib.llm', 'lib.memory', 'lib.metrics',
+                    'lib.pdf_store', 'lib.retrieval', 'lib.vdb', 'lib.warmup', 'langchain.chains'],
+        'budget_ms': 2000,
+        'lazy': ['faiss', 'pandas', 'pyarrow', 'openai', 'pdfminer'],
+    },
+}
+
+
+def importtime(modules):
+    '''
+    Import modules in a fresh interpreter with -X importtime.
+
+    Returns (total ms, {top level package: ms spent in its own modules}).
+    '''
+    code = '; '.join(f'import {m}' for m in modules)
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=APPS,
+                         capture_output=True, text=True, check=True).stderr
+    packages = {}
+    total = 0
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1000
+        # nested imports are in the time of the module importing them
+        if not name.startswith('  '):
+            total += int(cumulative) / 1000
+    return total, packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='runs per app, the fastest counts')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets, for slow machines')
+    parser.add_argument('--only', help='comma separated apps: ' + ', '.join(CHECKS))
+    args = parser.parse_args()
+
+    rows = []
+    failed = False
+    for app, check in CHECKS.items():
+        if args.only and app not in args.only.split(','):
+            continue
+        runs = [importtime(check['imports']) for _ in range(args.repeat)]
+        total, packages = min(runs, key=lambda r: r[0])
+        leaked = [m for m in check['lazy'] if m in packages]
+        budget = check['budget_ms'] * args.scale
+        ok = total <= budget and not leaked
+        failed = failed or not ok
+        slowest = sorted(packages.items(), key=lambda p: -p[1])[:3]
+        rows.append({'app': app, 'import_ms': round(total, 1), 'budget_ms': round(budget),
+                     'slowest': ', '.join(f'{p} {ms:.0f}' for p, ms in slowest),
+                     'eager': ', '.join(leaked) or '-', 'ok': 'yes' if ok else 'NO'})
+    report('Cold import time', rows)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+'''
+Measure completion latency through lib.llm.Client: time queued, to first token
+and in total, with concurrent callers. Uses the fake backend by default, so it
+runs without network.
+
+Usage: python benchmarks/llm_latency.py [--backend fake] [--requests 40] [--concurrency 8]
+'''
+import argparse
+from common import report, summary
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import llm
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', default='fake')
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-concurrency', type=int, default=4,
+                        help='calls the client lets through at once')
+    parser.add_argument('--first-token-latency', type=float, default=0.2)
+    parser.add_argument('--token-latency', type=float, default=0.01)
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.backend == 'fake':
+        kwargs = {'first_token_latency': args.first_token_latency,
+                  'token_latency': args.token_latency}
+    client = llm.Client(llm.create_backend(args.backend, **kwargs),
+                        max_concurrency=args.max_concurrency)
+
+    prompts = [f'Question {i}: summarize the document in one paragraph, please.'
+               for i in range(args.requests)]
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(client.complete, prompts))
+
+    timings = list(client.timings)
+    rows = [{'stage': stage, **summary([t[stage] for t in timings])}
+            for stage in ['queued', 'first_token', 'total']]
+    report(f'{args.backend} backend, {args.requests} requests (ms)', rows)
+    tps = sorted(t['tokens_per_second'] for t in timings)
+    print(f'tokens/s: median {tps[len(tps) // 2]:.1f}')
+
+
+if __name__ == '__main__':
+    main()
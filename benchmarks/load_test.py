@@ -0,0 +1,192 @@
+'''
+Load test of apps/server.py on a local fake stack: the server runs with the
+fake LLM and hash embeddings, on a synthetic PDF and the schema of the
+benchmark database (see `python benchmarks/suite.py --setup`; /sql is left
+out without it). Keep-alive connections send requests back to back for a
+while; a share of them repeat a few hot questions, which the server
+coalesces while they are in flight.
+
+Reports requests per second, latency percentiles and statuses per endpoint,
+and the coalesced and rejected counts of the server.
+
+Usage (from the repository root):
+  python benchmarks/load_test.py [--connections 64] [--duration 10] [--latency 0.2] [--workers 1]
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from common import DSN, percentile, report, write_pdf
+
+from sqlalchemy import create_engine
+from lib import embeddings, schema
+from lib.vdb import Vdb
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVER = os.path.join(ROOT, 'apps', 'server.py')
+QUESTIONS = os.path.join(ROOT, 'benchmarks', 'data', 'adventure_works_questions.jsonl')
+PDF_NAME = 'load_test'
+
+
+def setup(path, dsn, db_name, pages):
+    '''
+    Create the schema snapshot and the vector database the server uses, under
+    data/ of `path`. Returns whether the database is available.
+    '''
+    os.makedirs(os.path.join(path, 'data', 'db'))
+    os.makedirs(os.path.join(path, 'data', 'pdf'))
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        write_pdf(f'data/pdf/{PDF_NAME}.pdf', pages)
+        Vdb('data/pdf', PDF_NAME, embeddings=embeddings.default()).ingest(f'data/pdf/{PDF_NAME}.pdf')
+        try:
+            with create_engine(dsn.format(db_name=db_name)).connect() as con:
+                schema.refresh(con, db_name, full=True)
+            return True
+        except Exception as e:
+            print(f'/sql left out, no database: {str(e).splitlines()[0]}')
+            return False
+    finally:
+        os.chdir(cwd)
+
+
+async def request(reader, writer, method, path, payload=None):
+    '''
+    Send a request on a kept-alive connection. Returns (status, body).
+    '''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def connection(port, deadline, pick, results):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.perf_counter() < deadline:
+            endpoint, path, payload = pick()
+            start = time.perf_counter()
+            try:
+                status, _ = await request(reader, writer, 'POST', path, payload)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                results.append((endpoint, 'closed', (time.perf_counter() - start) * 1000))
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                continue
+            results.append((endpoint, status, (time.perf_counter() - start) * 1000))
+            if status == 503:
+                # what a well-behaved client does with Retry-After, shortened
+                await asyncio.sleep(0.05)
+    finally:
+        writer.close()
+
+
+async def load(args, endpoints):
+    with open(QUESTIONS) as f:
+        questions = [json.loads(line)['question'] for line in f if line.strip()]
+    rng = random.Random(0)
+    hot = questions[:args.hot]
+
+    def pick():
+        endpoint = rng.choice(endpoints)
+        question = rng.choice(hot) if rng.random() < args.repeat_share else f'{rng.choice(questions)} #{rng.random()}'
+        if endpoint == 'sql':
+            return endpoint, '/sql', {'db': args.db, 'question': question}
+        return endpoint, '/pdf/ask', {'name': PDF_NAME, 'question': question}
+
+    results = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[connection(args.port, deadline, pick, results) for _ in range(args.connections)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', args.port)
+    _, body = await request(reader, writer, 'GET', '/health')
+    writer.close()
+    return results, elapsed, json.loads(body)
+
+
+def wait_ready(server, port, timeout=60):
+    start = time.time()
+    while time.time() - start < timeout:
+        if server.poll() is not None:
+            raise SystemExit(f'The server exited with {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('The server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=DSN, help='DSN with a {db_name} placeholder')
+    parser.add_argument('--db', default='bench_adventure_works')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--connections', type=int, default=64, help='concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--latency', type=float, default=0.2, help='latency of the fake LLM in seconds')
+    parser.add_argument('--repeat-share', type=float, default=0.3, help='share of requests for hot questions')
+    parser.add_argument('--hot', type=int, default=3, help='number of hot questions')
+    parser.add_argument('--pages', type=int, default=50, help='pages of the synthetic PDF')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--llm-concurrency', type=int, default=16)
+    parser.add_argument('--max-pending', type=int, default=64)
+    args = parser.parse_args()
+
+    os.environ['EMBEDDING_BACKEND'] = 'hash'
+    with tempfile.TemporaryDirectory() as path:
+        endpoints = ['sql', 'pdf'] if setup(path, args.dsn, args.db, args.pages) else ['pdf']
+        env = {**os.environ, 'DB_DSN': args.dsn, 'EMBEDDING_BACKEND': 'hash', 'LLM_BACKEND': 'fake'}
+        server = subprocess.Popen(
+            [sys.executable, SERVER, '--port', str(args.port), '--backend', 'fake', '--latency', str(args.latency),
+             '--workers', str(args.workers), '--llm-concurrency', str(args.llm_concurrency),
+             '--max-pending', str(args.max_pending), '--dbs', args.db if 'sql' in endpoints else '',
+             '--pdfs', PDF_NAME], cwd=path, env=env, stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(server, args.port)
+            results, elapsed, health = asyncio.run(load(args, endpoints))
+        finally:
+            server.terminate()
+            server.wait()
+
+    rows = []
+    for endpoint in endpoints + ['all']:
+        picked = [r for r in results if endpoint in ('all', r[0])]
+        ok = sorted(ms for _, status, ms in picked if status == 200)
+        rows.append({
+            'endpoint': endpoint,
+            'requests': len(picked),
+            'rps': round(len(ok) / elapsed, 1),
+            'p50_ms': round(percentile(ok, 50), 1),
+            'p95_ms': round(percentile(ok, 95), 1),
+            'p99_ms': round(percentile(ok, 99), 1),
+            '503': sum(1 for r in picked if r[1] == 503),
+            'errors': sum(1 for r in picked if r[1] not in (200, 503)),
+        })
+    report(f'Load test ({args.connections} connections, {args.duration}s, fake LLM latency {args.latency}s, '
+           f'{args.workers} worker(s))', rows)
+    report('Server (last worker polled)', [{k: health[k] for k in
+                                             ['upstream_calls', 'coalesced', 'rejected', 'in_flight']}])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+'''
+Measure PDF ingestion with different numbers of extraction processes: wall
+clock time, pages per second and memory growth. Embeddings are local hashes,
+so the timings are dominated by page extraction.
+
+Usage: python benchmarks/pdf_ingest.py [data/pdf/some.pdf] [--pages 200] [--workers 1 2 4]
+'''
+import argparse
+import os
+import tempfile
+import time
+from common import report, rss, write_pdf
+
+from lib.embeddings import EmbeddingPipeline, HashEmbeddings
+from lib.vdb import Vdb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='?', help='a synthetic PDF is used if not given')
+    parser.add_argument('--pages', type=int, default=200, help='pages of the synthetic PDF')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        if args.filename is None:
+            args.filename = os.path.join(path, 'synthetic.pdf')
+            write_pdf(args.filename, args.pages)
+        for workers in sorted(set(args.workers)):
+            vdb = Vdb(path, f'ingest_{workers}', embeddings=EmbeddingPipeline(HashEmbeddings()))
+            before = rss()
+            start = time.perf_counter()
+            vdb.ingest(args.filename, workers=workers)
+            elapsed = time.perf_counter() - start
+            rows.append({
+                'workers': workers,
+                'pages': vdb.stats['pages'],
+                'chunks': vdb.stats['chunks'],
+                'seconds': round(elapsed, 2),
+                'pages_per_second': round(vdb.stats['pages'] / elapsed, 1),
+                'rss_growth_mb': round((rss() - before) / 1024 / 1024, 1),
+            })
+    report(f'Ingesting {args.filename}', rows)
+
+
+if __name__ == '__main__':
+    main()
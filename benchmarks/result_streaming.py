@@ -0,0 +1,67 @@
+'''
+Compare loading a query result with pandas against lib.results.ResultStream,
+by time to first row and peak RSS. Each mode runs in its own process.
+
+Usage: python benchmarks/result_streaming.py adventure_works \
+    [--sql "SELECT * FROM sales.salesorderdetail"]
+'''
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from common import DSN, report
+
+from sqlalchemy import create_engine
+
+
+def run(mode, dsn, sql):
+    engine = create_engine(dsn)
+    start = time.perf_counter()
+    if mode == 'pandas':
+        import pandas as pd
+
+        with engine.connect() as con:
+            df = pd.read_sql_query(sql, con)
+        rows = len(df)
+    else:
+        from lib.results import ResultStream
+
+        result = ResultStream(engine, sql)
+        result.page(0)
+        rows = len(result.rows)
+        result.close()
+    first_row = time.perf_counter() - start
+    return {
+        'mode': mode,
+        'rows held': rows,
+        'first row ms': round(first_row * 1000, 1),
+        'peak rss MB': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_name')
+    parser.add_argument('--dsn', default=DSN)
+    parser.add_argument('--sql', default='SELECT * FROM sales.salesorderdetail')
+    parser.add_argument('--mode')
+    args = parser.parse_args()
+    dsn = args.dsn.format(db_name=args.db_name)
+
+    if args.mode:
+        print(json.dumps(run(args.mode, dsn, args.sql)))
+        return
+
+    rows = []
+    for mode in ['pandas', 'stream']:
+        out = subprocess.run([sys.executable, __file__, args.db_name, '--dsn', args.dsn,
+                              '--sql', args.sql, '--mode', mode],
+                             check=True, capture_output=True, text=True).stdout
+        rows.append(json.loads(out.strip().splitlines()[-1]))
+    report(args.sql, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Offline evaluation of PDF retrieval: recall@k, prompt tokens of the chunks
+sent to the LLM and retrieval latency, for dense, BM25 and hybrid retrieval.
+
+A question is answered by a chunk if the chunk contains its "answer" string.
+Without --pdf, a synthetic corpus of part numbers is generated, so the eval
+runs offline with the local hash embeddings.
+
+Usage:
+  python benchmarks/retrieval_eval.py [--synthetic 200]
+  python benchmarks/retrieval_eval.py --pdf data/pdf/manual.pdf --questions questions.jsonl --embeddings openai
+'''
+import argparse
+import json
+import random
+import tempfile
+import time
+from common import report, summary
+
+from langchain.docstore.document import Document
+from lib import embeddings
+from lib.embeddings import EmbeddingPipeline, HashEmbeddings
+from lib.retrieval import HybridRetriever
+from lib.utils import count_tokens
+from lib.vdb import Vdb
+
+FIXED_K = 4
+
+
+def synthetic(pages, seed=42):
+    '''
+    Returns (documents, questions): pages of filler text, each stating a few
+    facts about part numbers, and a question per fact.
+    '''
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(2000)]
+    docs = []
+    questions = []
+    for page in range(pages):
+        sentences = []
+        for _ in range(12):
+            sentences.append(' '.join(rng.choice(vocabulary) for _ in range(rng.randint(15, 30))) + '.')
+        for _ in range(3):
+            part = f'PN-{rng.randint(10000, 99999)}-{rng.choice("ABCDEFGH")}{rng.choice("XYZ")}'
+            torque = rng.randint(5, 500)
+            sentences.insert(rng.randint(0, len(sentences)), f'Part {part} has a rated torque of {torque} Nm.')
+            questions.append({'question': f'What is the rated torque of part {part}?', 'answer': part})
+        docs.append(Document(page_content=' '.join(sentences), metadata={'page': page}))
+    return docs, questions
+
+
+def evaluate(store, questions, retrieve, budgeted=False):
+    relevant = [{i for i in range(len(store)) if q['answer'] in store.text(i)} for q in questions]
+    hits = {1: 0, 3: 0, 5: 0}
+    sent_hits = 0
+    tokens = []
+    timings = []
+    for q, answers in zip(questions, relevant):
+        start = time.perf_counter()
+        ids = retrieve(q['question'])
+        timings.append(time.perf_counter() - start)
+        for k in hits:
+            hits[k] += bool(set(ids[:k]) & answers)
+        sent = ids if budgeted else ids[:FIXED_K]
+        sent_hits += bool(set(sent) & answers)
+        tokens.append(sum(count_tokens(store.text(i)) for i in sent))
+
+    n = len(questions)
+    latency = summary(timings)
+    return {
+        'recall@1': round(hits[1] / n, 3),
+        'recall@3': round(hits[3] / n, 3),
+        'recall@5': round(hits[5] / n, 3),
+        'sent_recall': round(sent_hits / n, 3),
+        'sent_tokens': round(sum(tokens) / n),
+        'p50_ms': latency['median'],
+        'p95_ms': latency['p95'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdf')
+    parser.add_argument('--questions', help='JSONL of {"question", "answer"}')
+    parser.add_argument('--synthetic', type=int, default=200, help='pages of the synthetic corpus')
+    parser.add_argument('--embeddings', choices=['hash', 'openai'], default='hash')
+    parser.add_argument('--max-tokens', type=int, default=1500)
+    parser.add_argument('--size', type=int, default=256, help='dimension of the hash embeddings')
+    parser.add_argument('--lexical-weight', type=float, default=1.0, help='weight of BM25 in the fusion')
+    args = parser.parse_args()
+
+    embedder = EmbeddingPipeline(HashEmbeddings(args.size)) if args.embeddings == 'hash' else embeddings.default()
+    with tempfile.TemporaryDirectory() as path:
+        vdb = Vdb(path, 'eval', embeddings=embedder)
+        if args.pdf:
+            with open(args.questions) as f:
+                questions = [json.loads(line) for line in f if line.strip()]
+            vdb.ingest(args.pdf)
+            title = args.pdf
+        else:
+            docs, questions = synthetic(args.synthetic)
+            vdb.build(docs)
+            title = f'synthetic corpus of {args.synthetic} pages'
+        store = vdb.load()
+
+        weights = (1.0, args.lexical_weight)
+        ranked = HybridRetriever(store, weights=weights, max_tokens=None)
+        budgeted = HybridRetriever(store, weights=weights, max_tokens=args.max_tokens)
+        runs = [
+            ('dense', lambda q: ranked.dense(q, 10)),
+            ('bm25', lambda q: ranked.lexical(q, 10)),
+            ('rrf', lambda q: [i for i, _ in ranked.fuse(ranked.dense(q), ranked.lexical(q))]),
+            ('rrf + mmr', lambda q: ranked.search(q, 10)),
+        ]
+        rows = [{'method': name, **evaluate(store, questions, fn)} for name, fn in runs]
+        rows.append({'method': f'rrf + mmr, {args.max_tokens} tokens',
+                     **evaluate(store, questions, budgeted.search, budgeted=True)})
+    report(f'{len(questions)} questions over {len(store)} chunks of {title} (sent: top {FIXED_K} or budget)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''
+Compare the schema context of dbot prompts in SQL (lib.schema) and in the
+compact encoding (lib.schema_compact): tokens of the whole schema, and of the
+context of each benchmark question at the token budget of the app. With
+--backend the prompts are also sent to an LLM and timed.
+
+Uses the database created by `python benchmarks/suite.py --setup`.
+
+Usage (from the repository root):
+  python benchmarks/schema_compact.py [--db bench_adventure_works] [--budget 3000] [--backend fake]
+'''
+import argparse
+import json
+import os
+import tempfile
+import time
+from common import DSN, percentile, report
+
+from sqlalchemy import create_engine
+from lib import dbot, llm, schema, schema_compact, utils
+from lib.schema_index import SchemaIndex
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+QUESTIONS = os.path.join(ROOT, 'benchmarks', 'data', 'adventure_works_questions.jsonl')
+
+
+def load(dsn, db_name):
+    '''
+    Returns (schema snapshot, compact model) of a database.
+    '''
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        # schema snapshots are written under data/db of the working directory
+        os.makedirs(os.path.join(path, 'data', 'db'))
+        os.chdir(path)
+        try:
+            with create_engine(dsn.format(db_name=db_name)).connect() as con:
+                schema.refresh(con, db_name, full=True)
+                model = schema_compact.load_from_db(con)
+            return schema.load_snapshot(db_name), model
+        finally:
+            os.chdir(cwd)
+
+
+def contexts(snapshot, model, questions, top_k, budget):
+    '''
+    Returns {encoding: [context of each question]}.
+    '''
+    sql = schema.render(snapshot)
+    index = SchemaIndex(snapshot)
+    return {
+        'sql': [dbot.context(sql, index, q, top_k=top_k, max_tokens=budget) for q in questions],
+        'compact': [dbot.context(sql, index, q, top_k=top_k, max_tokens=budget, model=model) for q in questions],
+    }
+
+
+def count_objects(encoding, text):
+    '''
+    Count the schema objects in a context: CREATE statements in SQL, lines
+    other than comments and headers in the compact encoding.
+    '''
+    lines = text.splitlines()
+    if encoding == 'sql':
+        return sum(1 for line in lines if line.startswith('CREATE '))
+    return sum(1 for line in lines if line.strip() and not line.startswith('#'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=DSN, help='DSN with a {db_name} placeholder')
+    parser.add_argument('--db', default='bench_adventure_works')
+    parser.add_argument('--questions', default=QUESTIONS)
+    parser.add_argument('--top-k', type=int, default=8)
+    parser.add_argument('--budget', type=int, default=3000, help='token budget of a context')
+    parser.add_argument('--backend', help='also time dbot.generate with this LLM backend, e.g. fake or openai')
+    args = parser.parse_args()
+
+    snapshot, model = load(args.dsn, args.db)
+    with open(args.questions) as f:
+        questions = [json.loads(line)['question'] for line in f if line.strip()]
+
+    full = {'sql': schema.render(snapshot), 'compact': schema_compact.encode(model)}
+    rows = [{'context': f'whole schema ({name})', 'chars': len(text), 'tokens': utils.count_tokens(text)}
+            for name, text in full.items()]
+    for row in rows:
+        row['vs_sql'] = round(rows[0]['tokens'] / row['tokens'], 2)
+    report(f'Schema of {args.db}', rows)
+
+    rows = []
+    for name, texts in contexts(snapshot, model, questions, args.top_k, args.budget).items():
+        tokens = sorted(utils.count_tokens(text) for text in texts)
+        objects = sorted(count_objects(name, text) for text in texts)
+        row = {'encoding': name, 'p50_tokens': percentile(tokens, 50), 'max_tokens': tokens[-1],
+               'p50_objects': percentile(objects, 50)}
+        if args.backend:
+            client = llm.Client(llm.create_backend(args.backend))
+            timings = []
+            for question, text in zip(questions, texts):
+                start = time.perf_counter()
+                try:
+                    dbot.generate(client, text, question)
+                except ValueError:
+                    pass
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            row.update({'p50_ms': round(percentile(timings, 50), 1), 'p95_ms': round(percentile(timings, 95), 1)})
+        rows.append(row)
+    report(f'Context of {len(questions)} questions (budget {args.budget} tokens)', rows)
+
+
+if __name__ == '__main__':
+    main()
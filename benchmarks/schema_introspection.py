@@ -0,0 +1,57 @@
+'''
+Compare per-schema and bulk catalog introspection of schema.load_from_db.
+
+Usage: python benchmarks/schema_introspection.py adventure_works [--repeat 5]
+'''
+import argparse
+from common import DSN, measure, report, summary
+
+from lib import schema
+from sqlalchemy import create_engine
+
+
+class CountingConnection:
+    '''
+    Wrap a connection and count the statements sent to the database.
+    '''
+
+    def __init__(self, con):
+        self.con = con
+        self.queries = 0
+
+    def execute(self, *args, **kwargs):
+        self.queries += 1
+        return self.con.execute(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_name')
+    parser.add_argument('--dsn', default=DSN)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(args.dsn.format(db_name=args.db_name))
+    rows = []
+    outputs = {}
+    with engine.connect() as con:
+        for bulk in [False, True]:
+            counter = CountingConnection(con)
+            output, timings = measure(
+                lambda: schema.load_from_db(counter, bulk=bulk), args.repeat)
+            outputs[bulk] = output
+            rows.append({
+                'mode': 'bulk' if bulk else 'per-schema',
+                'schemas': len(schema.load_schema_names(con)),
+                'queries': counter.queries // args.repeat,
+                **summary(timings),
+            })
+
+    report(f'load_from_db on {args.db_name} (ms)', rows)
+    if outputs[True] != outputs[False]:
+        raise SystemExit('bulk and per-schema output differ')
+    print('outputs are identical')
+
+
+if __name__ == '__main__':
+    main()
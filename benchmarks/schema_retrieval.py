@@ -0,0 +1,67 @@
+'''
+Measure the schema context sent to dbot: full snapshot vs relevance-pruned
+context, by prompt size and by recall of the tables each question needs.
+Works offline on the snapshot in data/db/<db_name>.json.
+
+Usage: python benchmarks/schema_retrieval.py adventure_works \
+    [--questions benchmarks/data/adventure_works_questions.jsonl]
+'''
+import argparse
+import json
+import time
+from common import report
+
+from lib import schema, utils
+from lib.schema_index import SchemaIndex
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_name')
+    parser.add_argument('--questions', default='benchmarks/data/adventure_works_questions.jsonl')
+    parser.add_argument('--top-k', type=int, default=8)
+    parser.add_argument('--budgets', default='1000,2000,3000,6000')
+    args = parser.parse_args()
+
+    with open(args.questions) as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+
+    snapshot = schema.load_snapshot(args.db_name)
+    start = time.perf_counter()
+    index = SchemaIndex(snapshot)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    full = index.full_size
+    names = {c.name for c in index.chunks}
+    present = sum(len(set(q['tables']) & names) for q in questions)
+    total = sum(len(q['tables']) for q in questions)
+    rows = [{'budget': 'full', 'tokens': full, 'ratio': 1.0,
+             'recall': round(present / total, 3), 'ms': 0}]
+    for budget in [int(b) for b in args.budgets.split(',')]:
+        tokens = 0
+        found = 0
+        elapsed = 0
+        for q in questions:
+            start = time.perf_counter()
+            context = index.context(q['question'], args.top_k, budget)
+            elapsed += time.perf_counter() - start
+            tokens += utils.count_tokens(context)
+            if index.full_size <= budget:
+                found += len(set(q['tables']) & names)
+            else:
+                selected = index.select(q['question'], args.top_k, budget)
+                found += len(set(q['tables']) & {index.chunks[i].name for i in selected})
+        rows.append({
+            'budget': budget,
+            'tokens': round(tokens / len(questions)),
+            'ratio': round(tokens / len(questions) / full, 3),
+            'recall': round(found / total, 3),
+            'ms': round(elapsed * 1000 / len(questions), 2),
+        })
+
+    print(f'{len(index.chunks)} objects indexed in {build_ms:.1f} ms\n')
+    report(f'schema context on {args.db_name}, top_k={args.top_k} (avg per question)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+'''
+End-to-end benchmark suite of the apps on a local fake stack: a fake LLM, the
+local hash embedder, a synthetic PDF and a Postgres database created from
+fixtures/install.sql (schema only, the CSV data isn't needed). Cases needing
+a missing piece are skipped.
+
+Every case reports latency percentiles, throughput (items per second) and the
+peak memory allocated by one run (tracemalloc). Results can be saved as a
+JSON baseline and compared with a later run.
+
+Usage (from the repository root):
+  python benchmarks/suite.py --setup            # create the database first
+  python benchmarks/suite.py [--only vdb] [--repeat 20] [--save main] [--compare main]
+'''
+import argparse
+import json
+import os
+import sqlparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from common import DSN, percentile, report, write_pdf
+
+from langchain.docstore.document import Document
+from sqlalchemy import create_engine
+from lib import dbot, llm, loader, schema, utils
+from lib.embeddings import EmbeddingPipeline, HashEmbeddings
+from lib.retrieval import HybridRetriever
+from lib.schema_index import SchemaIndex
+from lib.vdb import Vdb
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+QUESTIONS = os.path.join(ROOT, 'benchmarks', 'data', 'adventure_works_questions.jsonl')
+FIXTURE = os.path.join(ROOT, 'fixtures', 'install.sql')
+SQLS = [
+    'select p.name, sum(d.orderqty) from sales.salesorderdetail d join production.product p '
+    'on p.productid = d.productid group by p.name order by 2 desc limit 10',
+    'SELECT * FROM person.person WHERE lastname LIKE \'S%\'; SELECT count(*) FROM sales.customer',
+    'with t as (select territoryid, sum(subtotal) s from sales.salesorderheader group by 1) '
+    'select * from t where s > (select avg(s) from t)',
+]
+
+
+class Skip(Exception):
+    pass
+
+
+def setup(dsn, db_name, fixture):
+    '''
+    Create the benchmark database from the fixture, without its data.
+    '''
+    import psycopg2
+
+    admin = psycopg2.connect(dsn.format(db_name='postgres'))
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{db_name}"')
+        cursor.execute(f'CREATE DATABASE "{db_name}"')
+    admin.close()
+
+    with open(fixture) as f:
+        # psql meta-commands (\copy of the CSV files, \pset, \dt) are skipped
+        sql = '\n'.join(line for line in f.read().splitlines() if not line.startswith('\\'))
+    con = psycopg2.connect(dsn.format(db_name=db_name))
+    con.autocommit = True
+    failed = []
+    with con.cursor() as cursor:
+        for statement in sqlparse.split(sql):
+            # inserts reference rows of the CSV files
+            if sqlparse.format(statement, strip_comments=True).lstrip().upper().startswith('INSERT'):
+                continue
+            try:
+                cursor.execute(statement)
+            except psycopg2.Error as e:
+                failed.append(str(e).splitlines()[0])
+    con.close()
+    print(f'Database {db_name} created from {fixture}')
+    if failed:
+        # e.g. a missing extension (uuid-ossp, tablefunc) on the server
+        print(f'{len(failed)} statements failed, the first: {failed[0]}')
+
+
+class Context:
+    '''
+    The shared fixtures of the cases, created on first use.
+    '''
+
+    def __init__(self, args, path):
+        self.args = args
+        self.path = path
+        self._engine = None
+        self._snapshot = None
+        self._vdb = None
+
+    def engine(self):
+        if self._engine is None:
+            engine = create_engine(self.args.dsn.format(db_name=self.args.db))
+            try:
+                engine.connect().close()
+            except Exception as e:
+                raise Skip(f'no database: {str(e).splitlines()[0]}')
+            self._engine = engine
+        return self._engine
+
+    def snapshot(self):
+        if self._snapshot is None:
+            with self.engine().connect() as con:
+                schema.refresh(con, self.args.db, full=True)
+            self._snapshot = schema.load_snapshot(self.args.db)
+        return self._snapshot
+
+    def vdb(self):
+        if self._vdb is None:
+            self._vdb = Vdb(self.path, 'suite', embeddings=EmbeddingPipeline(HashEmbeddings()))
+            self._vdb.build(documents(self.args.chunks))
+        return self._vdb
+
+    def questions(self):
+        with open(QUESTIONS) as f:
+            return [json.loads(line)['question'] for line in f if line.strip()]
+
+
+def documents(n):
+    words = [f'term{i}' for i in range(5000)]
+    return [Document(page_content=' '.join(words[(i * 31 + j * 7) % len(words)] for j in range(250)),
+                     metadata={'page': i}) for i in range(n)]
+
+
+def case_load_from_db(ctx):
+    engine = ctx.engine()
+
+    def run():
+        with engine.connect() as con:
+            schema.load_from_db(con)
+        return 1
+    return run
+
+
+def case_refresh(ctx):
+    ctx.snapshot()
+
+    def run():
+        with ctx.engine().connect() as con:
+            schema.refresh(con, ctx.args.db)
+        return 1
+    return run
+
+
+def case_schema_index(ctx):
+    snapshot = ctx.snapshot()
+    return lambda: SchemaIndex(snapshot) and 1
+
+
+def case_prompt(ctx):
+    snapshot = ctx.snapshot()
+    sql = schema.render(snapshot)
+    index = SchemaIndex(snapshot)
+    questions = ctx.questions()
+
+    def run():
+        for question in questions:
+            context = dbot.context(sql, index, question)
+            dbot.PROMT.format(context=context, question=question)
+        return len(questions)
+    return run
+
+
+def case_generate(ctx):
+    snapshot = ctx.snapshot()
+    sql = schema.render(snapshot)
+    index = SchemaIndex(snapshot)
+    questions = ctx.questions()
+    client = llm.Client(llm.FakeBackend())
+
+    def run():
+        for question in questions:
+            dbot.generate(client, dbot.context(sql, index, question), question)
+        return len(questions)
+    return run
+
+
+def case_format_sql(ctx):
+    return lambda: [utils.format_sql(sql) for sql in SQLS] and len(SQLS)
+
+
+def case_vdb_build(ctx):
+    docs = documents(ctx.args.chunks)
+    # the embedding cache is off, so every run embeds all chunks
+    vdb = Vdb(ctx.path, 'build', embeddings=EmbeddingPipeline(HashEmbeddings()))
+    return lambda: vdb.build(docs) or len(docs)
+
+
+def case_vdb_load(ctx):
+    vdb = ctx.vdb()
+    return lambda: vdb.load() and 1
+
+
+def case_vdb_search(ctx):
+    store = ctx.vdb().load()
+    queries = [f'term{i} term{i * 3} term{i * 7}' for i in range(50)]
+    return lambda: [store.similarity_search(q, k=4) for q in queries] and len(queries)
+
+
+def case_hybrid_search(ctx):
+    retriever = HybridRetriever(ctx.vdb().load())
+    queries = [f'term{i} term{i * 3} term{i * 7}' for i in range(50)]
+    return lambda: [retriever.search(q) for q in queries] and len(queries)
+
+
+def case_pdf(ctx):
+    try:
+        import pdfminer  # noqa: F401
+    except ImportError:
+        raise Skip('pdfminer.six not installed')
+    path = os.path.join(ctx.path, 'suite.pdf')
+    write_pdf(path, ctx.args.pages)
+    return lambda: len(loader.pdf(path))
+
+
+CASES = [
+    ('schema', 'load_from_db', case_load_from_db),
+    ('schema', 'refresh (unchanged)', case_refresh),
+    ('schema', 'SchemaIndex', case_schema_index),
+    ('db', 'prompt assembly', case_prompt),
+    ('db', 'generate (fake llm)', case_generate),
+    ('db', 'format_sql', case_format_sql),
+    ('vdb', 'build', case_vdb_build),
+    ('vdb', 'load', case_vdb_load),
+    ('vdb', 'similarity_search', case_vdb_search),
+    ('vdb', 'hybrid search', case_hybrid_search),
+    ('pdf', 'loader.pdf', case_pdf),
+]
+
+
+def measure(fn, repeat):
+    fn()
+    timings = []
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items += fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'items_per_second': round(items / sum(timings), 1),
+        'peak_kb': round(peak / 1024),
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns rows comparing the median latency and peak memory with a baseline,
+    and whether any case regressed by more than `threshold`.
+    '''
+    rows = []
+    regressed = False
+    for name, result in results.items():
+        if name not in baseline or 'skipped' in result or 'skipped' in baseline[name]:
+            continue
+        before = baseline[name]
+        latency = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0
+        memory = result['peak_kb'] / before['peak_kb'] - 1 if before['peak_kb'] else 0
+        flag = latency > threshold or memory > threshold
+        regressed = regressed or flag
+        rows.append({'case': name, 'p50_before': before['p50_ms'], 'p50_now': result['p50_ms'],
+                     'p50_change': f'{latency:+.0%}', 'peak_change': f'{memory:+.0%}',
+                     'regression': 'YES' if flag else ''})
+    return rows, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=DSN, help='DSN with a {db_name} placeholder')
+    parser.add_argument('--db', default='bench_adventure_works')
+    parser.add_argument('--setup', action='store_true', help='create the database from the fixture')
+    parser.add_argument('--fixture', default=FIXTURE)
+    parser.add_argument('--only', help='comma separated groups: schema, db, vdb, pdf')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--chunks', type=int, default=2000, help='chunks of the synthetic Vdb')
+    parser.add_argument('--pages', type=int, default=20, help='pages of the synthetic PDF')
+    parser.add_argument('--save', help='save the results as baselines/<name>.json')
+    parser.add_argument('--compare', help='compare with baselines/<name>.json')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold')
+    args = parser.parse_args()
+
+    if args.setup:
+        setup(args.dsn, args.db, args.fixture)
+
+    groups = args.only.split(',') if args.only else None
+    results = {}
+    rows = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        # schema snapshots are written under data/db of the working directory
+        os.makedirs(os.path.join(path, 'data', 'db'))
+        os.chdir(path)
+        try:
+            ctx = Context(args, path)
+            for group, name, case in CASES:
+                if groups and group not in groups:
+                    continue
+                key = f'{group}/{name}'
+                try:
+                    results[key] = measure(case(ctx), args.repeat)
+                except Skip as e:
+                    results[key] = {'skipped': str(e)}
+                rows.append({'case': key, **{k: results[key].get(k, '') for k in
+                             ['p50_ms', 'p95_ms', 'p99_ms', 'items_per_second', 'peak_kb', 'skipped']}})
+        finally:
+            os.chdir(cwd)
+    report(f'Benchmark suite ({args.repeat} runs per case)', rows)
+
+    regressed = False
+    if args.compare:
+        with open(os.path.join(BASELINES, f'{args.compare}.json')) as f:
+            baseline = json.load(f)['results']
+        comparison, regressed = compare(results, baseline, args.threshold)
+        report(f'Compared with baseline {args.compare}', comparison)
+
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, f'{args.save}.json'), 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                       'args': {'repeat': args.repeat, 'chunks': args.chunks, 'pages': args.pages},
+                       'results': results}, f, indent=2)
+        print(f'Baseline saved to {BASELINES}/{args.save}.json')
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
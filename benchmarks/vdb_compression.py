@@ -0,0 +1,105 @@
+'''
+Compare the compression options of Vdb on a synthetic corpus of clustered
+vectors: index bytes per vector, query latency, and recall@10 against the
+exact float32 ranking, with and without the float32 re-rank.
+
+Usage: python benchmarks/vdb_compression.py [--chunks 20000] [--dim 1536] [--rerank 50] [--nprobe 16]
+'''
+import argparse
+import os
+import tempfile
+import time
+from common import percentile, report
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from lib.vdb import COMPRESSIONS, Vdb
+
+
+class ArrayEmbeddings(Embeddings):
+    '''
+    Embeds "chunk <i>" as row i of an array.
+    '''
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[int(t.split()[1])] for t in texts]
+
+    def embed_query(self, text):
+        return self.vectors[int(text.split()[1])]
+
+
+def corpus(chunks, dim, clusters, seed=0):
+    '''
+    Returns normalized vectors around random centers, like embeddings of texts
+    on a few topics.
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=chunks)] + rng.normal(scale=0.6, size=(chunks, dim))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--clusters', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank', type=int, default=50, help='candidates re-ranked by exact distance')
+    parser.add_argument('--nprobe', type=int, default=16, help='inverted lists searched by ivfpq')
+    args = parser.parse_args()
+
+    vectors = corpus(args.chunks, args.dim, args.clusters)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(args.chunks, args.queries, replace=False)]
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+    docs = [Document(page_content=f'chunk {i}', metadata={'page': i}) for i in range(args.chunks)]
+    embeddings = ArrayEmbeddings(vectors)
+
+    # the exact ranking, from the float32 vectors
+    truth = [set(np.argsort(((vectors - q) ** 2).sum(axis=1))[:args.k]) for q in queries]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        for compression in COMPRESSIONS:
+            name = compression or 'flat'
+            vdb = Vdb(path, name, embeddings=embeddings, compression=compression, rerank=args.rerank,
+                      nprobe=args.nprobe)
+            start = time.perf_counter()
+            vdb.build(docs)
+            build_s = time.perf_counter() - start
+            store = vdb.load()
+            index_bytes = os.path.getsize(vdb.faiss_name())
+
+            for rerank in ([args.rerank, 0] if compression else [0]):
+                store.rerank = rerank
+                timings = []
+                found = 0
+                for q, expected in zip(queries, truth):
+                    start = time.perf_counter()
+                    indices, _ = store.nearest(q, args.k)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    found += len(expected & set(int(i) for i in indices))
+                timings.sort()
+                rows.append({
+                    'compression': name,
+                    'rerank': rerank if compression else '-',
+                    'index_bytes_per_vector': round(index_bytes / args.chunks, 1),
+                    'build_s': round(build_s, 2),
+                    'p50_ms': round(percentile(timings, 50), 3),
+                    'p95_ms': round(percentile(timings, 95), 3),
+                    f'recall@{args.k}': round(found / (args.k * len(queries)), 3),
+                })
+            del store
+    report(f'Vdb compression ({args.chunks} vectors of {args.dim} dimensions, '
+           f'float32 vectors on disk: {args.dim * 4} bytes each)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Compare loading a legacy pickled Vdb (.idx/.pkl) with the memory-mapped
+format, by load time, first search time and resident memory growth. Builds a synthetic
+corpus of random vectors; each load runs in its own process.
+
+Usage: python benchmarks/vdb_load.py [--chunks 50000] [--dim 1536]
+'''
+import argparse
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from common import report, rss
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings.fake import FakeEmbeddings
+from langchain.vectorstores import FAISS
+from lib.vdb import Vdb
+
+
+def create(path, chunks, dim):
+    rng = np.random.default_rng(0)
+    index = faiss.IndexFlatL2(dim)
+    index.add(rng.random((chunks, dim), dtype=np.float32))
+    ids = {i: str(uuid.uuid4()) for i in range(chunks)}
+    docstore = InMemoryDocstore(
+        {ids[i]: Document(page_content=f'chunk {i} ' + 'lorem ipsum ' * 120) for i in range(chunks)})
+    store = FAISS(None, index, docstore, ids)
+
+    legacy = Vdb(path, 'legacy')
+    faiss.write_index(index, legacy.index_name())
+    store.index = None
+    with open(legacy.pickle_name(), 'wb') as f:
+        pickle.dump(store, f)
+
+    for ext in ['idx', 'pkl']:
+        shutil.copy(f'{path}/legacy.{ext}', f'{path}/mmap.{ext}')
+    Vdb(path, 'mmap').migrate()
+
+
+def run(path, name, dim):
+    before = rss()
+    start = time.perf_counter()
+    vdb = Vdb(path, name)
+    if name == 'legacy':
+        with open(vdb.pickle_name(), 'rb') as f:
+            store = pickle.load(f)
+        store.index = faiss.read_index(vdb.index_name())
+    else:
+        vdb.embeddings = FakeEmbeddings(size=dim)
+        store = vdb.load()
+    loaded = time.perf_counter()
+    store.similarity_search_by_vector(np.zeros(dim, dtype=np.float32), k=4)
+    searched = time.perf_counter()
+    return {
+        'format': name,
+        'load ms': round((loaded - start) * 1000, 1),
+        'first search ms': round((searched - loaded) * 1000, 1),
+        'rss growth MB': round((rss() - before) / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--path')
+    parser.add_argument('--format')
+    args = parser.parse_args()
+
+    if args.format:
+        print(json.dumps(run(args.path, args.format, args.dim)))
+        return
+
+    path = tempfile.mkdtemp()
+    try:
+        create(path, args.chunks, args.dim)
+        rows = []
+        for name in ['legacy', 'mmap']:
+            out = subprocess.run([sys.executable, __file__, '--path', path, '--format', name,
+                                  '--dim', str(args.dim)], check=True, capture_output=True, text=True).stdout
+            rows.append(json.loads(out.strip().splitlines()[-1]))
+        size = sum(os.path.getsize(f'{path}/mmap.{ext}') for ext in ['faiss', 'chunks', 'json'])
+        report(f'{args.chunks} chunks of {args.dim} dimensions ({size / 2**20:.0f} MB on disk)', rows)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
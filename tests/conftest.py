@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the apps import their library as `lib`, from apps/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apps'))
@@ -0,0 +1,118 @@
+import pytest
+from lib import answer_cache
+from lib.answer_cache import AnswerCache
+
+ANSWER = {'sql': 'SELECT 1;', 'type': 'SELECT'}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Complete:
+    '''
+    A stub completion function counting its calls.
+    '''
+
+    def __init__(self, answer=ANSWER):
+        self.answer = answer
+        self.calls = []
+
+    def __call__(self, question):
+        self.calls.append(question)
+        return dict(self.answer, question=question)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(answer_cache.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return AnswerCache(str(tmp_path / 'answers.sqlite'), max_entries=2, ttl=60)
+
+
+def test_miss_then_hit(cache):
+    complete = Complete()
+    answer, cached = cache.get_or_create('db', 'f1', 'How many orders?', complete)
+    assert not cached
+    again, cached = cache.get_or_create('db', 'f1', 'How many orders?', complete)
+    assert cached
+    assert again == answer
+    assert len(complete.calls) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_normalized_question_hits(cache):
+    complete = Complete()
+    cache.get_or_create('db', 'f1', 'How many orders?', complete)
+    _, cached = cache.get_or_create('db', 'f1', '  how   many ORDERS ', complete)
+    assert cached
+    assert len(complete.calls) == 1
+
+
+def test_answers_without_sql_are_not_cached(cache):
+    complete = Complete({'error': 'no table'})
+    cache.get_or_create('db', 'f1', 'q', complete)
+    _, cached = cache.get_or_create('db', 'f1', 'q', complete)
+    assert not cached
+    assert len(complete.calls) == 2
+
+
+def test_ttl_expiry(cache, clock):
+    complete = Complete()
+    cache.get_or_create('db', 'f1', 'q', complete)
+    clock.now += 59
+    assert cache.get_or_create('db', 'f1', 'q', complete)[1]
+    clock.now += 2
+    assert not cache.get_or_create('db', 'f1', 'q', complete)[1]
+    assert len(complete.calls) == 2
+
+
+def test_lru_eviction(cache, clock):
+    complete = Complete()
+    for question in ['a', 'b']:
+        cache.get_or_create('db', 'f1', question, complete)
+        clock.now += 1
+    # a is used more recently than b
+    assert cache.get_or_create('db', 'f1', 'a', complete)[1]
+    clock.now += 1
+    cache.get_or_create('db', 'f1', 'c', complete)
+    assert cache.stats()['entries'] == 2
+    assert cache.get('db', 'f1', 'a') is not None
+    assert cache.get('db', 'f1', 'b') is None
+    assert cache.get('db', 'f1', 'c') is not None
+
+
+def test_fingerprint_change_invalidates(cache):
+    complete = Complete()
+    cache.get_or_create('db', 'f1', 'q', complete)
+    cache.get_or_create('other', 'f1', 'q', complete)
+    assert not cache.get_or_create('db', 'f2', 'q', complete)[1]
+    # the old answers of the database are dropped, not those of others
+    assert cache.get('db', 'f1', 'q') is None
+    assert cache.get('other', 'f1', 'q') is not None
+
+
+def test_near_duplicate_hit(tmp_path, clock):
+    vectors = {
+        'total sales by region': [1.0, 0.0, 0.0],
+        'sales total by region': [0.99, 0.1, 0.0],
+        'top customers': [0.0, 1.0, 0.0],
+    }
+    cache = AnswerCache(str(tmp_path / 'answers.sqlite'), embed=lambda q: vectors[q], similarity=0.95)
+    complete = Complete()
+    cache.get_or_create('db', 'f1', 'Total sales by region?', complete)
+    answer, cached = cache.get_or_create('db', 'f1', 'sales total by region', complete)
+    assert cached
+    assert answer['question'] == 'Total sales by region?'
+    assert not cache.get_or_create('db', 'f1', 'top customers', complete)[1]
+    assert cache.stats()['near_hits'] == 1
@@ -0,0 +1,177 @@
+import pytest
+from lib import guard
+
+
+def test_parse_single_statement():
+    statement = guard.parse('SELECT * FROM sales.orders;\n')
+    assert statement.get_type() == 'SELECT'
+
+
+def test_parse_ignores_empty_statements():
+    assert guard.parse(';  SELECT 1;  ;').get_type() == 'SELECT'
+
+
+@pytest.mark.parametrize('sql', ['', ';', 'SELECT 1; DROP TABLE orders;'])
+def test_parse_rejects(sql):
+    with pytest.raises(guard.Rejected):
+        guard.parse(sql)
+
+
+def test_add_limit_appends():
+    sql = guard.add_limit(guard.parse('SELECT id FROM orders ORDER BY id;'), 1000)
+    assert sql == 'SELECT id FROM orders ORDER BY id\nLIMIT 1000'
+
+
+def test_add_limit_wraps_a_limited_statement():
+    sql = guard.add_limit(guard.parse('SELECT id FROM orders LIMIT 5000'), 1000)
+    assert sql == 'SELECT * FROM (\nSELECT id FROM orders LIMIT 5000\n) AS limited LIMIT 1000'
+
+
+def test_add_limit_ignores_limit_in_subqueries():
+    sql = guard.add_limit(guard.parse('SELECT * FROM (SELECT id FROM orders LIMIT 5) o'), 10)
+    assert sql.endswith('o\nLIMIT 10')
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT id FROM orders FOR UPDATE', 'SELECT id FROM orders\nLIMIT 10 FOR UPDATE'),
+    ('SELECT * FROM orders o JOIN customers c ON true FOR NO KEY UPDATE OF o, c SKIP LOCKED;',
+     'SELECT * FROM orders o JOIN customers c ON true\nLIMIT 10 FOR NO KEY UPDATE OF o, c SKIP LOCKED'),
+    ('SELECT id FROM orders FOR UPDATE OF orders FOR SHARE NOWAIT',
+     'SELECT id FROM orders\nLIMIT 10 FOR UPDATE OF orders FOR SHARE NOWAIT'),
+])
+def test_add_limit_before_locking_clauses(sql, expected):
+    assert guard.add_limit(guard.parse(sql), 10) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT 1', 'SELECT'),
+    ('(SELECT id FROM orders) UNION (SELECT id FROM returns)', 'SELECT'),
+    ('((SELECT 1)) EXCEPT SELECT 2', 'SELECT'),
+    ('WITH o AS (SELECT 1) SELECT * FROM o', 'SELECT'),
+    ('DELETE FROM orders', 'DELETE'),
+])
+def test_statement_type(sql, expected):
+    assert guard.statement_type(guard.parse(sql)) == expected
+
+
+def test_relations_of_a_plan():
+    plan = {'Node Type': 'Hash Join', 'Plans': [
+        {'Node Type': 'Seq Scan', 'Relation Name': 'orders', 'Schema': 'sales'},
+        {'Node Type': 'Hash', 'Plans': [{'Node Type': 'Seq Scan', 'Relation Name': 'customers'}]},
+    ]}
+    assert guard.relations(plan) == {'sales.orders', 'public.customers'}
+
+
+class Cursor:
+    '''
+    A DB-API cursor returning the canned EXPLAIN plan of the connection.
+    '''
+
+    def __init__(self, con):
+        self.con = con
+
+    def execute(self, sql):
+        self.con.executed.append(sql)
+
+    def fetchone(self):
+        return [self.con.plan(self.con.executed[-1])]
+
+    def close(self):
+        pass
+
+
+class Connection:
+    '''
+    A DB-API connection whose EXPLAIN returns the plan of `plan(sql)`.
+    '''
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def plan(cost, rows, relation='orders'):
+    return [{'Plan': {'Node Type': 'Seq Scan', 'Relation Name': relation, 'Schema': 'sales',
+                      'Total Cost': cost, 'Plan Rows': rows}}]
+
+
+def test_check_explains_in_a_read_only_transaction():
+    con = Connection(lambda sql: plan(100.0, 10))
+    result = guard.Preflight(statement_timeout=5000).check(con, 'SELECT * FROM sales.orders;')
+    assert result['sql'] == 'SELECT * FROM sales.orders'
+    assert (result['type'], result['cost'], result['rows']) == ('SELECT', 100.0, 10)
+    assert result['tables'] == ['sales.orders'] and not result['limited']
+    assert con.executed == ['SET TRANSACTION READ ONLY', 'SET LOCAL statement_timeout = 5000',
+                            'EXPLAIN (FORMAT JSON, VERBOSE) SELECT * FROM sales.orders']
+    assert con.rollbacks == 1
+
+
+def test_check_rejects_over_max_cost():
+    con = Connection(lambda sql: plan(5000.0, 10))
+    with pytest.raises(guard.Rejected) as e:
+        guard.Preflight(max_cost=1000).check(con, 'SELECT * FROM sales.orders')
+    assert e.value.plan['cost'] == 5000.0
+    assert 'exceeds the limit' in e.value.plan['rejected']
+
+
+def test_check_limits_large_selects():
+    con = Connection(lambda sql: plan(50.0, 100) if 'LIMIT' in sql else plan(500.0, 1000000))
+    result = guard.Preflight(max_rows=1000, limit=100).check(con, 'SELECT * FROM sales.orders')
+    assert result['limited']
+    assert result['sql'] == 'SELECT * FROM sales.orders\nLIMIT 100'
+    assert (result['cost'], result['rows']) == (50.0, 100)
+
+
+def test_check_rejects_a_limited_select_still_over_max_cost():
+    con = Connection(lambda sql: plan(5000.0, 100) if 'LIMIT' in sql else plan(9000.0, 1000000))
+    with pytest.raises(guard.Rejected) as e:
+        guard.Preflight(max_cost=1000, max_rows=1000).check(con, 'SELECT * FROM sales.orders')
+    assert e.value.plan['limited'] and e.value.plan['cost'] == 5000.0
+
+
+def test_check_rejects_writes_unless_allowed():
+    con = Connection(lambda sql: plan(10.0, 1))
+    with pytest.raises(guard.Rejected):
+        guard.Preflight(allow_writes=False).check(con, 'DELETE FROM sales.orders')
+    assert con.executed == []
+    result = guard.Preflight(allow_writes=True).check(con, 'DELETE FROM sales.orders')
+    assert result['type'] == 'DELETE' and result['cost'] == 10.0
+
+
+def test_check_allows_parenthesized_selects():
+    con = Connection(lambda sql: plan(10.0, 2))
+    result = guard.Preflight().check(con, '(SELECT id FROM orders) UNION (SELECT id FROM returns)')
+    assert result['type'] == 'SELECT'
+
+
+def test_check_rejects_invalid_sql():
+    def fail(sql):
+        raise ValueError('syntax error at or near "FORM"')
+
+    con = Connection(fail)
+    with pytest.raises(guard.Rejected) as e:
+        guard.Preflight().check(con, 'SELECT * FORM orders')
+    assert e.value.reason.startswith('Invalid SQL')
+    assert con.rollbacks == 1
+
+
+def test_stats_counts_checks():
+    preflight = guard.Preflight(max_cost=1000, max_rows=1000)
+    costs = {'a': plan(10.0, 1), 'b': plan(30.0, 1), 'c': plan(5000.0, 1)}
+    con = Connection(lambda sql: plan(20.0, 10) if 'LIMIT' in sql else costs.get(sql[-1], plan(20.0, 5000)))
+    for sql in ['SELECT * FROM a', 'SELECT * FROM b', 'SELECT * FROM c', 'SELECT * FROM d']:
+        try:
+            preflight.check(con, sql)
+        except guard.Rejected:
+            pass
+    stats = preflight.stats()
+    assert (stats['checked'], stats['rejected'], stats['limited']) == (4, 1, 1)
+    assert (stats['cost_median'], stats['cost_max']) == (30.0, 5000.0)
+    assert stats['last']['sql'] == 'SELECT * FROM d\nLIMIT 1000'
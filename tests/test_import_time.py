@@ -0,0 +1,19 @@
+import os
+import pytest
+import sys
+
+# the checks and the measure are those of benchmarks/import_time.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import import_time  # noqa: E402
+
+# multiply the budgets on slow machines, e.g. IMPORT_TIME_SCALE=2
+SCALE = float(os.environ.get('IMPORT_TIME_SCALE', '1'))
+
+
+@pytest.mark.parametrize('app', list(import_time.CHECKS))
+def test_import_time(app):
+    check = import_time.CHECKS[app]
+    # the fastest of a few runs, as in the benchmark
+    total, packages = min((import_time.importtime(check['imports']) for _ in range(3)), key=lambda r: r[0])
+    assert [m for m in check['lazy'] if m in packages] == []
+    assert total <= check['budget_ms'] * SCALE
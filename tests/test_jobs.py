@@ -0,0 +1,65 @@
+import threading
+import time
+from lib.jobs import Jobs
+
+
+def wait(jobs, target, timeout=5):
+    start = time.time()
+    while jobs.active(target):
+        assert time.time() - start < timeout, 'the job did not finish'
+        time.sleep(0.01)
+    return jobs.status(target)
+
+
+def test_submit_dedups_active_jobs(tmp_path):
+    jobs = Jobs(str(tmp_path))
+    release = threading.Event()
+    calls = []
+
+    def build(job, value):
+        calls.append(value)
+        job.progress(1, 2)
+        release.wait(5)
+        return {'value': value}
+
+    first = jobs.submit('vdb:manual', build, 1)
+    second = jobs.submit('vdb:manual', build, 2)
+    assert second['id'] == first['id']
+    release.set()
+
+    status = wait(jobs, 'vdb:manual')
+    assert status['state'] == 'done'
+    assert status['result'] == {'value': 1}
+    assert calls == [1]
+
+
+def test_submit_after_done_runs_again(tmp_path):
+    jobs = Jobs(str(tmp_path))
+    first = jobs.submit('schema:db', lambda job: 'a')
+    wait(jobs, 'schema:db')
+    second = jobs.submit('schema:db', lambda job: 'b')
+    assert second['id'] != first['id']
+    assert wait(jobs, 'schema:db')['result'] == 'b'
+
+
+def test_targets_are_independent(tmp_path):
+    jobs = Jobs(str(tmp_path))
+    release = threading.Event()
+    first = jobs.submit('vdb:a', lambda job: release.wait(5))
+    second = jobs.submit('vdb:b', lambda job: 'b')
+    assert second['id'] != first['id']
+    assert wait(jobs, 'vdb:b')['result'] == 'b'
+    release.set()
+    wait(jobs, 'vdb:a')
+
+
+def test_failed_job(tmp_path):
+    jobs = Jobs(str(tmp_path))
+
+    def fail(job):
+        raise RuntimeError('no such file')
+
+    jobs.submit('vdb:broken', fail)
+    status = wait(jobs, 'vdb:broken')
+    assert status['state'] == 'failed'
+    assert 'no such file' in status['error']
@@ -0,0 +1,58 @@
+import random
+import pytest
+from langchain.docstore.document import Document
+from lib.embeddings import HashEmbeddings
+from lib.vdb import Vdb
+
+WORDS = ['revenue', 'growth', 'margin', 'region', 'customer', 'product', 'quarter', 'segment', 'cost',
+         'outlook', 'market', 'share', 'capital', 'return', 'risk', 'demand', 'supply', 'price']
+DISCLAIMER = ('This report contains forward looking statements that involve risks and uncertainties, '
+              'and actual results may differ materially from those expressed or implied in them.')
+
+
+def pages(count):
+    '''
+    Pages of a report: a running header, paragraphs, a disclaimer on every
+    other page and a numbered footer.
+    '''
+    rng = random.Random(7)
+    docs = []
+    for page in range(count):
+        lines = ['ACME Annual Report', '']
+        if page % 4 == 0:
+            lines += [f'{page // 4 + 1}. Section {page // 4 + 1}', '']
+        for _ in range(3):
+            lines += [' '.join(rng.choice(WORDS) for _ in range(40)).capitalize() + '.', '']
+        if page % 2 == 0:
+            lines += [DISCLAIMER, '']
+        lines += [f'Page {page + 1} of {count}']
+        docs.append(Document(page_content='\n'.join(lines), metadata={'page': page}))
+    return docs
+
+
+def interrupted(docs, after):
+    yield from docs[:after]
+    raise KeyboardInterrupt
+
+
+def chunks(vdb):
+    store = vdb.load()
+    return [(store.text(i), store.document(i).metadata['page']) for i in range(len(store))]
+
+
+def test_resumed_build_splits_like_a_full_build(tmp_path):
+    docs = pages(40)
+    full = Vdb(str(tmp_path), 'full', chunk_size=500, chunk_overlap=50, embeddings=HashEmbeddings(), embed_batch=1)
+    full.build(docs)
+
+    resumed = Vdb(str(tmp_path), 'resumed', chunk_size=500, chunk_overlap=50, embeddings=HashEmbeddings(),
+                  embed_batch=1)
+    with pytest.raises(KeyboardInterrupt):
+        resumed.build(interrupted(docs, 8))
+    start = resumed._resume()
+    assert start == 8
+    resumed._build(docs[start:], start, None)
+
+    assert chunks(resumed) == chunks(full)
+    # the footer is stripped once it was seen on 3 pages
+    assert {page for text, page in chunks(resumed) if 'Page ' in text} == {0, 1, 2}